@@ -2,13 +2,957 @@
 Filename: agentframework.py 
 
 Contains: 
-- Classes: Agent and Wolf
+- Classes: SpatialGrid, NeighbourList, AgentPopulation, Agent, World and 
+           Wolf
+- Methods (SpatialGrid): rebuild, refresh, update, remove, candidates.
+- Methods (NeighbourList): rebuild, refresh, update, remove, candidates.
+- Methods (AgentPopulation): add, use_grid, use_neighbour_list, 
+                             use_kernel, set_position, occupants, live_rows, kill, 
+                             revive, rebuild_indexes, wrapped, pairs_within,
+                             plan_moves, move_all, move_one, eat_one, 
+                             eat_all, share_one, share_all, 
+                             order_of_agents, reorder_agents, rank_of, step,
+                             step_synchronous.
 - Methods (Agent): move, eat, share_with_neighbours, distance_between, 
                    Get<var name> (multiple) and Set<var name> (multiple).
-- Methods (Wolf): move, hunt, Get<var name> (multiple) and 
-                  Set<var name> (multiple).
+- Methods (Wolf): move, hunt and Get<var name> (multiple).
+- Functions: palette_index, move_wolves, pairs_within, eat_cells.
 '''
-import random
+import math
+import time
+import array
+import numpy as np
+import modelprofile
+from environment import Environment, TiledEnvironment
+
+# Plotting colours of the Agents and Wolves, each of which holds an index
+# into the palette: 256 colours of 3 bits red, 3 bits green and 2 bits 
+# blue, as hex strings and as an array of RGBA values (0 to 1)
+PALETTE = ['#%02x%02x%02x' % ((index >> 5) * 255 // 7, 
+                              ((index >> 2) & 7) * 255 // 7, 
+                              (index & 3) * 255 // 3) 
+           for index in range(256)]
+PALETTE_RGBA = np.array([[(index >> 5) / 7, ((index >> 2) & 7) / 7, 
+                          (index & 3) / 3, 1.0] for index in range(256)])
+
+# Furthest an Agent moves in one iteration (one cell diagonally)
+STEP_DISTANCE = math.sqrt(2)
+
+#----------------------------------------------------------
+# SpatialGrid Class
+#----------------------------------------------------------
+class SpatialGrid():
+    '''
+    Uniform grid (cell bucket) index over the rows of an AgentPopulation.
+    
+    Buckets are square with a side of at least the neighbourhood distance,
+    so every neighbour of an Agent lies in its own bucket or one of the 8
+    buckets around it.  The index is updated incrementally as Agents move.
+    Only live rows are held; a row is removed when its Agent is killed.
+    '''
+    def __init__(self, population, neighbourhood):
+        '''
+        Initialisation of the SpatialGrid instance with:
+            - Bucket size
+            - Buckets holding every live row of the population
+        
+        Inputs:
+            - population: AgentPopulation to index
+            - neighbourhood: Distance considered to be a neighbour
+        '''
+        self.population = population
+        self.cell_size = max(1, int(math.ceil(neighbourhood)))
+        self.rebuild()
+        
+        
+    def rebuild(self):
+        '''
+        Place every live row of the population in its bucket
+        '''
+        n = len(self.population)
+        live = self.population.live_rows()
+        cys = (self.population.y[live] // self.cell_size).tolist()
+        cxs = (self.population.x[live] // self.cell_size).tolist()
+        
+        # Bucket of each row (None if dead)
+        self.cells = [None] * n
+        self.buckets = {}
+        
+        for i, cell in zip(live.tolist(), zip(cys, cxs)):
+            self.cells[i] = cell
+            self.buckets.setdefault(cell, set()).add(i)
+            
+            
+    def refresh(self):
+        '''
+        Bring the index up to date after a batch of moves
+        '''
+        self.rebuild()
+        
+        
+    def update(self, i):
+        '''
+        Move row i to a new bucket if it has left its current one (or
+        put it in one if it has been revived)
+        '''
+        if i >= len(self.cells):
+            # Row added since the last rebuild
+            self.rebuild()
+            return
+        
+        if not self.population.alive[i]:
+            return
+        
+        cell = (int(self.population.y[i]) // self.cell_size, 
+                int(self.population.x[i]) // self.cell_size)
+        
+        if cell != self.cells[i]:
+            self.remove(i)
+            self.buckets.setdefault(cell, set()).add(i)
+            self.cells[i] = cell
+            
+            
+    def remove(self, i):
+        '''
+        Take row i out of its bucket (Agent killed)
+        '''
+        if i < len(self.cells) and self.cells[i] is not None:
+            bucket = self.buckets[self.cells[i]]
+            bucket.discard(i)
+            
+            if not bucket:
+                del self.buckets[self.cells[i]]
+                
+            self.cells[i] = None
+            
+            
+    def candidates(self, i):
+        '''
+        Rows in the 3 x 3 block of buckets around row i (including i)
+        '''
+        cy, cx = self.cells[i]
+        rows = []
+        
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                bucket = self.buckets.get((cy + dy, cx + dx))
+                
+                if bucket:
+                    rows.extend(bucket)
+                    
+        return np.fromiter(rows, dtype=np.intp, count=len(rows))
+
+
+#----------------------------------------------------------
+# NeighbourList Class
+#----------------------------------------------------------
+class NeighbourList():
+    '''
+    Verlet neighbour list over the rows of an AgentPopulation.
+    
+    Holds, for every row, the rows within the neighbourhood distance plus a
+    skin margin when the list was built.  Distances (and moves since the 
+    build) are measured round the toroidal raster, which is never more 
+    than the straight distance, so while no Agent has moved more than half
+    the skin every true neighbour is still in the list.  The list is 
+    rebuilt (when next used) once some Agent has.  AgentPopulation.step 
+    checks every Agent at once, up front, allowing for its one move, so 
+    the skin must be at least two steps; other moves are checked one by 
+    one.  Only live rows are listed; rows killed since the last build are
+    skipped by share_one until the next one.
+    '''
+    def __init__(self, population, neighbourhood, skin):
+        '''
+        Initialisation of the NeighbourList instance with:
+            - List distance (neighbourhood + skin)
+            - Neighbour rows of every live row of the population
+            - Rebuild counter (not counting this first build)
+            - Moves allowed for without checking (none)
+        
+        Inputs:
+            - population: AgentPopulation to index
+            - neighbourhood: Distance considered to be a neighbour
+            - skin: Extra distance listed beyond the neighbourhood (at 
+                    least 2 * STEP_DISTANCE)
+        '''
+        if skin < 2 * STEP_DISTANCE:
+            raise ValueError('Neighbour list skin must be at least ' + 
+                             '%.2f (two moves).' % (2 * STEP_DISTANCE))
+            
+        self.population = population
+        self.skin = skin
+        self.reach = neighbourhood + skin
+        self.rebuilds = -1
+        self.ahead = 0.0
+        self.rebuild()
+        
+        
+    def rebuild(self):
+        '''
+        List the live rows within reach of every live row (toroidal 
+        distance)
+        '''
+        n = len(self.population)
+        live = self.population.live_rows()
+        first, second = self.population.pairs_within(live, self.reach)
+        
+        # Neighbour rows of row i are neighbours[starts[i]:starts[i+1]]
+        self.neighbours = second[np.argsort(first, kind='stable')]
+        self.starts = np.r_[0, np.cumsum(np.bincount(first, minlength=n))]
+        self.listed = np.zeros(n, dtype=bool)
+        self.listed[live] = True
+        self.built_y = self.population.y[:n].copy()
+        self.built_x = self.population.x[:n].copy()
+        self.stale = False
+        self.rebuilds += 1
+        
+        
+    def refresh(self, ahead=0.0):
+        '''
+        Rebuild now if any Agent has moved over half the skin since the 
+        last build, or could have after moving ahead cells further.  Moves
+        are not checked one by one (update) until the next refresh.
+        
+        Inputs:
+            - ahead: Distance every Agent may yet move before the list is
+                     next refreshed (e.g. one diagonal move per iteration;
+                     0 to check every move from now on)
+        '''
+        self.ahead = ahead
+        live = self.population.live_rows()
+        
+        if len(self.population) != len(self.listed) or \
+                not self.listed[live].all():
+            # Rows added or revived since the last build
+            self.rebuild()
+            return
+        
+        dy, dx = self.population.wrapped(
+            self.population.y[live] - self.built_y[live],
+            self.population.x[live] - self.built_x[live])
+        
+        if len(live) > 0 and \
+                2 * (np.sqrt((dy * dy + dx * dx).max()) + ahead) > self.skin:
+            self.rebuild()
+            
+            
+    def update(self, i):
+        '''
+        Flag a rebuild if row i has moved over half the skin since the 
+        last build (or was added or revived since), unless the last 
+        refresh allowed for the move
+        '''
+        if self.ahead > 0 or self.stale or not self.population.alive[i]:
+            return
+        
+        if i >= len(self.listed) or not self.listed[i]:
+            self.stale = True
+            return
+        
+        # Plain integer arithmetic (called for every move)
+        height = self.population.y_boundary + 1
+        width = self.population.x_boundary + 1
+        dy = abs(int(self.population.y[i]) - int(self.built_y[i])) % height
+        dx = abs(int(self.population.x[i]) - int(self.built_x[i])) % width
+        dy = min(dy, height - dy)
+        dx = min(dx, width - dx)
+        
+        if 4 * (dy * dy + dx * dx) > self.skin * self.skin:
+            self.stale = True
+    
+    
+    def remove(self, i):
+        '''
+        Agent i killed - nothing to do until the next rebuild drops it
+        '''
+        pass
+    
+    
+    def candidates(self, i):
+        '''
+        Listed neighbour rows of row i (rebuilding the list first if it 
+        is out of date)
+        '''
+        if self.stale:
+            self.rebuild()
+            
+        return self.neighbours[self.starts[i]:self.starts[i + 1]]
+
+
+#----------------------------------------------------------
+# AgentPopulation Class
+#----------------------------------------------------------
+class AgentPopulation():
+    '''
+    Struct-of-arrays store of every Agent in the model.
+    
+    Each Agent is a row: positions, stores, move counts and alive flags are
+    held in contiguous NumPy arrays so a whole iteration can be run over the
+    population without going through one Python object per Agent.  Agent
+    instances are light views onto a row of this store.
+    
+    The rows of live Agents are also kept packed together (updated as 
+    Agents are killed or revived), so per-iteration work only visits the 
+    live Agents however many have been killed.
+    '''
+    def __init__(self, environment, capacity=64, rng=None):
+        '''
+        Initialisation of the AgentPopulation instance with:
+            - x and y boundary variables
+            - Random number generator
+            - Empty row arrays (grown on demand)
+            - Empty live row index
+        
+        Inputs:
+            - environment: Environment raster (the Agents graze on it in
+                           place, so raster data in any other form is 
+                           refused rather than copied)
+            - capacity: Number of rows to allocate up front
+            - rng: numpy.random.Generator for every Agent draw (defaults 
+                   to a freshly seeded one)
+        '''
+        if not isinstance(environment, Environment):
+            raise ValueError('Agents need an Environment raster to graze '
+                             'on (wrap the raster rows in Environment and '
+                             'read the cells back from it).')
+            
+        self.environment = environment
+        
+        # Cells are read and written through this with [y, x] (the raster
+        # array, or the tile cache of a TiledEnvironment)
+        self.cells = environment.cells
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.y_boundary = environment.y_boundary
+        self.x_boundary = environment.x_boundary
+        self.size = 0
+        self.y = np.zeros(capacity, dtype=np.int64)
+        self.x = np.zeros(capacity, dtype=np.int64)
+        self.store = np.zeros(capacity, dtype=np.float64)
+        self.moves = np.zeros(capacity, dtype=np.int64)
+        self.alive = np.zeros(capacity, dtype=bool)
+        
+        # Live rows are live[:live_count] (in no particular order); slot 
+        # is the position of each live row in live
+        self.live = np.zeros(capacity, dtype=np.intp)
+        self.slot = np.zeros(capacity, dtype=np.intp)
+        self.live_count = 0
+        
+        # Plotting colour of each row (index into PALETTE)
+        self.colour_index = np.zeros(capacity, dtype=np.uint8)
+        self.grid = None
+        self.kernel = None
+        
+        # Agent views of the rows, in row order (the agents list the first
+        # Agent was made with)
+        self.agents = None
+        
+        # Rows of the agents list in list order and the position of each
+        # row in it, as visited by Agent.share_with_neighbours.  Built when
+        # first needed and again after Agents are added or reorder_agents
+        # is called.
+        self.agent_order = None
+        self.agent_rank = None
+        
+        # Rows of the live Agents by cell, in a hash table sized to the 
+        # Agents rather than the raster: the rows whose cell number masked
+        # by cell_mask is b are cell_rows[cell_starts[b]:cell_starts[b+1]]
+        # (in row order, with the cell number of each in cell_keys).  Built
+        # when first needed after the Agents have moved.
+        self.cell_keys = None
+        self.cell_rows = None
+        self.cell_starts = None
+        self.cell_mask = 0
+        
+        
+    def __len__(self):
+        '''
+        Number of Agents held (alive or dead)
+        '''
+        return self.size
+
+
+    def add(self, start_y=None, start_x=None):
+        '''
+        Append a new Agent row and return its index.
+        
+        Inputs:
+            - start_y: Default starting y coordinate (may not be supplied)
+            - start_x: Default starting x coordinate (may not be supplied)
+        '''
+        if self.size == len(self.y):
+            # Double the capacity of every row array
+            capacity = max(1, 2 * len(self.y))
+            
+            for name in ('y', 'x', 'store', 'moves', 'alive', 'live', 
+                         'slot', 'colour_index'):
+                old = getattr(self, name)
+                new = np.zeros(capacity, dtype=old.dtype)
+                new[:self.size] = old[:self.size]
+                setattr(self, name, new)
+                
+        i = self.size
+        self.colour_index[i] = palette_index(
+            self.rng.integers(0x000000, 0xffffff, endpoint=True))
+        
+        # Randomise starting position if not supplied
+        if start_y is None:
+            self.y[i] = self.rng.integers(0, self.y_boundary, endpoint=True)
+        else:
+            self.y[i] = start_y
+            
+        if start_x is None:
+            self.x[i] = self.rng.integers(0, self.x_boundary, endpoint=True)
+        else:
+            self.x[i] = start_x
+            
+        self.store[i] = 0
+        self.moves[i] = 0
+        self.alive[i] = True
+        self.live[self.live_count] = i
+        self.slot[i] = self.live_count
+        self.live_count += 1
+        self.size += 1
+        self.cell_keys = None
+        self.agent_order = None
+        
+        if self.grid is not None:
+            self.grid.update(i)
+        
+        return i
+    
+    
+    def use_grid(self, neighbourhood):
+        '''
+        Switch neighbour searches to a SpatialGrid index.
+        
+        Inputs:
+            - neighbourhood: Distance considered to be a neighbour 
+                             (None to go back to the brute-force search)
+        '''
+        if neighbourhood is None:
+            self.grid = None
+        else:
+            self.grid = SpatialGrid(self, neighbourhood)
+    
+    
+    def use_neighbour_list(self, neighbourhood, skin):
+        '''
+        Switch neighbour searches to a NeighbourList reused across 
+        iterations (held in place of the SpatialGrid).
+        
+        Inputs:
+            - neighbourhood: Distance considered to be a neighbour
+            - skin: Extra distance listed beyond the neighbourhood
+        '''
+        self.grid = NeighbourList(self, neighbourhood, skin)
+    
+    
+    def use_kernel(self, kernel):
+        '''
+        Run step through a compiled kernel (see modelkernels.py).
+        
+        Inputs:
+            - kernel: Step kernel (None to go back to the Python 
+                      implementation)
+        '''
+        self.kernel = kernel
+    
+    
+    def set_position(self, i, y, x):
+        '''
+        Place Agent i on cell (y, x), keeping the indexes up to date
+        '''
+        self.cell_keys = None
+        self.y[i] = y
+        self.x[i] = x
+        
+        if self.grid is not None:
+            self.grid.update(i)
+            
+            
+    def occupants(self, y, x):
+        '''
+        Rows of the live Agents on cell (y, x), in row order
+        '''
+        if self.cell_keys is None:
+            # Rows of the Agents live now (any killed later are skipped),
+            # under one to a bucket on average, held in arrays of the 
+            # array module (quicker to read an item at a time than NumPy)
+            rows = np.sort(self.live_rows())
+            keys = self.y[rows] * (self.x_boundary + 1) + self.x[rows]
+            self.cell_mask = (1 << len(rows).bit_length()) - 1
+            buckets = keys & self.cell_mask
+            order = np.argsort(buckets, kind='stable')
+            starts = np.r_[0, np.cumsum(np.bincount(
+                buckets, minlength=self.cell_mask + 1))]
+            self.cell_keys = array.array('q', keys[order].astype(np.int64)
+                                                  .tobytes())
+            self.cell_rows = array.array('i', rows[order].astype(np.intc)
+                                                  .tobytes())
+            self.cell_starts = array.array('i', starts.astype(np.intc)
+                                                    .tobytes())
+            
+        key = y * (self.x_boundary + 1) + x
+        bucket = key & self.cell_mask
+        occupants = []
+        
+        for k in range(self.cell_starts[bucket], 
+                       self.cell_starts[bucket + 1]):
+            if self.cell_keys[k] == key:
+                i = self.cell_rows[k]
+                
+                if self.alive[i]:
+                    occupants.append(i)
+                    
+        return occupants
+    
+    
+    def live_rows(self):
+        '''
+        Array of the rows of the live Agents (a copy, in no particular 
+        order)
+        '''
+        return self.live[:self.live_count].copy()
+    
+    
+    def kill(self, i):
+        '''
+        Mark Agent i as dead and take it off the live rows
+        '''
+        if self.alive[i]:
+            # Fill the gap with the last live row
+            last = self.live[self.live_count - 1]
+            self.live[self.slot[i]] = last
+            self.slot[last] = self.slot[i]
+            self.live_count -= 1
+            self.alive[i] = False
+            
+            if self.grid is not None:
+                self.grid.remove(i)
+            
+            
+    def revive(self, i):
+        '''
+        Mark Agent i as alive and put it back on the live rows
+        '''
+        if not self.alive[i]:
+            self.cell_keys = None
+            self.live[self.live_count] = i
+            self.slot[i] = self.live_count
+            self.live_count += 1
+            self.alive[i] = True
+            
+            if self.grid is not None:
+                self.grid.update(i)
+    
+    
+    def rebuild_indexes(self):
+        '''
+        Drop the Agents by cell (rebuilt when next needed) and refresh the
+        grid or neighbour list from the row arrays
+        '''
+        self.cell_keys = None
+        
+        if self.grid is not None:
+            self.grid.refresh()
+            
+            
+    def wrapped(self, dy, dx):
+        '''
+        Shortest y and x offsets round the toroidal raster
+        '''
+        height = self.y_boundary + 1
+        width = self.x_boundary + 1
+        dy = np.abs(dy) % height
+        dx = np.abs(dx) % width
+        
+        return np.minimum(dy, height - dy), np.minimum(dx, width - dx)
+    
+    
+    def pairs_within(self, rows, reach):
+        '''
+        Every ordered pair (first, second) of different rows (of rows) 
+        within reach of each other round the toroidal raster, as two 
+        arrays of rows (see the pairs_within function).
+        
+        Inputs:
+            - rows: Rows to pair up
+            - reach: Largest distance between the rows of a pair
+        '''
+        rows = np.asarray(rows, dtype=np.intp)
+        first, second = pairs_within(self.y[rows], self.x[rows], 
+                                     self.y_boundary + 1, 
+                                     self.x_boundary + 1, reach)
+        
+        return rows[first], rows[second]
+    
+    
+    def plan_moves(self, rows, draws=None):
+        '''
+        New (y, x) arrays of the given rows after one diagonal move each, 
+        with the toroidal wrap applied as array arithmetic.  Nothing is 
+        moved.
+        
+        Inputs:
+            - rows: Rows to move
+            - draws: Array of uniform [0, 1) draws, one (y, x) pair per row
+                     (drawn here in one call if not supplied)
+        '''
+        rows = np.asarray(rows, dtype=np.intp)
+        
+        if draws is None:
+            draws = self.rng.random((len(rows), 2))
+            
+        # Up / right if the draw is < 0.5, otherwise down / left
+        steps = np.where(np.asarray(draws) < 0.5, 1, -1)
+        new_y = (self.y[rows] + steps[:, 0]) % (self.y_boundary + 1)
+        new_x = (self.x[rows] + steps[:, 1]) % (self.x_boundary + 1)
+        
+        return new_y, new_x
+    
+    
+    def move_all(self, rows=None, draws=None):
+        '''
+        Move every live Agent of rows (default all live rows) in one batch.
+        
+        Inputs:
+            - rows: Rows to move (dead rows are left where they are)
+            - draws: As plan_moves
+        '''
+        if rows is None:
+            rows = np.sort(self.live_rows())
+            
+        rows = np.asarray(rows, dtype=np.intp)
+        
+        if draws is None:
+            draws = self.rng.random((len(rows), 2))
+            
+        live = self.alive[rows]
+        rows = rows[live]
+        new_y, new_x = self.plan_moves(rows, np.asarray(draws)[live])
+        
+        self.y[rows] = new_y
+        self.x[rows] = new_x
+        self.moves[rows] += 1
+        self.rebuild_indexes()
+        
+        
+    def move_one(self, i, draws=None):
+        '''
+        Move Agent i North-East, South-East, South-West or North-West 
+        
+        Inputs:
+            - i: Row of the moving Agent
+            - draws: Pair of uniform [0, 1) draws deciding the y and x 
+                     directions (drawn here if not supplied)
+        '''
+        if draws is None:
+            draws = self.rng.random(2)
+            
+        y = int(self.y[i])
+        x = int(self.x[i])
+        
+        if draws[0] < 0.5:
+            y = (y + 1) % (self.y_boundary + 1)
+        else:
+            y = (y - 1) % (self.y_boundary + 1)
+
+        if draws[1] < 0.5:
+            x = (x + 1) % (self.x_boundary + 1)
+        else:
+            x = (x - 1) % (self.x_boundary + 1)
+
+        self.set_position(i, y, x)
+        self.moves[i] += 1
+        
+        
+    def eat_one(self, i):
+        '''
+        Agent i nibbles at the Environment raster
+        '''
+        data = self.cells
+        cell = (int(self.y[i]), int(self.x[i]))
+        store = float(self.store[i])
+        value = float(data[cell])
+        
+        # Allow Agent to eat a maximum of 10 units or whatever is left
+        if value >= 10:
+            store += 10
+            value -= 10
+
+        elif value > 0:
+            store += value
+            value = 0
+
+        # Put back to the environment if Agent has eaten too much
+        if store > 100:
+            value += store
+            store = 0
+
+        data[cell] = value
+        self.store[i] = store
+
+
+    def eat_all(self, order=None):
+        '''
+        Every live Agent nibbles at the Environment raster, in one batch.
+        
+        Gives the same result as eat_one for each Agent in order: Agents
+        sharing a cell eat (and put back) in turn, handled as rounds where
+        round k takes the k-th Agent on every occupied cell at once (see 
+        eat_cells).  At 100000 Agents this is about 20-25x faster than 
+        eat_one for each (25-40x at 10000; modelbench.py agent_eat_all),
+        short of the 50x once sought: sorting the Agents by cell and the
+        array passes of each round are most of what is left.
+        
+        Used by the synchronous schedule (the parallel strips call 
+        eat_cells directly).  The random and fixed schedules eat Agent by
+        Agent (eat_one), as the sharing between turns changes the stores 
+        each one puts back.
+        
+        Inputs:
+            - order: Rows in the order Agents eat (default row order)
+        '''
+        if order is None:
+            rows = np.flatnonzero(self.alive[:self.size])
+        else:
+            order = np.asarray(order, dtype=np.intp)
+            rows = order[self.alive[order]]
+            
+        if len(rows) == 0:
+            return
+        
+        if order is None and len(rows) == self.size:
+            # Every row, in row order - read them as slices
+            rows = slice(0, self.size)
+            
+        cells = self.y[rows] * self.environment.shape[1] + self.x[rows]
+        self.store[rows] = eat_cells(self.environment, cells, 
+                                     self.store[rows])
+        
+
+    def share_one(self, i, neighbourhood, order, rank=None):
+        '''
+        Average out the store of Agent i with each live neighbour in turn.
+        
+        Inputs:
+            - i: Row of the sharing Agent
+            - neighbourhood: Distance considered to be a neighbour
+            - order: Rows in the order neighbours are visited
+            - rank: Position of each row in order (-1 if absent); only
+                    used with a SpatialGrid or NeighbourList, built from 
+                    order if not given
+        '''
+        if self.grid is None:
+            others = order[self.alive[order] & (order != i)]
+        else:
+            if rank is None:
+                rank = self.rank_of(order)
+                
+            # Only rows in nearby buckets (or listed) can be neighbours
+            others = self.grid.candidates(i)
+            others = others[(rank[others] >= 0) & self.alive[others] & 
+                            (others != i)]
+            
+        dy = self.y[others] - self.y[i]
+        dx = self.x[others] - self.x[i]
+        
+        # Compare squared distances - exact for integer coordinates
+        near = others[dy * dy + dx * dx <= neighbourhood * neighbourhood]
+        
+        if self.grid is not None:
+            # Visit neighbours in the same order as the brute-force search
+            near = near[np.argsort(rank[near], kind='stable')]
+        
+        store = float(self.store[i])
+        
+        for j in near.tolist():
+            store = (store + self.store[j]) / 2
+            self.store[j] = store
+            
+        self.store[i] = store
+
+
+    def share_all(self, neighbourhood, rows=None):
+        '''
+        Every live Agent of rows (default all) shares at once: each store
+        becomes the mean of its own and its live neighbours' stores as 
+        they were before any sharing.
+        
+        Inputs:
+            - neighbourhood: Distance considered to be a neighbour
+            - rows: Rows sharing (dead rows are left as they are)
+        '''
+        if rows is None:
+            rows = self.live_rows()
+            
+        rows = np.asarray(rows, dtype=np.intp)
+        rows = rows[self.alive[rows]]
+        first, second = self.pairs_within(rows, neighbourhood)
+        
+        # Straight line neighbours only (as share_one)
+        dy = self.y[second] - self.y[first]
+        dx = self.x[second] - self.x[first]
+        near = dy * dy + dx * dx <= neighbourhood * neighbourhood
+        first = first[near]
+        second = second[near]
+        
+        totals = np.bincount(first, weights=self.store[second], 
+                             minlength=self.size)
+        counts = np.bincount(first, minlength=self.size)
+        self.store[rows] = (self.store[rows] + totals[rows]) / \
+                           (1 + counts[rows])
+            
+
+    def order_of_agents(self):
+        '''
+        Rows of the agents list in list order and the position of each row
+        in it (-1 for rows not listed), built once until Agents are added 
+        or reorder_agents is called
+        '''
+        if self.agent_order is None or \
+                len(self.agent_order) != len(self.agents):
+            self.agent_order = np.array(
+                [agent.index for agent in self.agents], dtype=np.intp)
+            self.agent_rank = self.rank_of(self.agent_order)
+            
+        return self.agent_order, self.agent_rank
+    
+    
+    def reorder_agents(self):
+        '''
+        Forget the order of the agents list (call after shuffling, sorting 
+        or otherwise rearranging the list in place)
+        '''
+        self.agent_order = None
+        self.agent_rank = None
+
+
+    def rank_of(self, order):
+        '''
+        Position of each row in order (-1 for rows not in order)
+        '''
+        rank = np.full(self.size, -1, dtype=np.intp)
+        rank[order] = np.arange(len(order))
+        
+        return rank
+
+
+    def step(self, order, neighbourhood, share=True, timer=None):
+        '''
+        Run one iteration (move, eat, share) over every live Agent.
+        
+        Inputs:
+            - order: Rows in the order Agents are processed this iteration
+                     (e.g. a permutation of live_rows; dead rows are 
+                     skipped)
+            - neighbourhood: Distance considered to be a neighbour
+            - share: Interact with neighbours (False if only 1 Agent)
+            - timer: modelprofile.PhaseTimer to add the move, eat and share
+                     times to (if it is timing this iteration)
+        '''
+        order = np.asarray(order, dtype=np.intp)
+        rank = self.rank_of(order) if self.grid is not None else None
+        
+        if isinstance(self.grid, NeighbourList):
+            # Rebuild at most once an iteration, up front: every Agent 
+            # moves one step at most before the check after the iteration
+            self.grid.refresh(STEP_DISTANCE)
+        
+        # Every move for the iteration in one batch.  Each Agent takes 
+        # up its new position in its turn, so Agents later in the order 
+        # are still where they were when earlier ones share.
+        new_y, new_x = self.plan_moves(order)
+        
+        if self.kernel is not None:
+            # The whole iteration in compiled code, timed as one phase
+            with modelprofile.phase(timer, 'step'):
+                self.kernel(order, new_y, new_x, self.y, self.x, self.store,
+                            self.moves, self.alive, 
+                            np.asarray(self.environment.data), 
+                            neighbourhood, share)
+                self.rebuild_indexes()
+                
+            return
+        
+        new_y = new_y.tolist()
+        new_x = new_x.tolist()
+        
+        if timer is None or not timer.active:
+            for k, i in enumerate(order.tolist()):
+                if self.alive[i]:
+                    self.set_position(i, new_y[k], new_x[k])
+                    self.moves[i] += 1
+                    self.eat_one(i)
+                    
+                    if share:
+                        self.share_one(i, neighbourhood, order, rank)
+                        
+            if isinstance(self.grid, NeighbourList):
+                # Check later moves one by one again
+                self.grid.refresh()
+                
+            return
+        
+        # Same processing, timing each phase
+        clock = time.perf_counter
+        move_time = eat_time = share_time = 0.0
+        count = 0
+        start = clock()
+        
+        for k, i in enumerate(order.tolist()):
+            if self.alive[i]:
+                t0 = clock()
+                self.set_position(i, new_y[k], new_x[k])
+                self.moves[i] += 1
+                t1 = clock()
+                self.eat_one(i)
+                t2 = clock()
+                
+                if share:
+                    self.share_one(i, neighbourhood, order, rank)
+                    
+                share_time += clock() - t2
+                eat_time += t2 - t1
+                move_time += t1 - t0
+                count += 1
+                
+        # Phases are interleaved per Agent - each is added as one span
+        timer.add('move', start, move_time, count)
+        timer.add('eat', start + move_time, eat_time, count)
+        
+        if share:
+            timer.add('share', start + move_time + eat_time, share_time, 
+                      count)
+            
+        if isinstance(self.grid, NeighbourList):
+            self.grid.refresh()
+            
+            
+    def step_synchronous(self, neighbourhood, share=True, timer=None):
+        '''
+        Run one synchronous iteration over every live Agent, each phase in
+        one batch: all move, then all eat (Agents sharing a cell eat in 
+        row order), then all share (share_all).
+        
+        Inputs:
+            - neighbourhood: Distance considered to be a neighbour
+            - share: Interact with neighbours (False if only 1 Agent)
+            - timer: modelprofile.PhaseTimer to time the move, eat and 
+                     share phases with (None for no timing)
+        '''
+        rows = np.sort(self.live_rows())
+        
+        with modelprofile.phase(timer, 'move'):
+            self.move_all(rows)
+            
+        with modelprofile.phase(timer, 'eat'):
+            self.eat_all(rows)
+            
+        if share:
+            with modelprofile.phase(timer, 'share'):
+                self.share_all(neighbourhood, rows)
+
 
 #----------------------------------------------------------
 # Agent Class
@@ -16,47 +960,41 @@ import random
 class Agent():
     '''
     Processing of an instance of an Agent.
+    
+    An Agent is a view onto one row of an AgentPopulation (which holds the
+    environment and boundaries for every Agent).
     '''
-    def __init__(self, environment, agents, start_y=None, start_x=None):
+    __slots__ = ('population', 'index')
+    
+    def __init__(self, environment, agents, start_y=None, start_x=None,
+                 population=None):
         '''
         Initialisation of the Agent instance with:
-            - x and y boundary variables
-            - plotting colour
-            - Store variable
-            - Agent number (sequential)
+            - Population row (x, y, store, moves and alive data), whose 
+              index + 1 is the Agent number
         
         Inputs:
-            - environment: Raster data
+            - environment: Environment raster
             - agents: All agents created (ranges from 1 to n)
             - start_y: Default starting y coordinate (may not be supplied)
             - start_x: Default starting x coordinate (may not be supplied)
+            - population: AgentPopulation to add the Agent to (defaults to
+                          the population of the agents already created)
         '''
         #--------------------------------------------------
         # Initialise variables
         #--------------------------------------------------
-        self.environment = environment
-        self.agents = agents
-        self.y_boundary = len(self.environment) - 1
-        self.x_boundary = len(self.environment[0]) - 1
-        self.colour = '#' + hex(random.randint(0x000000,0xffffff))[2:].zfill(6)
-        self.store = 0
-        self.moves = 0
-        self.alive = 'Y'
-        self.agent_num = len(agents) + 1
-
-        #--------------------------------------------------
-        # Boundaries are now known.
-        # Randomise starting position of Agent.
-        #--------------------------------------------------
-        if start_y is None:
-            self.y = random.randint(0, self.y_boundary)
-        else:
-            self.y = start_y
-            
-        if start_x is None:
-            self.x = random.randint(0, self.x_boundary)
-        else:
-            self.x = start_x
+        if population is None:
+            if len(agents) > 0:
+                population = agents[0].population
+            else:
+                population = AgentPopulation(environment)
+                
+        self.population = population
+        self.index = population.add(start_y, start_x)
+        
+        if population.agents is None:
+            population.agents = agents
             
            
     def __str__(self):
@@ -68,43 +1006,21 @@ class Agent():
                ', y=' + str(self.y).zfill(3) + \
                ', moves=' + str(self.moves) + \
                ', store=' + str(self.store) + \
-               ', alive=' + self.alive + '.'
+               ', alive=' + ('Y' if self.alive else 'N') + '.'
 
 
     def move(self):
         '''
         Move the Agent North-East, South-East, South-West or North-West 
         '''
-        if random.random() < 0.5:
-            self.y = (self.y + 1) % (self.y_boundary + 1)
-        else:
-            self.y = (self.y - 1) % (self.y_boundary + 1)
-
-        if random.random() < 0.5:
-            self.x = (self.x + 1) % (self.x_boundary + 1)
-        else:
-            self.x = (self.x - 1) % (self.x_boundary + 1)
-
-        self.moves += 1
+        self.population.move_one(self.index)
         
         
     def eat(self): 
         '''
         Nibble at the Environment raster
         '''
-        # Allow Agernt to eat a maximum of 10 units or whatever is left
-        if self.environment[self.y][self.x] >= 10:
-            self.store += 10
-            self.environment[self.y][self.x] -= 10
-
-        elif self.environment[self.y][self.x] > 0:
-            self.store += self.environment[self.y][self.x]
-            self.environment[self.y][self.x] = 0
-
-        # Put back to the environment if Agent has eaten too much
-        if self.store > 100:
-            self.environment[self.y][self.x] += self.store
-            self.store = 0
+        self.population.eat_one(self.index)
 
 
     def distance_between(self, agent):
@@ -117,75 +1033,128 @@ class Agent():
     def share_with_neighbours(self, neighbourhood): 
         '''
         Average out the store between two neighbours
+        
+        Neighbours are visited in the order of the agents list (held by 
+        the population - see AgentPopulation.reorder_agents if the list is
+        rearranged).
         '''
-        for agent in self.agents:
-
-            if agent == self or agent.alive == 'N':
-                # Do not compare with itself or with a dead agent
-                pass 
-            else: 
-                distance = self.distance_between(agent)
-            
-                if distance <= neighbourhood:
-                    average = (self.store + agent.store) / 2
-                    self.store = average
-                    agent.store = average
-                    self.store + agent.store
+        order, rank = self.population.order_of_agents()
+        self.population.share_one(self.index, neighbourhood, order, rank)
         
 
     #-------------------------------------
     # Get & Set methods
     #-------------------------------------
+    @property
+    def agents(self):
+        '''Get all agents created'''
+        return self.population.agents
+            
+    @property
+    def agent_num(self):
+        '''Get the Agent number (sequential, from 1)'''
+        return self.index + 1
+            
+    @property
+    def environment(self):
+        '''Get the Environment raster'''
+        return self.population.environment
+            
     @property
     def y(self):
         '''Get the y coordinate'''
-        return self._y
+        return int(self.population.y[self.index])
             
     @y.setter
     def y(self,val):
         '''Set the y coordinate'''
-        self._y = val
+        self.population.set_position(self.index, val, self.x)
             
     @property
     def x(self):
         '''Get the x coordinate'''
-        return self._x
+        return int(self.population.x[self.index])
             
     @x.setter
     def x(self,val):
         '''Set the x coordinate'''
-        self._x = val
+        self.population.set_position(self.index, self.y, val)
             
     @property
     def y_boundary(self):
         '''Get the y axis boundary'''
-        return self._y_boundary
-            
-    @y_boundary.setter
-    def y_boundary(self,val):
-        '''Set the y axis boundary'''
-        self._y_boundary = val
+        return self.population.y_boundary
             
     @property
     def x_boundary(self):
         '''Get the x axis boundary'''
-        return self._x_boundary
-            
-    @x_boundary.setter
-    def x_boundary(self,val):
-        '''Set the x axis boundary'''
-        self._x_boundary = val
+        return self.population.x_boundary
             
     @property
     def store(self):
         '''Get the Agent store value'''
-        return self._store
+        return float(self.population.store[self.index])
             
     @store.setter
     def store(self,val):
         '''Set the Agent store value'''
-        self._store = val
+        self.population.store[self.index] = val
             
+    @property
+    def moves(self):
+        '''Get the Agent move count'''
+        return int(self.population.moves[self.index])
+            
+    @moves.setter
+    def moves(self,val):
+        '''Set the Agent move count'''
+        self.population.moves[self.index] = val
+            
+    @property
+    def alive(self):
+        '''Get the Agent alive flag (True/False)'''
+        return bool(self.population.alive[self.index])
+            
+    @alive.setter
+    def alive(self,val):
+        '''Set the Agent alive flag (True/False)'''
+        if val:
+            self.population.revive(self.index)
+        else:
+            self.population.kill(self.index)
+            
+    @property
+    def colour(self):
+        '''Get the Agent plotting colour'''
+        return PALETTE[self.population.colour_index[self.index]]
+            
+        
+#----------------------------------------------------------
+# World Class
+#----------------------------------------------------------
+class World():
+    '''
+    Environment, boundaries and random number generator shared by the
+    Wolves of a pack (held once rather than by every Wolf).
+    '''
+    __slots__ = ('environment', 'y_boundary', 'x_boundary', 'rng')
+    
+    def __init__(self, environment, rng=None):
+        '''
+        Initialisation of the World instance with:
+            - Environment raster and its x and y boundaries
+            - Random number generator
+        
+        Inputs:
+            - environment: Environment raster
+            - rng: numpy.random.Generator (defaults to a freshly seeded 
+                   one)
+        '''
+        self.environment = environment
+        self.y_boundary = environment.y_boundary
+        self.x_boundary = environment.x_boundary
+        self.rng = np.random.default_rng() if rng is None else rng
+        
         
 #----------------------------------------------------------
 # Wolf Class
@@ -194,27 +1163,45 @@ class Wolf():
     '''
     Processing of an instance of an Wolf.
     '''
-    def __init__(self, environment, wolf_pack, start_y=None, start_x=None):
+    __slots__ = ('world', 'wolf_pack', 'colour_index', 'kills', 'wolf_num', 
+                 'y', 'x')
+    
+    def __init__(self, environment, wolf_pack, start_y=None, start_x=None,
+                 rng=None):
         '''
         Initialisation of the Wolf instance with:
-            - x and y boundary variables
+            - World (shared with the pack if on the same environment)
             - plotting colour
             - Store variable
         
         Inputs:
-            - environment: Raster data
+            - environment: Environment raster
             - wolf_pack: All wolves created (ranges from 1 to n)
             - start_y: Default starting y coordinate (may not be supplied)
             - start_x: Default starting x coordinate (may not be supplied)
+            - rng: numpy.random.Generator for the Wolf's draws (defaults to 
+                   the generator of the wolves already created)
         '''
         #--------------------------------------------------
         # Initialise variables
         #--------------------------------------------------
-        self.environment = environment
+        if not isinstance(environment, Environment):
+            raise ValueError('Wolves need an Environment raster, shared '
+                             'by the pack (wrap the raster rows in '
+                             'Environment once).')
+            
+        if len(wolf_pack) > 0 and \
+                wolf_pack[0].environment is environment and \
+                (rng is None or rng is wolf_pack[0].rng):
+            self.world = wolf_pack[0].world
+        elif rng is None and len(wolf_pack) > 0:
+            self.world = World(environment, wolf_pack[0].rng)
+        else:
+            self.world = World(environment, rng)
+                
         self.wolf_pack = wolf_pack
-        self.y_boundary = len(self.environment) - 1
-        self.x_boundary = len(self.environment[0]) - 1
-        self.colour = '#' + hex(random.randint(0x000000,0xffffff))[2:].zfill(6)
+        self.colour_index = palette_index(
+            self.rng.integers(0x000000, 0xffffff, endpoint=True))
         self.kills = 0
         self.wolf_num = len(wolf_pack) + 1
 
@@ -224,7 +1211,8 @@ class Wolf():
         #--------------------------------------------------
         if start_y is None:
             if self.wolf_num == 1:
-                self.y = random.randint(0, self.y_boundary)
+                self.y = int(self.rng.integers(0, self.y_boundary, 
+                                               endpoint=True))
             else:
                 self.y = wolf_pack[0].y
         else:
@@ -232,7 +1220,8 @@ class Wolf():
             
         if start_x is None:
             if self.wolf_num == 1:
-                self.x = random.randint(0, self.x_boundary)
+                self.x = int(self.rng.integers(0, self.x_boundary, 
+                                               endpoint=True))
             else:
                 self.x = wolf_pack[0].x
         else:
@@ -249,11 +1238,16 @@ class Wolf():
                ', kills=' + str(self.kills) 
 
 
-    def move(self):
+    def move(self, where_to=None):
         '''
         Move the Wolf North, East, South or West 
+        
+        Inputs:
+            - where_to: Uniform [0, 1) draw deciding the direction (drawn 
+                        here if not supplied)
         '''
-        where_to = random.random() 
+        if where_to is None:
+            where_to = self.rng.random() 
         
         if where_to < 0.25:   # Go North
             self.y = (self.y + 3) % (self.y_boundary + 1)
@@ -268,67 +1262,237 @@ class Wolf():
     def hunt(self, agents): 
         '''
         Kill the Agent if there first and Agent still alive
+        
+        Live Agents on the Wolf's cell are looked up in the Agents by cell
+        of the population the agents belong to.
         '''
-        for agent in agents:
-                
-            if (agent.alive == 'Y') \
-                and (self.y == agent.y) and (self.x == agent.x): 
-                self.kills += 1
-                
-                agent.alive = 'N'
-                
-                print('Kill -', self) 
+        if len(agents) == 0:
+            return
+        
+        population = agents[0].population
+        
+        for i in population.occupants(self.y, self.x):
+            self.kills += 1
+            
+            population.kill(i)
+            
+            print('Kill -', self) 
             
         
     #-------------------------------------
-    # Get & Set methods
+    # Get methods (shared World)
     #-------------------------------------
     @property
-    def y(self):
-        '''Get the y coordinate'''
-        return self._y
-            
-    @y.setter
-    def y(self,val):
-        '''Set the y coordinate'''
-        self._y = val
+    def environment(self):
+        '''Get the Environment raster'''
+        return self.world.environment
             
     @property
-    def x(self):
-        '''Get the x coordinate'''
-        return self._x
-            
-    @x.setter
-    def x(self,val):
-        '''Set the x coordinate'''
-        self._x = val
+    def rng(self):
+        '''Get the random number generator'''
+        return self.world.rng
             
     @property
     def y_boundary(self):
         '''Get the y axis boundary'''
-        return self._y_boundary
-            
-    @y_boundary.setter
-    def y_boundary(self,val):
-        '''Set the y axis boundary'''
-        self._y_boundary = val
+        return self.world.y_boundary
             
     @property
     def x_boundary(self):
         '''Get the x axis boundary'''
-        return self._x_boundary
-            
-    @x_boundary.setter
-    def x_boundary(self,val):
-        '''Set the x axis boundary'''
-        self._x_boundary = val
+        return self.world.x_boundary
             
     @property
-    def kills(self):
-        '''Get the Wolf kill value'''
-        return self._kill
-            
-    @kills.setter
-    def kills(self,val):
-        '''Set the Wolf kill value'''
-        self._kill = val
+    def colour(self):
+        '''Get the Wolf plotting colour'''
+        return PALETTE[self.colour_index]
+
+
+#----------------------------------------------------------
+# Functions
+#----------------------------------------------------------
+def palette_index(value):
+    '''
+    Index into PALETTE of the colour nearest a 24 bit RGB value (the top 
+    3 bits of red and green and 2 bits of blue).
+    '''
+    value = int(value)
+    
+    return ((value >> 21) << 5) | (((value >> 13) & 7) << 2) | \
+           ((value >> 6) & 3)
+
+
+def move_wolves(wolf_pack, where_to=None):
+    '''
+    Move every Wolf of the pack 3 raster cells North, East, South or West
+    in one batch (same rule as Wolf.move).
+    
+    Inputs:
+        - wolf_pack: Wolves to move
+        - where_to: Array of uniform [0, 1) draws, one per Wolf (drawn 
+                    in one call from the pack's generator if not supplied)
+    '''
+    if len(wolf_pack) == 0:
+        return
+    
+    if where_to is None:
+        where_to = wolf_pack[0].rng.random(len(wolf_pack))
+        
+    # 0 = North, 1 = East, 2 = South, 3 = West (4 x draw is exact)
+    direction = (np.asarray(where_to) * 4).astype(np.intp)
+    y = np.fromiter((wolf.y for wolf in wolf_pack), dtype=np.int64, 
+                    count=len(wolf_pack))
+    x = np.fromiter((wolf.x for wolf in wolf_pack), dtype=np.int64, 
+                    count=len(wolf_pack))
+    
+    y = (y + np.array([3, 0, -3, 0])[direction]) % \
+        (wolf_pack[0].y_boundary + 1)
+    x = (x + np.array([0, 3, 0, -3])[direction]) % \
+        (wolf_pack[0].x_boundary + 1)
+    
+    for wolf, wolf_y, wolf_x in zip(wolf_pack, y.tolist(), x.tolist()):
+        wolf.y = wolf_y
+        wolf.x = wolf_x
+
+
+def pairs_within(y, x, height, width, reach):
+    '''
+    Every ordered pair (first, second) of different positions within 
+    reach of each other round a toroidal raster, as two arrays of 
+    positions (indices into y and x).  Found through a wrapped bucket grid
+    in array operations.
+    
+    Inputs:
+        - y, x: Coordinate arrays
+        - height, width: Raster rows and columns
+        - reach: Largest distance between the positions of a pair
+    '''
+    y = np.asarray(y)
+    x = np.asarray(x)
+    
+    # Buckets at least reach wide (the last one takes the remainder)
+    size = max(1, int(math.ceil(reach)))
+    rows_of_buckets = max(1, height // size)
+    cols_of_buckets = max(1, width // size)
+    by = np.minimum(y // size, rows_of_buckets - 1)
+    bx = np.minimum(x // size, cols_of_buckets - 1)
+    bucket = by * cols_of_buckets + bx
+    
+    # Positions sorted by bucket, with the start and count of each bucket
+    sort = np.argsort(bucket, kind='stable')
+    count = np.bincount(bucket, minlength=rows_of_buckets * 
+                                          cols_of_buckets)
+    start = np.cumsum(count) - count
+    
+    # Pair every position with those of its own and the 8 buckets around
+    # it (wrapping round; fewer if there are under 3 a side), keeping 
+    # the pairs within reach of each block of pairs as it is made
+    offsets = set((dy % rows_of_buckets, dx % cols_of_buckets)
+                  for dy in (-1, 0, 1) for dx in (-1, 0, 1))
+    positions = np.arange(len(y))
+    sorted_y = y[sort]
+    sorted_x = x[sort]
+    firsts = []
+    seconds = []
+    
+    for dy, dx in offsets:
+        other = ((by + dy) % rows_of_buckets) * cols_of_buckets + \
+                (bx + dx) % cols_of_buckets
+        pairs = count[other]
+        ends = np.cumsum(pairs)
+        first = np.repeat(positions, pairs)
+        
+        # Place in sort of the second position of each pair
+        at = np.arange(len(first)) + np.repeat(start[other] - ends + pairs,
+                                               pairs)
+        
+        # Shortest offsets round the raster
+        offset_y = np.abs(sorted_y[at] - y[first]) % height
+        offset_x = np.abs(sorted_x[at] - x[first]) % width
+        np.minimum(offset_y, height - offset_y, out=offset_y)
+        np.minimum(offset_x, width - offset_x, out=offset_x)
+        offset_y *= offset_y
+        offset_x *= offset_x
+        offset_y += offset_x
+        near = offset_y <= reach * reach
+        first = first[near]
+        second = sort[at[near]]
+        apart = first != second
+        firsts.append(first[apart])
+        seconds.append(second[apart])
+        
+    return np.concatenate(firsts), np.concatenate(seconds)
+
+
+def eat_cells(environment, cells, stores):
+    '''
+    Agents with stores nibble at flat cells (y * columns + x) of an 
+    Environment in turn, by the rules of AgentPopulation.eat_one, and
+    return their new stores.
+    
+    Agents sharing a cell eat (and put back) in the order given, handled
+    as rounds where round k takes the k-th Agent on every occupied cell 
+    at once: Environment.graze takes their bites and Environment.put_back
+    returns the stores that go over 100.  The Agents are grouped by cell 
+    once, up front, so each round only steps on to the next Agent of the
+    cells that have one.
+    
+    Inputs:
+        - environment: Environment (or TiledEnvironment) eaten from
+        - cells: Flat cell of each Agent
+        - stores: Store of each Agent
+    '''
+    cells = np.asarray(cells, dtype=np.int64)
+    n = len(cells)
+    
+    if n == 0:
+        return np.array(stores, dtype=np.float64)
+    
+    # Agents in cell order, in the order given within each cell: each 
+    # position is packed below its cell in one key, so a plain sort of 
+    # the keys keeps the order without a (much slower) stable argsort
+    bits = max(1, (n - 1).bit_length())
+    mask = (1 << bits) - 1
+    
+    if int(cells.max()) < 1 << (62 - bits):
+        sorted_cells = cells << bits
+        sorted_cells |= np.arange(n)
+        sorted_cells.sort()
+        order = sorted_cells & mask
+        sorted_cells >>= bits
+    else:
+        order = np.argsort(cells, kind='stable')
+        sorted_cells = cells[order]
+    
+    stores = np.array(stores, dtype=np.float64)
+    
+    # First Agent on each cell (positions in the sorted order)
+    first = np.empty(n, dtype=bool)
+    first[0] = True
+    np.not_equal(sorted_cells[1:], sorted_cells[:-1], out=first[1:])
+    turn = np.flatnonzero(first)
+    
+    # Second Agent on each cell that has one
+    second = np.flatnonzero(first[:-1] & ~first[1:]) + 1
+    
+    while len(turn) > 0:
+        i = order[turn]
+        cell = sorted_cells[turn]
+        
+        # Allow Agent to eat a maximum of 10 units or whatever is left
+        store = stores[i] + environment.graze(cell, 10)
+        
+        # Put back to the environment if Agent has eaten too much
+        over = np.flatnonzero(store > 100)
+        environment.put_back(cell[over], store[over])
+        store[over] = 0
+        stores[i] = store
+        
+        # Next Agent on each cell that has one
+        if second is not None:
+            turn, second = second, None
+        else:
+            turn = turn[turn < n - 1] + 1
+            turn = turn[~first[turn]]
+            
+    return stores
@@ -0,0 +1,1081 @@
+'''
+Filename: environment.py
+
+Contains:
+- Classes: Environment, TiledEnvironment
+- Methods (Environment): take, put, graze, put_back, copy, 
+                         Get<var name> (multiple).
+- Methods (TiledEnvironment): as Environment, plus sync, close and 
+                              tile_stats.
+- Functions: graze_cells, raster_chunks, parse_raster_chunk, 
+             read_text_raster, 
+             write_binary_raster, read_binary_raster, convert_text_raster, 
+             cache_is_current, load_raster, save_raster.
+
+Large text rasters are parsed in parallel: the file is split into byte 
+ranges on line boundaries, each parsed by a worker process straight into 
+one shared, preallocated array.
+
+Rasters larger than memory can be held as a TiledEnvironment: square tiles
+of the binary raster are read on demand into a least recently used cache 
+held under a memory budget, and changed tiles are written back to the file.
+
+Binary raster format (.rbin):
+    A 128 byte header followed by the cells as one raw C-order array, so
+    the cells can be mapped straight into memory with numpy.memmap.
+    Header fields (little-endian): magic 'RBIN', format version, dtype
+    string, rows, columns and the size, mtime and SHA-256 hash of the text
+    raster it was converted from (zero if none).
+
+Can be run from the command line to convert a text raster:
+    python environment.py in.txt [in.txt.rbin] [--workers n]
+'''
+import io
+import os
+import sys
+import csv
+import shutil
+import struct
+import weakref
+import tempfile
+import collections
+import hashlib
+import argparse
+import warnings
+import concurrent.futures
+import numpy as np
+from multiprocessing import shared_memory
+
+
+#----------------------------------------------------------
+# Binary raster format
+#----------------------------------------------------------
+RASTER_MAGIC = b'RBIN'
+RASTER_VERSION = 1
+RASTER_HEADER = struct.Struct('<4sHxx8sQQQQ32s')
+RASTER_HEADER_SIZE = 128
+RASTER_SUFFIX = '.rbin'
+
+# Text rasters smaller than this are parsed in the calling process
+PARALLEL_MIN_BYTES = 8 << 20
+
+# Default tile side (cells) and tile cache budget (bytes) of a 
+# TiledEnvironment
+TILE_SIZE = 256
+TILE_BUDGET = 256 << 20
+
+
+#----------------------------------------------------------
+# Environment Class
+#----------------------------------------------------------
+class Environment():
+    '''
+    Raster the Agents graze on, held as a 2-D NumPy array of one dtype.
+
+    Cells are read with environment[y][x] or environment[y, x] as before.
+    Bulk grazing and putting back work on whole arrays of cells at once.
+    '''
+    def __init__(self, data, dtype=np.float64, copy=True):
+        '''
+        Initialisation of the Environment instance with:
+            - Raster array
+
+        Inputs:
+            - data: Raster data (list of rows or 2-D array)
+            - dtype: Cell data type (float64 keeps put back stores exact)
+            - copy: Copy the data (False uses an array of the right dtype,
+                    e.g. a memory-mapped raster, in place)
+        '''
+        if copy:
+            self.data = np.array(data, dtype=dtype)
+        else:
+            self.data = np.asarray(data, dtype=dtype)
+
+        if self.data.ndim != 2 or self.data.size == 0:
+            raise ValueError('Environment raster must be a non-empty '
+                             '2-D grid of cells.')
+
+
+    def __len__(self):
+        '''
+        Number of rows in the raster
+        '''
+        return self.shape[0]
+
+
+    def __getitem__(self, key):
+        '''
+        Row or cell access onto the raster array
+        '''
+        return self.data[key]
+
+
+    def __setitem__(self, key, val):
+        '''
+        Row or cell assignment into the raster array
+        '''
+        self.data[key] = val
+
+
+    def take(self, cells):
+        '''
+        Values of cells given as flat cell numbers (y * columns + x)
+        '''
+        return self.data.reshape(-1)[cells]
+
+
+    def put(self, cells, values):
+        '''
+        Set cells given as flat cell numbers (y * columns + x)
+        '''
+        self.data.reshape(-1)[cells] = values
+
+
+    def graze(self, cells, bite=10):
+        '''
+        Take up to bite units from cells given as flat cell numbers and 
+        return the amounts.
+
+        Where several entries share a cell they eat in the order given,
+        each taking up to bite units of whatever is left, as they would
+        one at a time.
+
+        Inputs:
+            - cells: Flat cell numbers (y * columns + x) grazed
+            - bite: Maximum units taken per entry
+        '''
+        return graze_cells(self.data.reshape(-1), cells, bite)
+
+
+    def put_back(self, cells, amounts):
+        '''
+        Add amounts back onto cells given as flat cell numbers (repeated 
+        cells accumulate)
+        '''
+        np.add.at(self.data.reshape(-1), cells, amounts)
+        
+        
+    def copy(self):
+        '''
+        Independent copy of the Environment
+        '''
+        return Environment(self.data, self.dtype)
+
+
+    #-------------------------------------
+    # Get methods
+    #-------------------------------------
+    @property
+    def cells(self):
+        '''Get the object cells are indexed through with [y, x]'''
+        return self.data
+
+    @property
+    def shape(self):
+        '''Get the raster (rows, columns)'''
+        return self.data.shape
+
+    @property
+    def dtype(self):
+        '''Get the cell data type'''
+        return self.data.dtype
+
+    @property
+    def y_boundary(self):
+        '''Get the y axis boundary'''
+        return self.shape[0] - 1
+
+    @property
+    def x_boundary(self):
+        '''Get the x axis boundary'''
+        return self.shape[1] - 1
+
+    @property
+    def bounds(self):
+        '''Get the (y, x) axis boundaries'''
+        return (self.y_boundary, self.x_boundary)
+
+
+#----------------------------------------------------------
+# TiledEnvironment Class
+#----------------------------------------------------------
+class TiledEnvironment(Environment):
+    '''
+    Raster held in a binary raster file (see below) and brought into 
+    memory one tile at a time, for rasters larger than memory.
+
+    Square tiles are read on demand from the memory mapped file into a 
+    least recently used cache of at most budget bytes.  Changed (dirty) 
+    tiles are written back to the file when they are evicted and on sync.
+
+    Cells are read and written with environment[y][x] or environment[y, x]
+    as for an Environment.  Rows and other slices are read only copies 
+    taken from the file; data is the memory mapped file itself (the cache 
+    is written back and emptied first).
+    '''
+    def __init__(self, path, tile=TILE_SIZE, budget=TILE_BUDGET, mode='r+',
+                 temporary=False):
+        '''
+        Initialisation of the TiledEnvironment instance with:
+            - Memory mapped binary raster
+            - Empty tile cache and counters
+
+        Inputs:
+            - path: Binary raster file
+            - tile: Tile side (cells)
+            - budget: Most bytes of tiles held in memory (at least one 
+                      tile is always held)
+            - mode: 'r+' writes changed tiles back to the file, 'r' is 
+                    read only
+            - temporary: Delete the file when the instance is closed or 
+                         no longer used
+        '''
+        if tile < 1:
+            raise ValueError('Tile size must be 1 or more cells.')
+
+        self.path = path
+        self.mapped = read_binary_raster(path, mode)
+        self.tile = tile
+        self.budget = budget
+        self.capacity = max(1, budget // (tile * tile * 
+                                          self.mapped.dtype.itemsize))
+        self.tile_cols = -(-self.mapped.shape[1] // tile)
+
+        if self.mapped.ndim != 2 or self.mapped.size == 0:
+            raise ValueError('Environment raster must be a non-empty '
+                             '2-D grid of cells.')
+
+        # Cached tiles: (tile row, tile column) -> [cells, dirty], least
+        # recently used first
+        self.tiles = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writes = 0
+
+        if temporary:
+            self.remover = weakref.finalize(self, remove_file, path)
+        else:
+            self.remover = None
+
+
+    def __getitem__(self, key):
+        '''
+        Cell access through the tile cache, or a read only copy of rows
+        or slices from the file
+        '''
+        cell = self.cell_of(key)
+
+        if cell is not None:
+            cells, y, x = self.locate(cell, False)
+            return cells[y, x]
+
+        self.sync()
+        rows = np.array(self.mapped[key])
+        rows.flags.writeable = False
+
+        return rows
+
+
+    def __setitem__(self, key, val):
+        '''
+        Cell assignment through the tile cache (rows and slices are 
+        written to the file)
+        '''
+        cell = self.cell_of(key)
+
+        if cell is not None:
+            cells, y, x = self.locate(cell, True)
+            cells[y, x] = val
+            return
+
+        self.check_writable()
+        self.sync()
+        self.mapped[key] = val
+
+        # Cached tiles may no longer match the file
+        self.tiles.clear()
+
+
+    def cell_of(self, key):
+        '''
+        (y, x) of a single cell key, None for any other key
+        '''
+        if type(key) is not tuple or len(key) != 2:
+            return None
+
+        y, x = key
+
+        if not isinstance(y, (int, np.integer)) or \
+                not isinstance(x, (int, np.integer)):
+            return None
+
+        rows, cols = self.mapped.shape
+
+        if y < 0:
+            y += rows
+
+        if x < 0:
+            x += cols
+
+        if not (0 <= y < rows and 0 <= x < cols):
+            raise IndexError('Cell ' + str(key) + ' is outside the raster.')
+
+        return int(y), int(x)
+
+
+    def locate(self, cell, dirty):
+        '''
+        (tile cells, y, x) of a cell (y, x) within its cached tile, 
+        marking the tile dirty if it is to be changed
+        '''
+        y, x = cell
+
+        if dirty:
+            self.check_writable()
+
+        entry = self.load(y // self.tile, x // self.tile)
+
+        if dirty:
+            entry[1] = True
+
+        return entry[0], y % self.tile, x % self.tile
+
+
+    def load(self, tile_y, tile_x):
+        '''
+        Cache entry [cells, dirty] of a tile, read from the file (evicting
+        the least recently used tile if the cache is full) if not cached
+        '''
+        key = (tile_y, tile_x)
+        entry = self.tiles.get(key)
+
+        if entry is not None:
+            self.hits += 1
+            self.tiles.move_to_end(key)
+            return entry
+
+        self.misses += 1
+
+        if len(self.tiles) >= self.capacity:
+            old_key, old_entry = self.tiles.popitem(last=False)
+            self.evictions += 1
+
+            if old_entry[1]:
+                self.write_back(old_key, old_entry[0])
+
+        entry = [np.array(self.mapped[self.region(tile_y, tile_x)]), False]
+        self.tiles[key] = entry
+
+        return entry
+
+
+    def check_writable(self):
+        '''
+        Raise ValueError if the file is open read only
+        '''
+        if self.mapped.mode == 'r':
+            raise ValueError(self.path + ' is open read only - copy the ' +
+                             'TiledEnvironment to change cells.')
+
+
+    def region(self, tile_y, tile_x):
+        '''
+        Slices of the raster covered by a tile
+        '''
+        return (slice(tile_y * self.tile, (tile_y + 1) * self.tile),
+                slice(tile_x * self.tile, (tile_x + 1) * self.tile))
+
+
+    def write_back(self, key, cells):
+        '''
+        Write the cells of a tile back to the file
+        '''
+        self.mapped[self.region(*key)] = cells
+        self.writes += 1
+
+
+    def groups(self, cells):
+        '''
+        Split flat cell numbers by tile, yielding (tile row, tile column,
+        positions in cells, y and x within the tile) in tile order; 
+        positions keep their order within each tile.
+        '''
+        cells = np.asarray(cells, dtype=np.intp).reshape(-1)
+        
+        if len(cells) == 0:
+            return
+        
+        ys, xs = np.divmod(cells, self.mapped.shape[1])
+        keys = (ys // self.tile) * self.tile_cols + xs // self.tile
+        sort = np.argsort(keys, kind='stable')
+        sorted_keys = keys[sort]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != 
+                                      sorted_keys[:-1]])
+
+        for start, end in zip(starts.tolist(), 
+                              np.r_[starts[1:], len(sort)].tolist()):
+            index = sort[start:end]
+            tile_y, tile_x = divmod(int(sorted_keys[start]), self.tile_cols)
+
+            yield tile_y, tile_x, index, ys[index] % self.tile, \
+                xs[index] % self.tile
+
+
+    def take(self, cells):
+        '''
+        Values of cells given as flat cell numbers (y * columns + x)
+        '''
+        values = np.empty(len(cells), dtype=self.mapped.dtype)
+
+        for tile_y, tile_x, index, ys, xs in self.groups(cells):
+            values[index] = self.load(tile_y, tile_x)[0][ys, xs]
+
+        return values
+
+
+    def put(self, cells, values):
+        '''
+        Set cells given as flat cell numbers (y * columns + x)
+        '''
+        self.check_writable()
+        values = np.broadcast_to(values, (len(cells),))
+
+        for tile_y, tile_x, index, ys, xs in self.groups(cells):
+            entry = self.load(tile_y, tile_x)
+            entry[0][ys, xs] = values[index]
+            entry[1] = True
+
+
+    def graze(self, cells, bite=10):
+        '''
+        Take up to bite units from cells given as flat cell numbers and 
+        return the amounts (see Environment.graze), one tile at a time.
+        '''
+        self.check_writable()
+        eaten = np.empty(len(cells), dtype=self.mapped.dtype)
+
+        for tile_y, tile_x, index, ys, xs in self.groups(cells):
+            entry = self.load(tile_y, tile_x)
+            eaten[index] = graze_cells(entry[0].reshape(-1), 
+                                       ys * entry[0].shape[1] + xs, bite)
+            entry[1] = True
+
+        return eaten
+
+
+    def put_back(self, cells, amounts):
+        '''
+        Add amounts back onto cells given as flat cell numbers (repeated 
+        cells accumulate)
+        '''
+        self.check_writable()
+        amounts = np.broadcast_to(amounts, (len(cells),))
+
+        for tile_y, tile_x, index, ys, xs in self.groups(cells):
+            entry = self.load(tile_y, tile_x)
+            np.add.at(entry[0], (ys, xs), amounts[index])
+            entry[1] = True
+
+
+    def sync(self):
+        '''
+        Write every dirty tile back to the file (they stay cached)
+        '''
+        for key, entry in self.tiles.items():
+            if entry[1]:
+                self.write_back(key, entry[0])
+                entry[1] = False
+
+        if self.mapped.mode != 'r':
+            self.mapped.flush()
+
+
+    def copy(self, path=None):
+        '''
+        Independent TiledEnvironment on a copy of the file, with the same
+        tile size and budget.
+
+        Inputs:
+            - path: File for the copy (default a temporary file next to 
+                    this one, deleted once the copy is no longer used)
+        '''
+        self.sync()
+        temporary = path is None
+
+        if temporary:
+            try:
+                handle, path = tempfile.mkstemp(
+                    suffix=RASTER_SUFFIX, 
+                    dir=os.path.dirname(os.path.abspath(self.path)))
+            except OSError:
+                # Read only location - use the temporary directory
+                handle, path = tempfile.mkstemp(suffix=RASTER_SUFFIX)
+
+            os.close(handle)
+
+        shutil.copyfile(self.path, path)
+
+        return TiledEnvironment(path, self.tile, self.budget, 'r+', 
+                                temporary)
+
+
+    def close(self):
+        '''
+        Write back the dirty tiles and release the file (deleting it if
+        temporary)
+        '''
+        if self.mapped is None:
+            return
+
+        self.sync()
+        self.tiles.clear()
+        self.mapped = None
+
+        if self.remover is not None:
+            self.remover()
+
+
+    def tile_stats(self):
+        '''
+        Tile cache counters (dictionary): hits, misses, evictions and
+        writes back, with the tiles cached and the most that may be
+        '''
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'writes': self.writes,
+                'cached': len(self.tiles),
+                'capacity': self.capacity}
+
+
+    #-------------------------------------
+    # Get methods
+    #-------------------------------------
+    @property
+    def data(self):
+        '''Get the memory mapped raster (the cache is written back and 
+        emptied first)'''
+        self.sync()
+        self.tiles.clear()
+        return self.mapped
+
+    @property
+    def cells(self):
+        '''Get the object cells are indexed through with [y, x]'''
+        return self
+
+    @property
+    def shape(self):
+        '''Get the raster (rows, columns)'''
+        return self.mapped.shape
+
+    @property
+    def dtype(self):
+        '''Get the cell data type'''
+        return self.mapped.dtype
+
+
+#----------------------------------------------------------
+# Cell functions
+#----------------------------------------------------------
+def graze_cells(data, cells, bite=10):
+    '''
+    Take up to bite units from each of cells (indices into a 1-D array, 
+    such as a raster viewed flat) and return the amounts (see 
+    Environment.graze).
+    
+    The k-th entry on a cell (counting from 0) finds what is left after 
+    the earlier ones, value - k * bite, which is exact for the whole
+    numbers subtracted; each cell is then written once.  Cells given once
+    each in increasing order (as by each round of 
+    agentframework.eat_cells) skip the grouping.
+    '''
+    cells = np.asarray(cells, dtype=np.intp)
+    n = len(cells)
+    
+    if n < 2 or (cells[1:] > cells[:-1]).all():
+        # Every cell once - take up to a bite from each (nothing from 
+        # empty or not a number cells)
+        value = data[cells]
+        eaten = np.minimum(value, bite)
+        np.fmax(eaten, 0, out=eaten)
+        data[cells] = value - eaten
+        
+        return eaten
+    
+    sort = np.argsort(cells, kind='stable')
+    sorted_cells = cells[sort]
+    
+    # Number of earlier entries on the same cell
+    starts = np.flatnonzero(np.r_[True, sorted_cells[1:] != 
+                                  sorted_cells[:-1]])
+    counts = np.diff(np.append(starts, n))
+    earlier = np.empty(n, dtype=np.intp)
+    earlier[sort] = np.arange(n) - np.repeat(starts, counts)
+    
+    value = data[sorted_cells[starts]]
+    eaten = np.minimum(data[cells] - earlier * bite, bite)
+    np.fmax(eaten, 0, out=eaten)
+    
+    # Every entry on a cell of value > 0 eats until it is empty
+    left = np.maximum(value - counts * bite, 0)
+    data[sorted_cells[starts]] = np.where(value > 0, left, value)
+    
+    return eaten
+
+
+#----------------------------------------------------------
+# Raster file reading and writing
+#----------------------------------------------------------
+def raster_chunks(path, chunks):
+    '''
+    Split a file into about chunks byte ranges (start, end), each 
+    starting at the start of a line.
+    '''
+    size = os.path.getsize(path)
+    bounds = [0]
+    
+    with open(path, 'rb') as f:
+        for k in range(1, chunks):
+            # Carry on to the start of the next line
+            f.seek(max(size * k // chunks, bounds[-1]))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+            
+    bounds.append(size)
+    
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:])
+            if end > start]
+
+
+def count_lines(raw):
+    '''
+    Number of lines (rows) in a block of a text raster
+    '''
+    return raw.count(b'\n') + (1 if raw and not raw.endswith(b'\n') else 0)
+
+
+def parse_rows(raw, cols):
+    '''
+    Parse a block of whole lines of a text raster into a list of rows of 
+    integers, as the csv module reads it (numbers unquoted, cells 
+    converted to int).
+    
+    Returns (rows, None), or (None, (error, line)) for the first bad row,
+    where error is 'cells' or 'value' and line counts from 1 in the block.
+    '''
+    text = raw.decode()
+    reader = csv.reader(io.StringIO(text, newline=''), 
+                        quoting=csv.QUOTE_NONNUMERIC)
+    rows = []
+    
+    try:
+        for row in reader:
+            # Test if the number of cells is the same as the first row
+            if len(row) != cols:
+                raise IndexError
+                
+            # Convert each element from float to integer
+            rows.append(list(map(lambda row_elem: int(row_elem), row)))
+            
+    except IndexError:
+        return None, ('cells', reader.line_num)
+        
+    except ValueError:
+        return None, ('value', reader.line_num)
+    
+    return rows, None
+
+
+def parse_rows_fast(raw, cols):
+    '''
+    Parse a block of whole lines of plain comma separated numbers with 
+    numpy's compiled reader, giving the same cells as parse_rows.
+    
+    Returns a 2-D int64 array, or None if the block needs parse_rows 
+    (quotes, uneven or blank rows, non numerical or out of range cells).
+    '''
+    if b'"' in raw or cols == 0:
+        return None
+    
+    try:
+        # Blocks of blank lines warn of no data (and fail the shape test)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            cells = np.loadtxt(io.BytesIO(raw), dtype=np.float64, 
+                               delimiter=',', comments=None, ndmin=2)
+    except ValueError:
+        return None
+    
+    # Blank lines are skipped by loadtxt, so the shape must match too
+    if cells.shape != (count_lines(raw), cols) or \
+            not np.all(np.isfinite(cells)) or \
+            np.any(np.abs(cells) >= 2.0**63):
+        return None
+    
+    # Truncate towards zero as int() does
+    return cells.astype(np.int64)
+
+
+def parse_raster_chunk(path, start, end, first_row, cols, memory, shape, 
+                       dtype):
+    '''
+    Parse the byte range [start, end) of a text raster into rows 
+    first_row onwards of a shared array.
+    
+    Inputs:
+        - path: Text raster file
+        - start, end: Byte range (whole lines)
+        - first_row: Row of the shared array the range starts at
+        - cols: Number of cells in every row
+        - memory: Name of the shared memory block holding the array
+        - shape, dtype: Shape and data type of the shared array
+        
+    Returns None, or (error, line) for the first bad row (see parse_rows).
+    '''
+    with open(path, 'rb') as f:
+        f.seek(start)
+        raw = f.read(end - start)
+        
+    rows = parse_rows_fast(raw, cols)
+    
+    if rows is None:
+        rows, error = parse_rows(raw, cols)
+        
+        if error is not None:
+            return error
+        
+    block = shared_memory.SharedMemory(name=memory)
+    
+    try:
+        out = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        
+        if len(rows) > 0:
+            out[first_row:first_row + len(rows)] = rows
+            
+        del out
+    finally:
+        block.close()
+        
+    return None
+
+
+def raster_error(error, row):
+    '''
+    ValueError for a bad row of a text raster (row counts from 1)
+    '''
+    if error == 'cells':
+        return ValueError('Inconsistent number of cells encountered in ' +
+                          'row #' + str(row) + ' of input raster file.')
+    
+    return ValueError('Non numerical cell value encountered in row #' + 
+                      str(row) + ' of input raster file.')
+
+
+def read_text_raster(path, dtype=np.float64, workers=None):
+    '''
+    Read and validate a comma separated text raster (e.g. in.txt).
+    
+    Files of PARALLEL_MIN_BYTES or more are split into byte ranges parsed
+    by a pool of worker processes into one preallocated array.
+    
+    Raises ValueError naming the row of the first inconsistent or non
+    numerical row.
+    
+    Inputs:
+        - path: Text raster file
+        - dtype: Cell data type
+        - workers: Number of worker processes (default all cores for 
+                   large files, 1 parses in this process)
+    '''
+    size = os.path.getsize(path)
+    
+    if size == 0:
+        return np.array([], dtype=dtype)
+    
+    if workers is None:
+        workers = os.cpu_count() if size >= PARALLEL_MIN_BYTES else 1
+    
+    # Number of cells in every row, from the first row
+    with open(path, newline='') as f:
+        cols = len(next(csv.reader(f), []))
+        
+    chunks = raster_chunks(path, max(1, workers) * 4)
+    
+    # Rows in each range and so the row each starts at
+    counts = []
+    
+    with open(path, 'rb') as f:
+        for start, end in chunks:
+            f.seek(start)
+            counts.append(count_lines(f.read(end - start)))
+            
+    first_rows = np.r_[0, np.cumsum(counts)].tolist()
+    shape = (first_rows[-1], cols)
+    block = shared_memory.SharedMemory(create=True, 
+                                       size=max(1, int(np.prod(shape)) * 
+                                                np.dtype(dtype).itemsize))
+    
+    try:
+        jobs = [(path, start, end, first_row, cols, block.name, shape, 
+                 dtype) 
+                for (start, end), first_row in zip(chunks, first_rows)]
+        
+        if workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+                errors = list(pool.map(parse_raster_chunk, *zip(*jobs)))
+        else:
+            errors = [parse_raster_chunk(*job) for job in jobs]
+            
+        # The first bad row of the first range with one
+        for error, first_row in zip(errors, first_rows):
+            if error is not None:
+                raise raster_error(error[0], first_row + error[1])
+            
+        out = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        data = out.copy()
+        del out
+        
+    finally:
+        block.close()
+        block.unlink()
+        
+    return data
+
+
+def file_hash(path):
+    '''
+    SHA-256 digest of a file, read in 1MB blocks
+    '''
+    digest = hashlib.sha256()
+    
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+            
+    return digest.digest()
+
+
+def read_raster_header(path):
+    '''
+    Read the header of a binary raster as a dictionary
+    '''
+    with open(path, 'rb') as f:
+        header = f.read(RASTER_HEADER_SIZE)
+        
+    if len(header) < RASTER_HEADER_SIZE:
+        raise ValueError(path + ' is not a binary raster file.')
+    
+    magic, version, dtype, rows, cols, size, mtime, digest = \
+        RASTER_HEADER.unpack_from(header)
+        
+    if magic != RASTER_MAGIC or version != RASTER_VERSION:
+        raise ValueError(path + ' is not a binary raster file.')
+    
+    dtype = np.dtype(dtype.rstrip(b'\0').decode('ascii'))
+    
+    # A file cut short (e.g. by an interrupted copy) cannot be mapped
+    if os.path.getsize(path) != RASTER_HEADER_SIZE + \
+            rows * cols * dtype.itemsize:
+        raise ValueError(path + ' does not hold the ' + str(rows) + ' x ' +
+                         str(cols) + ' cells given in its header.')
+    
+    return {'dtype': dtype,
+            'shape': (rows, cols),
+            'source_size': size,
+            'source_mtime': mtime,
+            'source_hash': digest}
+
+
+def write_binary_raster(path, data, source=None):
+    '''
+    Write a 2-D array as a binary raster.
+    
+    Inputs:
+        - path: Binary raster file to write (replaced atomically)
+        - data: 2-D array of cells
+        - source: Text raster the data was read from (recorded in the
+                  header so the binary copy can be used as a cache)
+    '''
+    data = np.ascontiguousarray(data)
+    
+    if source is None:
+        size, mtime, digest = 0, 0, bytes(32)
+    else:
+        stat = os.stat(source)
+        size, mtime, digest = stat.st_size, stat.st_mtime_ns, \
+                              file_hash(source)
+    
+    header = RASTER_HEADER.pack(RASTER_MAGIC, RASTER_VERSION, 
+                                data.dtype.str.encode('ascii'),
+                                data.shape[0], data.shape[1], 
+                                size, mtime, digest)
+    
+    temp_path = path + '.tmp'
+    
+    with open(temp_path, 'wb') as f:
+        f.write(header.ljust(RASTER_HEADER_SIZE, b'\0'))
+        data.tofile(f)
+        
+    os.replace(temp_path, path)
+
+
+def read_binary_raster(path, mode='c'):
+    '''
+    Map a binary raster into memory.
+    
+    Inputs:
+        - path: Binary raster file
+        - mode: numpy.memmap mode ('c' copy-on-write leaves the file 
+                untouched, 'r' read only, 'r+' writes through to the file)
+    '''
+    header = read_raster_header(path)
+    
+    return np.memmap(path, dtype=header['dtype'], mode=mode, 
+                     offset=RASTER_HEADER_SIZE, shape=header['shape'])
+
+
+def convert_text_raster(text_path, binary_path=None, dtype=np.float64,
+                        workers=None):
+    '''
+    Convert a text raster to a binary raster and return the binary path
+    (workers as read_text_raster)
+    '''
+    if binary_path is None:
+        binary_path = text_path + RASTER_SUFFIX
+        
+    data = read_text_raster(text_path, dtype, workers)
+    write_binary_raster(binary_path, data, source=text_path)
+    
+    return binary_path
+
+
+def cache_is_current(text_path, binary_path):
+    '''
+    Test if a binary raster is an up to date copy of a text raster.
+    
+    The sizes must match; the hash is only compared if the modification 
+    times differ.  A binary raster of the wrong length for its header 
+    (truncated) is never current.
+    '''
+    try:
+        header = read_raster_header(binary_path)
+        stat = os.stat(text_path)
+    except (OSError, ValueError):
+        return False
+    
+    if header['source_size'] != stat.st_size:
+        return False
+    
+    if header['source_mtime'] == stat.st_mtime_ns:
+        return True
+    
+    return header['source_hash'] == file_hash(text_path)
+
+
+def load_raster(path, cache=True, dtype=np.float64, workers=None, tile=0,
+                budget=TILE_BUDGET):
+    '''
+    Load a raster file into an Environment.
+    
+    Binary rasters are memory mapped (copy-on-write).  Text rasters are 
+    parsed, unless cache is set and an up to date binary copy exists next 
+    to the text file; a new copy is written after parsing.
+    
+    With a tile size the raster is opened read only as a TiledEnvironment
+    on the binary raster (the binary copy of a text raster is made or 
+    brought up to date whatever cache is set to); copy it to change cells.
+    
+    Inputs:
+        - path: Text or binary (.rbin) raster file
+        - cache: Use and maintain the binary copy of a text raster
+        - dtype: Cell data type
+        - workers: Text raster parsing processes (see read_text_raster)
+        - tile: Tile side in cells (0 holds the whole raster in memory)
+        - budget: Most bytes of tiles held in memory
+    '''
+    if tile > 0:
+        return load_tiled_raster(path, dtype, workers, tile, budget)
+    
+    if path.endswith(RASTER_SUFFIX):
+        return Environment(read_binary_raster(path), dtype, copy=False)
+    
+    binary_path = path + RASTER_SUFFIX
+    
+    if cache and cache_is_current(path, binary_path):
+        data = read_binary_raster(binary_path)
+        
+        if data.dtype == dtype:
+            return Environment(data, dtype, copy=False)
+        
+    data = read_text_raster(path, dtype, workers)
+    
+    if cache:
+        try:
+            write_binary_raster(binary_path, data, source=path)
+        except OSError:
+            # Read only location - carry on without a cache
+            pass
+    
+    return Environment(data, dtype, copy=False)
+
+
+def load_tiled_raster(path, dtype, workers, tile, budget):
+    '''
+    Open a raster file read only as a TiledEnvironment (see load_raster)
+    '''
+    if path.endswith(RASTER_SUFFIX):
+        binary_path = path
+    else:
+        binary_path = path + RASTER_SUFFIX
+        
+        if not cache_is_current(path, binary_path) or \
+                read_raster_header(binary_path)['dtype'] != dtype:
+            convert_text_raster(path, binary_path, dtype, workers)
+            
+    if read_raster_header(binary_path)['dtype'] != dtype:
+        raise ValueError(binary_path + ' must hold ' + np.dtype(dtype).name + 
+                         ' cells to be tiled.')
+        
+    return TiledEnvironment(binary_path, tile, budget, mode='r')
+
+
+def remove_file(path):
+    '''
+    Delete a file if it is still there
+    '''
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def save_raster(environment, path):
+    '''
+    Write an Environment out as a binary raster
+    '''
+    write_binary_raster(path, environment.data)
+
+
+#----------------------------------------------------------
+# Command line conversion
+#----------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert a text raster to a binary (.rbin) raster.')
+    parser.add_argument('text_path', help='Text raster file (e.g. in.txt)')
+    parser.add_argument('binary_path', nargs='?', default=None,
+                        help='Binary raster file (default <text_path>' + 
+                             RASTER_SUFFIX + ')')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Parsing processes (default all cores for ' +
+                             'large files)')
+    args = parser.parse_args()
+    
+    try:
+        print('Written', convert_text_raster(args.text_path, 
+                                             args.binary_path,
+                                             workers=args.workers))
+    except ValueError as err:
+        sys.exit(str(err))
@@ -0,0 +1,613 @@
+'''
+Agent model micro-benchmarks
+
+Filename: modelbench.py
+
+Called by:
+    - Command line
+
+Times each hot method of agentframework.py in isolation on synthetic
+rasters (no input files or network needed):
+    - agent_move - Agent.move
+    - agent_move_all - AgentPopulation.move_all (every Agent, one call)
+    - agent_eat - Agent.eat
+    - agent_eat_all - AgentPopulation.eat_all (every Agent, one call; 
+                      sought to be 50x the agent_eat calls it replaces 
+                      at 100000 Agents, it is about 20-25x there and 
+                      25-40x at 10000)
+    - agent_share - Agent.share_with_neighbours (brute-force search)
+    - agent_share_grid - Agent.share_with_neighbours (spatial grid index)
+    - agent_share_list - Agent.share_with_neighbours (neighbour list)
+    - wolf_move - Wolf.move
+    - wolf_move_all - move_wolves (every Wolf, one call)
+    - wolf_hunt - Wolf.hunt
+    - population_step - AgentPopulation.step (one whole iteration, with
+                        the spatial grid index)
+    - population_run - AgentPopulation.step (per iteration of a run of 
+                       several, in random orders, with the spatial grid
+                       index)
+    - population_run_list - As population_run, with the neighbour list
+                            (its rebuilds included)
+
+With --memory, measures the memory held per Agent and per Wolf instead
+(Python allocations traced while the Agents and Wolves are created), 
+before (BaselineAgent and BaselineWolf, laid out as the original one 
+object per Agent and Wolf) and after (the AgentPopulation rows, Agent 
+views and Wolves of agentframework.py).
+
+Input:
+    - Optional arguments:
+        - sizes - Numbers of Agents (comma separated)
+        - rasters - Raster sizes (square, comma separated)
+        - radii - Neighbourhood distances (sharing and step benchmarks)
+        - only - Benchmarks to run (comma separated, default all)
+        - calls - Calls timed per repeat (sampled over the Agents)
+        - repeats - Repeats per case (the fastest is kept)
+        - out - Results file (JSON)
+        - baseline - Stored results file (JSON) to compare against
+        - threshold - Slowdown (fraction) reported as a regression
+        - memory - Measure bytes per Agent and Wolf instead of timing
+
+Output:
+    - Results file (JSON) of seconds per call for every case
+    - Speed-up of each batched benchmark over its per-Agent one
+    - Comparison with the baseline (exit status 1 if any case regressed)
+'''
+import sys
+import json
+import random
+import time
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+import agentframework
+from environment import Environment
+
+# Neighbour list skin in the benchmarks (the least allowed is 3; at 3 to
+# 5 it is rebuilt every iteration)
+LIST_SKIN = 6
+
+
+#----------------------------------------------------------
+# Synthetic model set up
+#----------------------------------------------------------
+def make_world(num_of_agents, raster_size, num_in_wolf_pack=10, seed=0):
+    '''
+    Create a synthetic raster with Agents and Wolves spread over it.
+
+    Returns (environment, agents, wolf_pack).
+    '''
+    rng = np.random.default_rng(seed)
+    environment = Environment(rng.integers(0, 500,
+                                           (raster_size, raster_size)))
+    population = agentframework.AgentPopulation(environment, num_of_agents,
+                                                rng=rng)
+    agents = []
+
+    for i in range(num_of_agents):
+        agents.append(agentframework.Agent(environment, agents,
+                                           population=population))
+
+    wolf_pack = []
+
+    for i in range(num_in_wolf_pack):
+        wolf_pack.append(agentframework.Wolf(environment, wolf_pack,
+                                             int(rng.integers(raster_size)),
+                                             int(rng.integers(raster_size)),
+                                             rng=rng))
+
+    return environment, agents, wolf_pack
+
+
+def time_calls(calls, repeats):
+    '''
+    Best time of repeats runs of a list of calls, per call.
+    '''
+    best = float('inf')
+
+    for repeat in range(repeats):
+        start = time.perf_counter()
+
+        for call in calls:
+            call()
+
+        best = min(best, time.perf_counter() - start)
+
+    return best / len(calls)
+
+
+def time_run(population, radius, repeats, iterations=10, seed=0):
+    '''
+    Best time of repeats runs of several iterations, each in a random 
+    order, per iteration.
+    '''
+    rng = np.random.default_rng(seed)
+    orders = [rng.permutation(len(population)) for k in range(iterations)]
+
+    return time_calls([lambda order=order: population.step(order, radius)
+                       for order in orders], repeats)
+
+
+def sample(items, calls):
+    '''
+    calls items, cycling through the list.
+    '''
+    return [items[k % len(items)] for k in range(calls)]
+
+
+#----------------------------------------------------------
+# Benchmarks
+# - Each returns seconds per call of its method
+#----------------------------------------------------------
+def bench_agent_move(agents, wolf_pack, radius, calls, repeats):
+    '''Agent.move'''
+    return time_calls([agent.move for agent in sample(agents, calls)],
+                      repeats)
+
+
+def bench_agent_move_all(agents, wolf_pack, radius, calls, repeats):
+    '''AgentPopulation.move_all (one call per repeat)'''
+    return time_calls([agents[0].population.move_all], repeats)
+
+
+def bench_agent_eat(agents, wolf_pack, radius, calls, repeats):
+    '''Agent.eat'''
+    return time_calls([agent.eat for agent in sample(agents, calls)],
+                      repeats)
+
+
+def bench_agent_eat_all(agents, wolf_pack, radius, calls, repeats):
+    '''AgentPopulation.eat_all (one call per repeat)'''
+    return time_calls([agents[0].population.eat_all], repeats)
+
+
+def bench_agent_share(agents, wolf_pack, radius, calls, repeats):
+    '''Agent.share_with_neighbours'''
+    return time_calls([lambda agent=agent:
+                       agent.share_with_neighbours(radius)
+                       for agent in sample(agents, calls)], repeats)
+
+
+def bench_agent_share_grid(agents, wolf_pack, radius, calls, repeats):
+    '''Agent.share_with_neighbours with a SpatialGrid'''
+    agents[0].population.use_grid(radius)
+
+    return bench_agent_share(agents, wolf_pack, radius, calls, repeats)
+
+
+def bench_agent_share_list(agents, wolf_pack, radius, calls, repeats):
+    '''Agent.share_with_neighbours with a NeighbourList'''
+    agents[0].population.use_neighbour_list(radius, LIST_SKIN)
+
+    return bench_agent_share(agents, wolf_pack, radius, calls, repeats)
+
+
+def bench_wolf_move(agents, wolf_pack, radius, calls, repeats):
+    '''Wolf.move'''
+    return time_calls([wolf.move for wolf in sample(wolf_pack, calls)],
+                      repeats)
+
+
+def bench_wolf_move_all(agents, wolf_pack, radius, calls, repeats):
+    '''move_wolves (one call per repeat)'''
+    return time_calls([lambda: agentframework.move_wolves(wolf_pack)],
+                      repeats)
+
+
+def bench_wolf_hunt(agents, wolf_pack, radius, calls, repeats):
+    '''Wolf.hunt'''
+    # Kills are printed - send them nowhere while timing
+    stdout = sys.stdout
+    sys.stdout = None
+
+    try:
+        return time_calls([lambda wolf=wolf: wolf.hunt(agents)
+                           for wolf in sample(wolf_pack, calls)], repeats)
+    finally:
+        sys.stdout = stdout
+
+
+def bench_population_step(agents, wolf_pack, radius, calls, repeats):
+    '''AgentPopulation.step (one call per repeat)'''
+    population = agents[0].population
+    population.use_grid(radius)
+    order = np.arange(len(population))
+
+    return time_calls([lambda: population.step(order, radius)], repeats)
+
+
+def bench_population_run(agents, wolf_pack, radius, calls, repeats):
+    '''AgentPopulation.step (a run of iterations per repeat)'''
+    agents[0].population.use_grid(radius)
+
+    return time_run(agents[0].population, radius, repeats)
+
+
+def bench_population_run_list(agents, wolf_pack, radius, calls, repeats):
+    '''AgentPopulation.step with a NeighbourList'''
+    agents[0].population.use_neighbour_list(radius, LIST_SKIN)
+
+    return time_run(agents[0].population, radius, repeats)
+
+
+benchmarks = {'agent_move': bench_agent_move,
+              'agent_move_all': bench_agent_move_all,
+              'agent_eat': bench_agent_eat,
+              'agent_eat_all': bench_agent_eat_all,
+              'agent_share': bench_agent_share,
+              'agent_share_grid': bench_agent_share_grid,
+              'agent_share_list': bench_agent_share_list,
+              'wolf_move': bench_wolf_move,
+              'wolf_move_all': bench_wolf_move_all,
+              'wolf_hunt': bench_wolf_hunt,
+              'population_step': bench_population_step,
+              'population_run': bench_population_run,
+              'population_run_list': bench_population_run_list}
+
+# Benchmarks whose cost depends on the neighbourhood distance
+radius_benchmarks = ['agent_share', 'agent_share_grid', 'agent_share_list',
+                     'population_step', 'population_run',
+                     'population_run_list']
+
+# Benchmarks of one call over every Agent, with the per-Agent benchmark
+# they replace
+batched_benchmarks = {'agent_move_all': 'agent_move',
+                      'agent_eat_all': 'agent_eat'}
+
+
+#----------------------------------------------------------
+# Running and comparing
+#----------------------------------------------------------
+def case_key(case):
+    '''
+    Identify a case by its benchmark and parameters.
+    '''
+    return (case['name'], case['agents'], case['raster'], case['radius'])
+
+
+def run_benchmarks(names, sizes, rasters, radii, calls=1000, repeats=3):
+    '''
+    Run every benchmark over every case and return the results.
+    '''
+    results = []
+
+    for raster_size in rasters:
+        for num_of_agents in sizes:
+            for name in names:
+                for radius in (radii if name in radius_benchmarks
+                               else [None]):
+                    # A fresh world per case so earlier cases (eating,
+                    # killing) do not change later ones
+                    environment, agents, wolf_pack = \
+                        make_world(num_of_agents, raster_size)
+
+                    per_call = benchmarks[name](agents, wolf_pack, radius,
+                                                calls, repeats)
+                    results.append({'name': name,
+                                    'agents': num_of_agents,
+                                    'raster': raster_size,
+                                    'radius': radius,
+                                    'per_call': per_call})
+
+                    print(name.ljust(16),
+                          'agents=' + str(num_of_agents).ljust(7),
+                          'raster=' + str(raster_size).ljust(5),
+                          'radius=' + str(radius).ljust(5),
+                          '%.3e s/call' % per_call)
+
+    return {'meta': {'python': platform.python_version(),
+                     'numpy': np.__version__,
+                     'machine': platform.machine(),
+                     'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                     'calls': calls,
+                     'repeats': repeats},
+            'results': results}
+
+
+def speedups(results):
+    '''
+    Print how many times faster each batched benchmark is than calling
+    its per-Agent benchmark for every Agent (where both were run).
+    '''
+    per_call = {case_key(case): case['per_call']
+                for case in results['results']}
+
+    for case in results['results']:
+        if case['name'] not in batched_benchmarks:
+            continue
+
+        key = (batched_benchmarks[case['name']], case['agents'], 
+               case['raster'], case['radius'])
+
+        if key not in per_call:
+            continue
+
+        print(case['name'].ljust(16),
+              'agents=' + str(case['agents']).ljust(7),
+              'raster=' + str(case['raster']).ljust(5),
+              '%.1fx' % (per_call[key] * case['agents'] / case['per_call']),
+              key[0], 'for every Agent')
+
+
+def compare(results, baseline, threshold=0.1):
+    '''
+    Compare results with a baseline, printing the ratio of every case
+    found in both.
+
+    Returns the number of cases more than threshold (fraction) slower.
+    '''
+    base = {case_key(case): case['per_call']
+            for case in baseline['results']}
+    regressions = 0
+
+    for case in results['results']:
+        key = case_key(case)
+
+        if key not in base:
+            continue
+
+        ratio = case['per_call'] / base[key]
+
+        if ratio > 1 + threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        elif ratio < 1 - threshold:
+            flag = 'faster'
+        else:
+            flag = ''
+
+        print(case['name'].ljust(16),
+              'agents=' + str(case['agents']).ljust(7),
+              'raster=' + str(case['raster']).ljust(5),
+              'radius=' + str(case['radius']).ljust(5),
+              '%.2fx' % ratio, flag)
+
+    return regressions
+
+
+#----------------------------------------------------------
+# Memory per Agent and Wolf
+#----------------------------------------------------------
+class BaselineAgent():
+    '''
+    An Agent as it was before the AgentPopulation: one object whose 
+    __dict__ holds the environment, the agents list, its boundaries, a 
+    hex colour string, store, moves, alive flag, number and position, 
+    set in the order (and under the names) the original set them.
+    '''
+    def __init__(self, environment, agents):
+        '''
+        Initialisation of the BaselineAgent instance with the attributes
+        of the original Agent
+
+        Inputs:
+            - environment: Environment raster
+            - agents: All agents created
+        '''
+        self.environment = environment
+        self.agents = agents
+        self._y_boundary = len(environment) - 1
+        self._x_boundary = len(environment[0]) - 1
+        self.colour = '#' + hex(random.randint(0x000000, 
+                                               0xffffff))[2:].zfill(6)
+        self._store = 0
+        self.moves = 0
+        self.alive = 'Y'
+        self.agent_num = len(agents) + 1
+        self._y = random.randint(0, self._y_boundary)
+        self._x = random.randint(0, self._x_boundary)
+
+
+class BaselineWolf():
+    '''
+    A Wolf as it was before the shared World (see BaselineAgent).
+    '''
+    def __init__(self, environment, wolf_pack):
+        '''
+        Initialisation of the BaselineWolf instance with the attributes
+        of the original Wolf
+
+        Inputs:
+            - environment: Environment raster
+            - wolf_pack: All wolves created
+        '''
+        self.environment = environment
+        self.wolf_pack = wolf_pack
+        self._y_boundary = len(environment) - 1
+        self._x_boundary = len(environment[0]) - 1
+        self.colour = '#' + hex(random.randint(0x000000, 
+                                               0xffffff))[2:].zfill(6)
+        self._kill = 0
+        self.wolf_num = len(wolf_pack) + 1
+
+        # The pack starts together, on the first Wolf's cell
+        if self.wolf_num == 1:
+            self._y = random.randint(0, self._y_boundary)
+            self._x = random.randint(0, self._x_boundary)
+        else:
+            self._y = wolf_pack[0]._y
+            self._x = wolf_pack[0]._x
+
+
+def baseline_bytes_per_agent(num_of_agents, raster_size, 
+                             num_in_wolf_pack=None):
+    '''
+    Memory held per BaselineAgent and per BaselineWolf, in bytes, traced
+    while they are created on a synthetic raster.
+
+    Returns (bytes per Agent, bytes per Wolf).
+    '''
+    if num_in_wolf_pack is None:
+        num_in_wolf_pack = max(1, num_of_agents // 10)
+
+    random.seed(0)
+    rng = np.random.default_rng(0)
+    environment = Environment(rng.integers(0, 500,
+                                           (raster_size, raster_size)))
+
+    tracemalloc.start()
+    agents = []
+
+    for i in range(num_of_agents):
+        agents.append(BaselineAgent(environment, agents))
+
+    agent_bytes = tracemalloc.get_traced_memory()[0] / num_of_agents
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    wolf_pack = []
+
+    for i in range(num_in_wolf_pack):
+        wolf_pack.append(BaselineWolf(environment, wolf_pack))
+
+    wolf_bytes = tracemalloc.get_traced_memory()[0] / num_in_wolf_pack
+    tracemalloc.stop()
+
+    return agent_bytes, wolf_bytes
+
+
+def bytes_per_agent(num_of_agents, raster_size, num_in_wolf_pack=None):
+    '''
+    Memory held per Agent (row arrays, Agent views and indexes) and per
+    Wolf, in bytes, traced while they are created on a synthetic raster.
+
+    Returns (bytes per Agent, bytes per Wolf).
+    '''
+    if num_in_wolf_pack is None:
+        num_in_wolf_pack = max(1, num_of_agents // 10)
+
+    rng = np.random.default_rng(0)
+    environment = Environment(rng.integers(0, 500,
+                                           (raster_size, raster_size)))
+
+    tracemalloc.start()
+    population = agentframework.AgentPopulation(environment, num_of_agents,
+                                                rng=rng)
+    agents = []
+
+    for i in range(num_of_agents):
+        agents.append(agentframework.Agent(environment, agents,
+                                           population=population))
+
+    # Including the Agents by cell, built by the first hunt
+    population.occupants(0, 0)
+    agent_bytes = tracemalloc.get_traced_memory()[0] / num_of_agents
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    wolf_pack = []
+
+    for i in range(num_in_wolf_pack):
+        wolf_pack.append(agentframework.Wolf(environment, wolf_pack,
+                                             rng=rng))
+
+    wolf_bytes = tracemalloc.get_traced_memory()[0] / num_in_wolf_pack
+    tracemalloc.stop()
+
+    return agent_bytes, wolf_bytes
+
+
+def measure_memory(sizes, rasters):
+    '''
+    Bytes per Agent and per Wolf for every case, before (baseline) and 
+    after.
+    '''
+    results = []
+
+    for raster_size in rasters:
+        for num_of_agents in sizes:
+            baseline_agent, baseline_wolf = baseline_bytes_per_agent(
+                num_of_agents, raster_size)
+            agent_bytes, wolf_bytes = bytes_per_agent(num_of_agents,
+                                                      raster_size)
+            results.append({'agents': num_of_agents,
+                            'raster': raster_size,
+                            'baseline_agent_bytes': baseline_agent,
+                            'baseline_wolf_bytes': baseline_wolf,
+                            'agent_bytes': agent_bytes,
+                            'wolf_bytes': wolf_bytes})
+
+            print('memory'.ljust(16),
+                  'agents=' + str(num_of_agents).ljust(7),
+                  'raster=' + str(raster_size).ljust(5),
+                  'Agent %.1f -> %.1f bytes (%.1fx)' % 
+                  (baseline_agent, agent_bytes, baseline_agent / agent_bytes),
+                  'Wolf %.1f -> %.1f bytes (%.1fx)' % 
+                  (baseline_wolf, wolf_bytes, baseline_wolf / wolf_bytes))
+
+    return {'meta': {'python': platform.python_version(),
+                     'numpy': np.__version__,
+                     'date': time.strftime('%Y-%m-%d %H:%M:%S')},
+            'memory': results}
+
+
+def parse_values(text):
+    '''
+    Comma separated integers.
+    '''
+    return [int(value) for value in text.split(',')]
+
+
+#----------------------------------------------------------
+# Command line processing
+#----------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Micro-benchmarks of the agentframework methods.')
+    parser.add_argument('--sizes', type=parse_values,
+                        default=[10, 100, 1000, 10000, 100000],
+                        help='Numbers of Agents (comma separated)')
+    parser.add_argument('--rasters', type=parse_values, default=[300],
+                        help='Raster sizes, square (comma separated)')
+    parser.add_argument('--radii', type=parse_values, default=[5, 20],
+                        help='Neighbourhood distances (comma separated)')
+    parser.add_argument('--only', default=','.join(benchmarks),
+                        help='Benchmarks to run (comma separated)')
+    parser.add_argument('--calls', type=int, default=1000,
+                        help='Calls timed per repeat')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='Repeats per case (the fastest is kept)')
+    parser.add_argument('--out', default='bench_results.json',
+                        help='Results file (JSON)')
+    parser.add_argument('--baseline', default=None,
+                        help='Stored results file (JSON) to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Slowdown (fraction) reported as a regression')
+    parser.add_argument('--memory', action='store_true',
+                        help='Measure bytes per Agent and Wolf instead')
+    args = parser.parse_args()
+
+    if args.memory:
+        results = measure_memory(args.sizes, args.rasters)
+
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
+
+        print('Results written to', args.out)
+        sys.exit(0)
+
+    names = args.only.split(',')
+
+    for name in names:
+        if name not in benchmarks:
+            parser.exit(1, 'Unknown benchmark ' + name + '\n')
+
+    results = run_benchmarks(names, args.sizes, args.rasters, args.radii,
+                             args.calls, args.repeats)
+    speedups(results)
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1)
+
+    print('Results written to', args.out)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = compare(results, baseline, args.threshold)
+        print(regressions, 'regression(s) over', args.threshold * 100, '%')
+
+        if regressions > 0:
+            sys.exit(1)
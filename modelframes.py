@@ -0,0 +1,234 @@
+'''
+Filename: modelframes.py
+
+Contains:
+- Classes: FrameWriter
+- Methods (FrameWriter): snapshot, wait, close.
+- Functions: init_worker, render_frame, background, encode
+
+Frames of a run written as PNG files (frame_00000.png, ...) for movies of
+long runs.  Every k-th iteration the Agent and Wolf positions are copied
+and handed to a pool of worker processes, which draw them offscreen (Agg)
+over the raster as it was at the start of the run, so rendering runs
+alongside the model instead of stalling it.  The frames can then be
+encoded as a video by ffmpeg, if it is installed.
+'''
+import os
+import math
+import shutil
+import subprocess
+import collections
+import concurrent.futures
+import numpy as np
+import agentframework
+
+# Frame file names (numbered from 0, as ffmpeg expects)
+FRAME_NAME = 'frame_%05d.png'
+
+# Resolution (dots per inch) frames are drawn at
+DPI = 100
+
+# Figure of a worker process (set up once by init_worker)
+worker_frame = None
+
+
+#----------------------------------------------------------
+# Worker processing
+#----------------------------------------------------------
+def init_worker(raster, extent, colours, size):
+    '''
+    Set up the figure a worker draws every frame on: the raster and empty
+    Agent and Wolf collections, which each frame moves.
+
+    Inputs:
+        - raster: Raster image (see background)
+        - extent: Raster extent (left, right, bottom, top)
+        - colours: RGBA colour of every Agent row
+        - size: Frame (width, height) in pixels
+    '''
+    global worker_frame
+
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    figure = Figure(figsize=(size[0] / DPI, size[1] / DPI), dpi=DPI)
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    image = axes.imshow(raster, extent=extent, cmap='copper')
+    figure.colorbar(image).set_label('Elevation (m)')
+    agent_points = axes.scatter([], [], marker='o')
+    wolf_points = axes.scatter([], [], marker='D', color='white')
+    axes.set_xlim(extent[0], extent[1])
+    axes.set_ylim(extent[2], extent[3])
+
+    worker_frame = {'figure': figure,
+                    'axes': axes,
+                    'agents': agent_points,
+                    'wolves': wolf_points,
+                    'colours': colours}
+
+
+def render_frame(path, iteration, rows, y, x, wolves):
+    '''
+    Draw one frame and write it to path (PNG).
+
+    Inputs:
+        - path: Frame file
+        - iteration: Iteration the positions are from
+        - rows, y, x: Row and position of each live Agent
+        - wolves: Position (y, x) of each Wolf
+    '''
+    frame = worker_frame
+    frame['agents'].set_offsets(np.column_stack((x, y)))
+    frame['agents'].set_facecolor(frame['colours'][rows])
+    frame['wolves'].set_offsets(wolves[:, ::-1])
+    frame['axes'].set_title('Agent Movements - iteration ' + str(iteration))
+    frame['figure'].savefig(path)
+
+    return path
+
+
+#----------------------------------------------------------
+# FrameWriter Class
+#----------------------------------------------------------
+class FrameWriter():
+    '''
+    Snapshots of a run handed to a pool of worker processes to draw.
+    '''
+    def __init__(self, folder, environment, population, wolf_pack, every=1,
+                 limit=0, size=(800, 600), workers=None):
+        '''
+        Initialisation of the FrameWriter instance with:
+            - Frame folder (created if need be)
+            - Stride and number of frames
+            - Worker processes, each with the raster and Agent colours
+            - Empty queue of frames being drawn
+
+        Inputs:
+            - folder: Folder the frames are written to
+            - environment: Environment raster at the start of the run
+            - population: AgentPopulation of the run (after every Agent
+                          has been added)
+            - wolf_pack: Wolves of the run
+            - every: Iterations between frames
+            - limit: Most frames to write (0 for no limit)
+            - size: Frame (width, height) in pixels
+            - workers: Number of worker processes (defaults to all cores
+                       but one)
+        '''
+        # Only the frames of this run are written (over any of the same 
+        # name); encode takes just those, so no other file is touched
+        os.makedirs(folder, exist_ok=True)
+
+        if workers is None:
+            workers = max(1, (os.cpu_count() or 1) - 1)
+
+        self.folder = folder
+        self.population = population
+        self.wolf_pack = wolf_pack
+        self.every = every
+        self.limit = limit
+        self.frames = 0
+        self.pending = collections.deque()
+        self.most_pending = 2 * workers
+
+        raster, extent = background(environment, size)
+        colours = agentframework.PALETTE_RGBA[
+            population.colour_index[:len(population)]]
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=init_worker,
+            initargs=(raster, extent, colours, size))
+
+
+    def snapshot(self, iteration):
+        '''
+        Copy the live Agent and Wolf positions for a frame if iteration
+        is a frame (every k-th, up to the limit).  Only waits for the
+        workers if they have fallen a few frames behind.
+        '''
+        if iteration % self.every != 0 or \
+                (self.limit > 0 and self.frames >= self.limit):
+            return
+
+        # Copies, as the arguments are only sent to a worker later on
+        population = self.population
+        rows = np.sort(population.live_rows())
+        wolves = np.array([(wolf.y, wolf.x) for wolf in self.wolf_pack],
+                          dtype=np.int64).reshape(-1, 2)
+        path = os.path.join(self.folder, FRAME_NAME % self.frames)
+
+        if len(self.pending) >= self.most_pending:
+            self.pending.popleft().result()
+
+        self.pending.append(self.pool.submit(render_frame, path, iteration,
+                                             rows, population.y[rows],
+                                             population.x[rows], wolves))
+        self.frames += 1
+
+
+    def wait(self):
+        '''
+        Wait for every frame to be written (raising any drawing error).
+        '''
+        while len(self.pending) > 0:
+            self.pending.popleft().result()
+
+
+    def close(self):
+        '''
+        Write the remaining frames and stop the workers.  Returns the
+        number of frames.
+        '''
+        try:
+            self.wait()
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+
+        return self.frames
+
+
+#----------------------------------------------------------
+# Functions
+#----------------------------------------------------------
+def background(environment, size):
+    '''
+    Raster image of a frame, thinned to about the frame resolution (so
+    large and tiled rasters are cheap to pass to the workers), and its
+    extent in cell coordinates.
+    '''
+    height, width = environment.shape
+    step = max(1, int(math.floor(min(height / size[1], width / size[0]))))
+    raster = np.array(environment.data[::step, ::step])
+
+    return raster, (-0.5, width - 0.5, height - 0.5, -0.5)
+
+
+def encode(folder, video, rate=10, frames=None):
+    '''
+    Encode the frames in folder as a video file with ffmpeg.  Returns
+    False (encoding nothing) if ffmpeg is not installed.
+
+    Inputs:
+        - folder: Folder of the frames
+        - video: Video file (any format ffmpeg writes, e.g. .mp4)
+        - rate: Frames per second
+        - frames: Number of frames to encode (default every frame in
+                  folder)
+    '''
+    ffmpeg = shutil.which('ffmpeg')
+
+    if ffmpeg is None:
+        return False
+
+    command = [ffmpeg, '-y', '-loglevel', 'error',
+               '-framerate', str(rate),
+               '-i', os.path.join(folder, FRAME_NAME),
+               '-pix_fmt', 'yuv420p',
+               '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2']
+
+    if frames is not None:
+        command += ['-frames:v', str(frames)]
+
+    subprocess.run(command + [video], check=True)
+
+    return True
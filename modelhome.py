@@ -5,17 +5,34 @@ Filename: modelhome.py
 
 Contains: 
 - Classes: FrontEnd
-- Methods: run, helper, about, finish, sel_no, sel_yes and unchecked.
+- Methods: run, start_next, read_output, poll, cancel, write, show_status,
+  start_server, stop_server, helper, about, finish, sel_no, sel_yes and 
+  unchecked.
 '''
+import re
+import sys
+import queue
+import threading
+import collections
 import tkinter as tk
 import subprocess
+import modelmain
+import modelserver
+
+# Milliseconds between checks for run output
+POLL_MS = 100
+
+# Progress line printed by modelmain.py --progress Y
+progress_line = re.compile(r'Iteration (\d+) of (\d+)$')
 
 
 class FrontEnd():
     '''
     Setup of Agents Model GUI home page
     
-    Calls modelmain.py with any parameters entered.
+    Calls modelmain.py with any parameters entered, in a subprocess so the
+    window stays responsive.  Runs are queued and started one at a time, 
+    on the model server if it has been started (see modelserver.py).
     
     Data entry fields:
         - Number of Agents
@@ -38,8 +55,10 @@ class FrontEnd():
         
     Buttons:
         - Run 
-            (Transfers control to modelmain.py with data entry fiels as
+            (Queues a run of modelmain.py with data entry fiels as
              arguments, if entered or selected)
+        - Cancel
+            (Stops the current run, queued runs carry on)
         - Reset
             (Reset input fields)
         - Exit
@@ -48,7 +67,9 @@ class FrontEnd():
     Display field
         - Run information
             (Displays any information (help, validation errosr etc) returned
-             from modelmain.py or the command prompt)
+             from modelmain.py or the command prompt, as it is printed)
+        - Run status
+            (Iteration of the current run and number of runs queued)
 
     Menu bar 
         - File > Run 
@@ -56,6 +77,11 @@ class FrontEnd():
              arguments, if entered)
         - File > Reset
             (Reset fields)
+        - File > Start server
+            (Starts modelserver.py, which keeps the model warm so later
+             runs start straight away)
+        - File > Stop server
+            (Stops modelserver.py)
         - File > Exit
             (Terminate application)
         - Defaults > Create (Not active in v1.0)
@@ -74,8 +100,10 @@ class FrontEnd():
             - 3 x Entry field
             - 1 x Set Radio buttons (contains 2)
             - 4 x Check buttons
-            - 3 x Buttons
+            - 4 x Buttons
+            - 1 x Status label
             - 1 x Text field (read only)
+            - Run queue
             - Menu bar (with cascading items)
         '''
         #-------------------------------------------------
@@ -103,6 +131,7 @@ class FrontEnd():
         home.bind('<Alt-r>', self.run)
         home.bind('<Alt-x>', self.finish)
         home.bind('<Alt-s>', self.clear)
+        home.bind('<Alt-c>', self.cancel)
         
         #-------------------------------------------------
         # Set up Menu Bar and cascading options.
@@ -117,6 +146,10 @@ class FrontEnd():
        
         menu_item_1.add_command(label='Run...', command=self.run, underline=0)
         menu_item_1.add_command(label='Reset', command=self.clear, underline=2)
+        menu_item_1.add_command(label='Start server', 
+                                command=self.start_server)
+        menu_item_1.add_command(label='Stop server', 
+                                command=self.stop_server)
         menu_item_1.add_command(label='Exit', command=self.finish, underline=1)
         menu_item_2.add_command(label='Create...', state=tk.DISABLED)
         menu_item_2.add_command(label='View...', state=tk.DISABLED)
@@ -155,7 +188,8 @@ class FrontEnd():
         # 3 x Entry fieds
         # 1 x Radio button set (2)
         # 4 x Check buttons
-        # 2 x Buttons
+        # 4 x Buttons
+        # 1 x Status label
         # 1 x Scrollable text box (This will be protected) 
         #-------------------------------------------------
         
@@ -248,6 +282,14 @@ class FrontEnd():
         self.b3.bind('<Return>', self.finish)
         self.b3.pack(side=tk.LEFT, expand=False)
         
+        self.b4 = tk.Button(frame7, text='Cancel', underline=0, width=6,
+                            command=self.cancel, state=tk.DISABLED)
+        self.b4.bind('<Return>', self.cancel)
+        self.b4.pack(side=tk.LEFT, expand=False, padx=20)
+        
+        self.l9 = tk.Label(frame7, anchor=tk.W, text='')
+        self.l9.pack(side=tk.LEFT, expand=False)
+        
         # Frame 8
         l8 = tk.Label(frame8, width=25, anchor=tk.W, text='Run information')
         l8.pack(side=tk.LEFT, expand = False)
@@ -259,6 +301,16 @@ class FrontEnd():
                      yscrollcommand=self.sb1.set)
         self.t1.pack(side = tk.LEFT, expand=False)
         
+        #-------------------------------------------------
+        # Run queue: argument lists waiting to run, the running process,
+        # and the lines it has printed (filled by a reader thread)
+        #-------------------------------------------------
+        self.runs = collections.deque()
+        self.process = None
+        self.lines = queue.Queue()
+        self.progress = ''
+        self.cancelled = False
+        
         #-------------------------------------------------
         # Initialise all input fields.
         #-------------------------------------------------
@@ -267,39 +319,172 @@ class FrontEnd():
 
     def run(self, event=None):
         '''
-        Link to the main Agents model module with any parameters entered.
-        
-        Display any returned information, errors, help etc.
+        Queue a run of the main Agents model module with any parameters 
+        entered, starting it straight away if nothing else is running.
         
         Note 1: Only parameters that have been entered via the GUI front-end 
         will be passed as arguments to modelhome.py.  
         
         Note 2: Radio and Check button will always have a value.
         '''
-        call_string = ''.join(
-            ['python modelmain.py',
-             ' --agents ' +  self.e1.get() if self.e1.get() != '' else '',
-             ' --defaults ' +  self.agent_defaults.get(),        # check button
-             ' --moves ' + self.e2.get() if self.e2.get() != '' else '',
-             ' --distance ' + self.e3.get() if self.e3.get() != ''  else '',
-             ' --wolves ' + self.e4.get() if self.e4.get() != ''  else '',
-             ' --plotstart ' + self.plot_start.get(),            # radio button
-             ' --dispagents ' +  self.disp_agent_summary.get(),  # check button
-             ' --dispwolves ' +  self.disp_wolf_summary.get(),   # check button
-             ' --dispparams ' +  self.disp_params.get()          # check button
-            ])
+        call_args = [sys.executable, '-u', 'modelmain.py']
+        
+        for name, value in [('--agents', self.e1.get()),
+                            ('--defaults', self.agent_defaults.get()),
+                            ('--moves', self.e2.get()),
+                            ('--distance', self.e3.get()),
+                            ('--wolves', self.e4.get()),
+                            ('--plotstart', self.plot_start.get()),
+                            ('--dispagents', self.disp_agent_summary.get()),
+                            ('--dispwolves', self.disp_wolf_summary.get()),
+                            ('--dispparams', self.disp_params.get())]:
+            if value != '':
+                call_args += [name, value]
+                
+        call_args += ['--progress', 'Y']
 
         self.b1.focus_set()
+        self.runs.append(call_args)
+        
+        if self.process is None:
+            self.start_next()
+        else:
+            self.show_status()
+            
+            
+    def start_next(self):
+        '''
+        Start the next queued run (if any), clearing the run information.
+        '''
+        if len(self.runs) == 0:
+            self.b4.configure(state=tk.DISABLED)
+            self.show_status()
+            return
+        
         self.t1.configure(state=tk.NORMAL)  
         self.t1.delete(1.0, tk.END)
         self.t1.configure(state=tk.DISABLED)
         
-        ret_code, ret_output = subprocess.getstatusoutput(call_string)
+        self.progress = 'Starting'
+        self.cancelled = False
+        
+        try:
+            self.process = subprocess.Popen(self.runs.popleft(), 
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT,
+                                            text=True, bufsize=1)
+        except OSError as e:
+            self.process = None
+            self.write(str(e) + '\n')
+            self.start_next()
+            return
+        
+        threading.Thread(target=self.read_output, args=(self.process,),
+                         daemon=True).start()
+        
+        self.b4.configure(state=tk.NORMAL)
+        self.show_status()
+        self.home.after(POLL_MS, self.poll)
+        
+        
+    def read_output(self, process):
+        '''
+        Pass each line the run prints to the GUI (runs on its own thread
+        as reading blocks; None marks the end of the run's output).
+        
+        Inputs:
+            - process: Running subprocess.Popen
+        '''
+        for line in process.stdout:
+            self.lines.put(line)
+            
+        process.stdout.close()
+        self.lines.put(None)
+        
+        
+    def poll(self):
+        '''
+        Show the lines printed since the last poll, showing progress lines
+        in the run status, and start the next run once this one ends.
+        '''
+        text = []
+        finished = False
+        
+        while True:
+            try:
+                line = self.lines.get_nowait()
+            except queue.Empty:
+                break
+            
+            if line is None:
+                finished = True
+                break
+            
+            match = progress_line.match(line.rstrip())
+            
+            if match is None:
+                text.append(line)
+            else:
+                self.progress = 'Iteration ' + match.group(1) + ' of ' + \
+                                match.group(2)
+        
+        self.write(''.join(text))
+        
+        if not finished:
+            self.show_status()
+            self.home.after(POLL_MS, self.poll)
+            return
+        
+        ret_code = self.process.wait()
+        self.process = None
+        
+        if self.cancelled:
+            self.write('\nRun cancelled.\n')
+        elif ret_code != 0:
+            self.write('\nRun ended with exit status ' + str(ret_code) + 
+                       '\n')
+            
+        self.progress = ''
+        self.start_next()
+        
+        
+    def cancel(self, event=None):
+        '''
+        Stop the current run (modelmain.py stops any worker processes on
+        the way out).  Queued runs carry on.
+        '''
+        if self.process is not None and self.process.poll() is None:
+            self.cancelled = True
+            self.progress = 'Cancelling'
+            self.process.terminate()
+            self.show_status()
+            
+            
+    def write(self, text):
+        '''
+        Add text to the end of the run information.
+        '''
+        if text == '':
+            return
         
         self.t1.configure(state=tk.NORMAL)  
-        self.t1.insert(tk.END, ret_output)
+        self.t1.insert(tk.END, text)
+        self.t1.see(tk.END)
         self.sb1.config(command=self.t1.yview)
         self.t1.configure(state=tk.DISABLED)
+        
+        
+    def show_status(self):
+        '''
+        Show the progress of the current run and the number queued.
+        '''
+        status = self.progress
+        
+        if len(self.runs) > 0:
+            status += (' - ' if status != '' else '') + \
+                      str(len(self.runs)) + ' run(s) queued'
+            
+        self.l9.configure(text=status)
 
     
     def clear(self, event=None):
@@ -320,13 +505,33 @@ class FrontEnd():
         self.unchecked()
     
     
+    def start_server(self):
+        '''
+        Start the model server (runs started from here on use it).
+        '''
+        if modelserver.start() is None:
+            self.write('Model server already running.\n')
+        else:
+            self.write('Model server started.\n')
+            
+            
+    def stop_server(self):
+        '''
+        Stop the model server (runs started from here on start afresh).
+        '''
+        if modelserver.stop_server():
+            self.write('Model server stopped.\n')
+        else:
+            self.write('No model server running.\n')
+        
+        
     def helper(self):
         '''
         Get the main Agents model help information.
         
         Display information is a popup window.
         '''
-        help_return = subprocess.getoutput('python modelmain.py -h') 
+        help_return = modelmain.make_parser().format_help()
         
         help_info = tk.Tk()
         help_info.geometry('900x500')
@@ -363,8 +568,13 @@ class FrontEnd():
     
     def finish(self, event=None):
         '''
-        Exit the program.
+        Exit the program, stopping any run and dropping the queue.
         '''
+        self.runs.clear()
+        
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            
         exit()
         
         
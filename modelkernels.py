@@ -0,0 +1,277 @@
+'''
+Filename: modelkernels.py
+
+Contains:
+- Functions: step_kernel, resolve_backend, kernel_for, check_backends
+
+Compiled kernel backend for the per-Agent iteration (--backend numba).
+
+step_kernel runs one random-sequential iteration (move, eat and share for
+each live Agent in turn) as plain loops over the AgentPopulation arrays,
+which Numba compiles to machine code when it is installed.  Without Numba
+the model uses the Python implementation (AgentPopulation.step) instead.
+
+Both backends give identical results for the same seed.  To check, enter:
+    python modelkernels.py [--agents n] [--moves n] [--distance n]
+(without Numba the kernel is checked running as ordinary Python).
+'''
+import sys
+import argparse
+import numpy as np
+
+# Numba is optional
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Backend names accepted by resolve_backend (--backend)
+backends = ['python', 'numba']
+
+
+#----------------------------------------------------------
+# Kernels
+#----------------------------------------------------------
+def step_kernel(order, new_y, new_x, y, x, store, moves, alive, data,
+                neighbourhood, share):
+    '''
+    One iteration of every live Agent in order, in place on the
+    population arrays (same rules and order as AgentPopulation.step).
+
+    Neighbours are found through a bucket grid held as linked lists of
+    rows, updated as each Agent moves, and are visited in order.
+
+    Inputs:
+        - order: Rows in the order Agents are processed
+        - new_y, new_x: Position of each Agent of order after its move
+        - y, x, store, moves, alive: AgentPopulation row arrays
+        - data: Environment raster array
+        - neighbourhood: Distance considered to be a neighbour
+        - share: Interact with neighbours
+    '''
+    n = len(y)
+    height, width = data.shape
+    size = max(1, int(np.ceil(neighbourhood)))
+    rows_of_buckets = height // size + 1
+    cols_of_buckets = width // size + 1
+    near = neighbourhood * neighbourhood
+
+    # First row of each bucket, next / previous row in its bucket and
+    # bucket of each row (-1 for none); position of each row in order
+    head = np.full(rows_of_buckets * cols_of_buckets, -1, np.int64)
+    after = np.full(n, -1, np.int64)
+    before = np.full(n, -1, np.int64)
+    bucket = np.full(n, -1, np.int64)
+    rank = np.full(n, -1, np.int64)
+    ranks = np.empty(n, np.int64)
+
+    for k in range(len(order)):
+        i = order[k]
+        rank[i] = k
+
+        if alive[i]:
+            b = (y[i] // size) * cols_of_buckets + x[i] // size
+            bucket[i] = b
+            after[i] = head[b]
+
+            if head[b] >= 0:
+                before[head[b]] = i
+
+            head[b] = i
+
+    for k in range(len(order)):
+        i = order[k]
+
+        if not alive[i]:
+            continue
+
+        #--------------------------------------------------
+        # Move (to the planned cell, changing bucket if need be)
+        #--------------------------------------------------
+        y[i] = new_y[k]
+        x[i] = new_x[k]
+        moves[i] += 1
+        b = (y[i] // size) * cols_of_buckets + x[i] // size
+
+        if b != bucket[i]:
+            if before[i] >= 0:
+                after[before[i]] = after[i]
+            else:
+                head[bucket[i]] = after[i]
+
+            if after[i] >= 0:
+                before[after[i]] = before[i]
+
+            before[i] = -1
+            after[i] = head[b]
+
+            if head[b] >= 0:
+                before[head[b]] = i
+
+            head[b] = i
+            bucket[i] = b
+
+        #--------------------------------------------------
+        # Eat a maximum of 10 units or whatever is left, putting
+        # back if the Agent has eaten too much
+        #--------------------------------------------------
+        value = data[y[i], x[i]]
+        amount = store[i]
+
+        if value >= 10:
+            amount += 10
+            value -= 10
+        elif value > 0:
+            amount += value
+            value = 0.0
+
+        if amount > 100:
+            value += amount
+            amount = 0.0
+
+        data[y[i], x[i]] = value
+        store[i] = amount
+
+        #--------------------------------------------------
+        # Average out the store with each neighbour in order
+        #--------------------------------------------------
+        if share:
+            by = y[i] // size
+            bx = x[i] // size
+            m = 0
+
+            for cy in range(max(by - 1, 0), min(by + 2, rows_of_buckets)):
+                for cx in range(max(bx - 1, 0),
+                                min(bx + 2, cols_of_buckets)):
+                    j = head[cy * cols_of_buckets + cx]
+
+                    while j >= 0:
+                        dy = y[j] - y[i]
+                        dx = x[j] - x[i]
+
+                        # Rows not in order (rank -1) are skipped, as
+                        # by AgentPopulation.share_one
+                        if j != i and rank[j] >= 0 and \
+                                dy * dy + dx * dx <= near:
+                            ranks[m] = rank[j]
+                            m += 1
+
+                        j = after[j]
+
+            amount = store[i]
+
+            for r in np.sort(ranks[:m]):
+                j = order[r]
+                amount = (amount + store[j]) / 2
+                store[j] = amount
+
+            store[i] = amount
+
+
+# Compiled copy of the kernel (None without Numba)
+if numba is not None:
+    compiled_step_kernel = numba.njit(cache=True)(step_kernel)
+else:
+    compiled_step_kernel = None
+
+
+#----------------------------------------------------------
+# Functions
+#----------------------------------------------------------
+def resolve_backend(name):
+    '''
+    Backend actually used for a name in backends: numba falls back to
+    python if Numba is not installed.
+    '''
+    if name not in backends:
+        raise ValueError('Unknown backend ' + str(name) + ' (must be one ' +
+                         'of ' + ', '.join(backends) + ').')
+
+    if name == 'numba' and compiled_step_kernel is None:
+        return 'python'
+
+    return name
+
+
+def kernel_for(name):
+    '''
+    Step kernel of a backend (None for the Python implementation)
+    '''
+    if resolve_backend(name) == 'numba':
+        return compiled_step_kernel
+
+    return None
+
+
+def check_backends(num_of_agents=500, iterations=20, neighbourhood=20,
+                   seed=0, kernel=None):
+    '''
+    Run the same seeded iterations through AgentPopulation.step and a
+    step kernel and return True if every array matches exactly.
+
+    Inputs:
+        - num_of_agents: Number of Agents
+        - iterations: Number of iterations
+        - neighbourhood: Distance considered to be a neighbour
+        - seed: Seed of the raster, Agents and orders
+        - kernel: Kernel to check (default the compiled kernel, or
+                  step_kernel itself without Numba)
+    '''
+    import agentframework
+    from environment import Environment
+
+    if kernel is None:
+        kernel = compiled_step_kernel or step_kernel
+
+    raster = np.random.default_rng(seed).integers(0, 500, (100, 100))
+    populations = []
+
+    for backend_kernel in (None, kernel):
+        rng = np.random.default_rng(seed)
+        population = agentframework.AgentPopulation(Environment(raster),
+                                                    num_of_agents, rng=rng)
+
+        for i in range(num_of_agents):
+            population.add()
+
+        population.use_kernel(backend_kernel)
+
+        for j in range(iterations):
+            # Kill a few Agents along the way so dead rows are covered
+            population.kill(int(rng.integers(num_of_agents)))
+            population.step(rng.permutation(population.live_rows()),
+                            neighbourhood)
+
+        populations.append(population)
+
+    python, compiled = populations
+
+    return all(np.array_equal(getattr(python, name),
+                              getattr(compiled, name))
+               for name in ('y', 'x', 'store', 'moves', 'alive')) and \
+        np.array_equal(python.environment.data, compiled.environment.data)
+
+
+#----------------------------------------------------------
+# Command line parity check
+#----------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check the kernel backend matches the Python one.')
+    parser.add_argument('--agents', type=int, default=500,
+                        help='Number of Agents')
+    parser.add_argument('--moves', type=int, default=20,
+                        help='Number of iterations')
+    parser.add_argument('--distance', type=int, default=20,
+                        help='Distance considered to be a neighbour')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random number seed')
+    args = parser.parse_args()
+
+    if compiled_step_kernel is None:
+        print('Numba not installed - checking the kernel as Python')
+
+    if check_backends(args.agents, args.moves, args.distance, args.seed):
+        print('Backends match')
+    else:
+        sys.exit('Backends differ')
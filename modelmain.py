@@ -9,7 +9,7 @@ Called by:
     - Developement IDE
 
 Input:   
-    - 9 optional arguments - able to be passed in in any order:
+    - 30 optional arguments - able to be passed in in any order:
         - agents - Number of Agents
         - defaults - Use default Agent start locations
         - moves - Number of Agent & Wolf moves
@@ -19,13 +19,35 @@ Input:
         - dispagents - Display Agent summary data
         - dispwolves - Display Wolf summary data
         - dispparams - Display Parameter Data
+        - grid - Use a spatial grid index for neighbour searches
+        - cache - Use a binary copy of the raster file
+        - binout - Also output a binary copy of the modified raster
+        - headless - Batch run with no figure (datasets only)
+        - seed - Random number seed (reproducible runs)
+        - profile-out - Per-phase timing file (JSON or Chrome trace)
+        - profile-every - Time every k-th iteration
+        - skin - Neighbour list margin beyond distance (0 for none, 
+                 else at least 3)
+        - schedule - Update scheduler (random, fixed or sync)
+        - backend - Agent iteration backend (python, or numba if installed)
+        - tile - Tile side for rasters larger than memory (0 for none)
+        - tilecache - Tile cache memory budget (MB)
+        - workers - Worker processes, one per strip of the raster
+        - progress - Print progress after each iteration
+        - server - Use the model server (modelserver.py) if one is running
+        - animate - Show the run live, every n-th iteration (0 for off)
+        - frames-out - Folder to write frames of the run to (PNG)
+        - frames-every - Iterations between frames
+        - frames-max - Most frames to write (0 for no limit)
+        - frames-size - Frame width x height in pixels
+        - frames-video - Video file to encode the frames as (ffmpeg)
       Note: All arguments have a hard coded default value if not supplied.
 
     - Environment raster file:
-        - in.txt
+        - in.txt (or its cached binary copy in.txt.rbin)
         
 Output:
-    - Figure
+    - Figure (not in headless mode)
         - Plotted Agent starting locations (dependant on argument passed in)
         - Plotted Wolf Pack starting location (dependant on argument passed in)
         - Plotted Agent finishing locations
@@ -34,24 +56,68 @@ Output:
         - out1.txt - Modified input raster file
         - out2.txt - Agent finalised store data
         - out3.txt - Wolf finakised kill data
+        - out1.rbin - Modified input raster in binary (dependant on argument
+                      passed in)
+        - Per-phase timings (dependant on argument passed in)
+        - Frames of the run and a video of them (dependant on arguments 
+          passed in)
+
+Functions (may be imported to run the model without the command line):
+    - make_parser - Argument parser (for help text)
+    - parse_arguments - Get and validate arguments into a config
+    - make_streams - Independent random number streams for a run
+    - run_model - Run the model for a config and environment
+    - write_outputs - Output datasets of a run
+    - setup_figure, scatter_agents, scatter_wolves - Plotting
+    - main - Command line processing
+    
+Classes:
+    - Result - Outcome of one model run
+    - Animation - Live view of a run (--animate)
 '''
+import time
+start_time = time.perf_counter()
+
 import sys
+
+# Hand the run to the model server if one is running in this folder (the
+# imports and raster below are already warm there)
+if __name__ == '__main__':
+    import modelserver
+    modelserver.forward(sys.argv[1:])
+
+import os
 import csv
-import random
+import math
+import signal
 import argparse
-import matplotlib.lines as lns
-import matplotlib.pyplot as plt
+import numpy as np
 import agentframework
-import requests
-import bs4
+import modelframes
+import modelkernels
+import modelparallel
+import modelprofile
+import modelschedule
+from environment import load_raster, save_raster, TiledEnvironment
+
+# Note: matplotlib, requests and bs4 are only imported when needed as
+# they take most of the startup time.
 
 
 #----------------------------------------------------------
 # Initialise variables
 #----------------------------------------------------------
 arg_name = ['--agents', '--defaults', '--moves', '--distance', '--wolves', 
-            '--plotstart', '--dispagents', '--dispwolves', '--dispparams']
-arg_dflt = ['10', 'N', '100', '20', '5', 'N', 'N', 'N', 'N']
+            '--plotstart', '--dispagents', '--dispwolves', '--dispparams',
+            '--grid', '--cache', '--binout', '--headless', '--seed',
+            '--profile-out', '--profile-every', '--skin', '--schedule',
+            '--backend', '--tile', '--tilecache', '--workers',
+            '--progress', '--server', '--animate', '--frames-out', 
+            '--frames-every', '--frames-max', '--frames-size', 
+            '--frames-video']
+arg_dflt = ['10', 'N', '100', '20', '5', 'N', 'N', 'N', 'N', 'Y', 'Y', 'N', 
+            'N', '', '', '1', '0', 'random', 'python', '0', '256', 
+            '1', 'N', 'Y', '0', '', '1', '0', '800x600', '']
 arg_dest = ['num_of_agents', 
             'agent_defaults',
             'num_of_iterations', 
@@ -60,7 +126,28 @@ arg_dest = ['num_of_agents',
             'plot_start',
             'display_agents',
             'display_wolves',
-            'display_params']
+            'display_params',
+            'use_grid',
+            'raster_cache',
+            'binary_out',
+            'headless',
+            'seed',
+            'profile_out',
+            'profile_every',
+            'skin',
+            'schedule',
+            'backend',
+            'tile_size',
+            'tile_cache',
+            'workers',
+            'progress',
+            'server',
+            'animate',
+            'frames_out',
+            'frames_every',
+            'frames_max',
+            'frames_size',
+            'frames_video']
 arg_help = ['Number of Agents (numeric)', 
             'Use default Agent start locations (Y/N)',
             'Number of Agent & Wolf moves (numeric)', 
@@ -69,316 +156,849 @@ arg_help = ['Number of Agents (numeric)',
             'Show starting location of Agents & Wolf Pack (Y/N)',
             'Display Agent summary data (Y/N)',
             'Display Wolf summary data (Y/N)',
-            'Display Parameter Data (Y/N)']
-environment = []
-agents = []
-agents_move = []
-agents_eat = []
-agents_share = []
-wolf_pack = []
-wolf_pack_move = []
-wolf_pack_hunt = []
-num_of_agents_killed = 0
+            'Display Parameter Data (Y/N)',
+            'Use a spatial grid index for neighbour searches (Y/N)',
+            'Use a binary copy of the raster file (Y/N)',
+            'Also output the modified raster as out1.rbin (Y/N)',
+            'Batch run with no figure, output datasets only (Y/N)',
+            'Random number seed (numeric, default unseeded)',
+            'Per-phase timing file (.trace.json for a Chrome trace)',
+            'Time every k-th iteration (numeric)',
+            'Neighbour list margin beyond the distance, reused across ' +
+            'iterations with the grid index (numeric, 0 for none or ' +
+            'at least 3)',
+            'Update scheduler: random (random-sequential), fixed ' +
+            '(creation order) or sync (synchronous, batched)',
+            'Agent iteration backend: python or numba (compiled, ' +
+            'falls back to python if Numba is not installed)',
+            'Tile side (cells) to hold the raster on disk, in tiles ' +
+            'cached on demand (numeric, 0 to hold it all in memory)',
+            'Tile cache memory budget (MB) (numeric)',
+            'Worker processes, each running the Agents and Wolves of ' +
+            'one strip of the raster (numeric, over 1 needs ' +
+            '--schedule sync; seeded results are the same for any ' +
+            'number over 1, but differ from 1)',
+            'Print "Iteration j of n" after each iteration (Y/N)',
+            'Use the model server (modelserver.py) if one is running ' +
+            '(Y/N)',
+            'Show the run live, redrawing the Agents and Wolves every ' +
+            'n-th iteration (numeric, 0 for off; not with --workers)',
+            'Folder to write a frame (PNG) of the run to every ' +
+            '--frames-every iterations (optional; not with --workers)',
+            'Iterations between frames (numeric)',
+            'Most frames to write (numeric, 0 for no limit)',
+            'Frame size in pixels (width x height, e.g. 800x600)',
+            'Video file to encode the frames as, if ffmpeg is installed ' +
+            '(optional)']
+
+# Raster rows written to out1.txt at a time
+OUTPUT_ROWS = 256
+
+
+#----------------------------------------------------------
+# Result Class
+#----------------------------------------------------------
+class Result():
+    '''
+    Outcome of one model run.
+    '''
+    def __init__(self, agents, wolf_pack, environment, stats):
+        '''
+        Initialisation of the Result instance with:
+            - agents: Final Agents (in creation order)
+            - wolf_pack: Final Wolves (in creation order)
+            - environment: Modified Environment raster
+            - stats: Dictionary of run statistics
+        '''
+        self.agents = agents
+        self.wolf_pack = wolf_pack
+        self.environment = environment
+        self.stats = stats
 
 
 #----------------------------------------------------------
 # Get and validate command line arguments
 #----------------------------------------------------------
-parser = argparse.ArgumentParser()
-
-# Setup arguments
-for i in range(len(arg_name)):
-    parser.add_argument(arg_name[i], 
-                        dest=arg_dest[i], 
-                        default=arg_dflt[i], 
-                        help=arg_help[i])
-
-# Bring in arguments
-args = parser.parse_args()
-
-# Store in a list entered arguments and defaults for those not entered.
-# Note: order is important for reasigning back
-arg_value = [args.num_of_agents, 
-             args.agent_defaults.upper(),
-             args.num_of_iterations, 
-             args.neighbourhood,
-             args.num_in_wolf_pack,
-             args.plot_start.upper(),
-             args.display_agents.upper(),
-             args.display_wolves.upper(),
-             args.display_params.upper()]
-
-# Test and finalise arguments
-arg_err_count = 0
-
-# Ensure arguments 0, 2, 3 and 4 are an integer and > 0.
-# All others are strings and controlled by check and radio buttons (Y / N).
-# Note: If a string argument contain anything other than Y or N, then the 
-# logic will treat it as a N.
-for i in list([0, 2, 3, 4]): 
-    if arg_value[i].isnumeric() is True:
-        arg_value[i] = int(arg_value[i])
+def make_parser():
+    '''
+    Argument parser of the model (also used for the GUI help).
+    '''
+    parser = argparse.ArgumentParser(prog='modelmain.py')
+    
+    # Setup arguments
+    for i in range(len(arg_name)):
+        parser.add_argument(arg_name[i], 
+                            dest=arg_dest[i], 
+                            default=arg_dflt[i], 
+                            help=arg_help[i])
+        
+    return parser
+
+
+def parse_arguments(argv=None):
+    '''
+    Get and validate the arguments, returning them as the run config.
+    
+    Inputs:
+        - argv: Argument strings (defaults to the command line)
+    '''
+    parser = make_parser()
+    
+    # Bring in arguments
+    args = parser.parse_args(argv)
+    
+    # Command line name of each argument (for the error messages)
+    name = dict(zip(arg_dest, arg_name))
+    
+    # Y/N flags are upper case and the scheduler, backend and frame size
+    # lower case.
+    # Note: If a Y/N argument contain anything other than Y or N, then 
+    # the logic will treat it as a N.
+    for dest in ['agent_defaults', 'plot_start', 'display_agents', 
+                 'display_wolves', 'display_params', 'use_grid', 
+                 'raster_cache', 'binary_out', 'headless', 'progress', 
+                 'server']:
+        setattr(args, dest, getattr(args, dest).upper())
+        
+    for dest in ['schedule', 'backend', 'frames_size']:
+        setattr(args, dest, getattr(args, dest).lower())
+    
+    # Test and finalise arguments
+    arg_err_count = 0
+    
+    # Ensure the counts, distance, strides, cache budget and workers are 
+    # integers and > 0.  The seed and profile file are optional and the 
+    # skin, tile size, animation stride and frame limit may be 0.
+    for dest in ['num_of_agents', 'num_of_iterations', 'neighbourhood', 
+                 'num_in_wolf_pack', 'profile_every', 'tile_cache', 
+                 'workers', 'frames_every']: 
+        value = getattr(args, dest)
+        
+        if value.isnumeric() is True:
+            value = int(value)
+            setattr(args, dest, value)
             
-        if arg_value[i] < 1:
-            print(arg_name[i], arg_value[i], '- Must be an integer and > 0')
+        if not isinstance(value, int) or value < 1:
+            print(name[dest], value, '- Must be an integer and > 0')
             arg_err_count += 1
+      
+    # The seed is optional but must be an integer >= 0 if given
+    if args.seed == '':
+        args.seed = None
+    elif args.seed.isnumeric() is True:
+        args.seed = int(args.seed)
+    else:
+        print(name['seed'], args.seed, '- Must be an integer and >= 0')
+        arg_err_count += 1
+      
+    # The skin, tile size, animation stride and frame limit must be 
+    # integers >= 0
+    for dest in ['skin', 'tile_size', 'animate', 'frames_max']:
+        value = getattr(args, dest)
+        
+        if value.isnumeric() is True:
+            setattr(args, dest, int(value))
         else:
-            pass
+            print(name[dest], value, '- Must be an integer and >= 0')
+            arg_err_count += 1
+      
+    # The neighbour list is only checked once an iteration, so its skin 
+    # must cover two moves (one by each of a pair of Agents)
+    least_skin = int(math.ceil(2 * agentframework.STEP_DISTANCE))
+    
+    if isinstance(args.skin, int) and 0 < args.skin < least_skin:
+        print(name['skin'], args.skin, '- Must be 0 or at least ' + 
+              str(least_skin))
+        arg_err_count += 1
+      
+    # The schedule must be one of the known schedulers
+    if args.schedule not in modelschedule.schedules:
+        print(name['schedule'], args.schedule, '- Must be one of ' + 
+              ', '.join(modelschedule.schedules))
+        arg_err_count += 1
+      
+    # The backend must be one of the known backends
+    if args.backend not in modelkernels.backends:
+        print(name['backend'], args.backend, '- Must be one of ' + 
+              ', '.join(modelkernels.backends))
+        arg_err_count += 1
+      
+    # Parallel runs follow the synchronous scheduler's rules only
+    parallel = isinstance(args.workers, int) and args.workers > 1
+    
+    if parallel and args.schedule != 'sync':
+        print(name['workers'], args.workers, '- Needs ' + 
+              name['schedule'] + ' sync')
+        arg_err_count += 1
+      
+    # The frame size is width x height, both integers > 0
+    size = args.frames_size.split('x')
+    
+    if len(size) == 2 and all(side.isnumeric() and int(side) > 0 
+                              for side in size):
+        args.frames_size = (int(size[0]), int(size[1]))
     else:
-        print(arg_name[i], arg_value[i], '- Must be an integer and > 0')
+        print(name['frames_size'], args.frames_size, 
+              '- Must be width x height (integers > 0)')
         arg_err_count += 1
-  
-# Abort if any command line errors
-if arg_err_count > 0:
-    parser.exit('Parameter error - aborting')
-
-# Reasign back
-args.num_of_agents, args.agent_defaults, args.num_of_iterations, \
-    args.neighbourhood, args.num_in_wolf_pack, args.plot_start, \
-    args.display_agents, args.display_wolves, args.display_params = arg_value
-
-if args.display_params == 'Y':
-    print('Processed with the following arguments:' + 
-          ',\n - No. Agents: ' + str(args.num_of_agents) + 
-          ',\n - Use default Agent start locations: ' + args.agent_defaults + 
-          ',\n - No. Agent moves: ' + str(args.num_of_iterations) + 
-          ',\n - Neighbourhood Distance: ' + str(args.neighbourhood) + 
-          ',\n - No. Wolves: '+ str(args.num_in_wolf_pack) + 
-          ',\n - Plot starting locations: ' + args.plot_start + '.')
-
-#----------------------------------------------------------
-# Read in raster dataset and create environment
-#----------------------------------------------------------
-f = open('in.txt', newline='')
-
-reader = csv.reader(f, quoting=csv.QUOTE_NONNUMERIC)
-
-try:
-    for row in reader: 
-
-        if reader.line_num > 1:
-            # Test if the number of cell is the same as previous row
-            if len(row) != len(environment[reader.line_num-2]):
-                f.close() 
-
-                sys.exit('Inconsistent number of cells encountered in row #' +
-                         str(reader.line_num) + ' of input raster file.')
-                
-        # Convert each element from float to integer
-        environment.append(list(map(lambda row_elem: int(row_elem), row)))
+      
+    # Frames are taken in this process, so not of parallel runs
+    if args.frames_out != '' and parallel:
+        print(name['frames_out'], args.frames_out, '- Needs ' + 
+              name['workers'] + ' 1')
+        arg_err_count += 1
+      
+    # Abort if any command line errors
+    if arg_err_count > 0:
+        parser.exit('Parameter error - aborting')
         
-except ValueError:
-    f.close() 
-
-    sys.exit('Non numerical cell value encountered in row #' + 
-             str(reader.line_num) + ' of input raster file.')
-
-
-f.close() 
-#----------------------------------------------------------
-# At this point, the contents of the raster have 
-# been read in and have passed validation.
-#----------------------------------------------------------
+    return args
 
 
 #----------------------------------------------------------
 # Get starting locations for up to 100 agents
 #----------------------------------------------------------
-if args.agent_defaults == 'Y':
+def get_start_locations():
+    '''
+    Get the default Agent start locations as a list of (y, x).
+    '''
+    import requests
+    import bs4
+    
     r = requests.get('http://www.geog.leeds.ac.uk/courses/computing/' + 
                      'practicals/python/agent-framework/part9/data.html')
     content = r.text
     soup = bs4.BeautifulSoup(content, 'html.parser')
     td_ys = soup.find_all(attrs={'class' : 'y'})
     td_xs = soup.find_all(attrs={'class' : 'x'})
-else:
-    td_ys = []
-    td_xs = []
+    
+    return [(int(td_y.text), int(td_x.text)) 
+            for td_y, td_x in zip(td_ys, td_xs)]
 
 
 #----------------------------------------------------------
-# Create agents
+# Random number streams
 #----------------------------------------------------------
-for i in range(args.num_of_agents):
-    # create the next Agent instance
-    if i+1 > len(td_ys):
-        agents.append(agentframework.Agent(environment, agents))
-    else:
-        agents.append(agentframework.Agent(environment, agents, 
-                      int(td_ys[i].text), int(td_xs[i].text))) 
+def make_streams(seed=None):
+    '''
+    Independent numpy.random.Generator streams for the Agents, the Wolves 
+    and the scheduler of one run.
+    
+    Inputs:
+        - seed: Integer seed, or a SeedSequence (e.g. one spawned per 
+                worker or replicate); None for fresh entropy
+    '''
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+        
+    agent_seq, wolf_seq, scheduler_seq = seed.spawn(3)
         
-    # Because the following functions are going to be called for a dynamic
-    # number of times for each Agent, let's label each for effeciency sake. 
-    agents_move.append(agents[i].move)
-    agents_eat.append(agents[i].eat)
-    agents_share.append(agents[i].share_with_neighbours)
+    return {'agents': np.random.default_rng(agent_seq),
+            'wolves': np.random.default_rng(wolf_seq),
+            'scheduler': np.random.default_rng(scheduler_seq)}
 
 
 #----------------------------------------------------------
-# Create wolves
+# Run the model
 #----------------------------------------------------------
-
-# All wolves will start as a pack at the same location
-for i in range(args.num_in_wolf_pack):
-    # create the next Wolf instance
-    wolf_pack.append(agentframework.Wolf(environment, wolf_pack))
-
-    # Because the following functions are going to be called for a dynamic 
-    # number of times for each Wolf, let's label each for effeciency sake. 
-    wolf_pack_move.append(wolf_pack[i].move)
-    wolf_pack_hunt.append(wolf_pack[i].hunt)
+def run_model(config, environment, start_locations=(), on_start=None, 
+              seed=None, timer=None, on_iteration=None):
+    '''
+    Create the Agents and Wolves and move them (config.num_of_iterations
+    times each) over a copy of the environment (a TiledEnvironment is 
+    copied to a temporary file).
+    
+    Holds no state outside the call, so may be called many times in one
+    process.
+    
+    Inputs:
+        - config: Parameters (as returned by parse_arguments)
+        - environment: Environment raster (not modified)
+        - start_locations: Default (y, x) start locations for the first 
+                           Agents
+        - on_start: Function called with (agents, wolf_pack) once they 
+                    have been created, before the first move
+        - seed: Seed or SeedSequence of the run (defaults to config.seed)
+        - timer: modelprofile.PhaseTimer to time the phases of each 
+                 iteration with (None for no timing)
+        - on_iteration: Function called with (iterations done, 
+                        config.num_of_iterations) after each iteration
+                    
+    Returns a Result.
+    '''
+    streams = make_streams(config.seed if seed is None else seed)
+    environment = environment.copy()
+    agents = []
+    wolf_pack = []
+    num_of_agents_killed = 0
+    
+    #------------------------------------------------------
+    # Create agents
+    # - All Agent data is held by the population; each Agent
+    #   is a view onto one row of it.
+    #------------------------------------------------------
+    population = agentframework.AgentPopulation(environment, 
+                                                config.num_of_agents,
+                                                rng=streams['agents'])
+    
+    for i in range(config.num_of_agents):
+        # create the next Agent instance
+        if i+1 > len(start_locations):
+            agents.append(agentframework.Agent(environment, agents, 
+                                               population=population))
+        else:
+            agents.append(agentframework.Agent(environment, agents, 
+                          start_locations[i][0], start_locations[i][1], 
+                          population=population)) 
+    
+    scheduler = modelschedule.make_scheduler(config.schedule, 
+                                             streams['scheduler'])
+    
+    # Index Agents by grid bucket so each only checks nearby candidates,
+    # or list each Agent's candidates once and reuse them (checked once 
+    # an iteration) until an Agent has moved over half the skin.  The 
+    # synchronous scheduler and the compiled kernel find neighbours their
+    # own way instead.
+    kernel = modelkernels.kernel_for(config.backend)
+    population.use_kernel(kernel)
+    
+    if config.use_grid == 'Y' and config.schedule != 'sync' and \
+            kernel is None:
+        if config.skin > 0:
+            population.use_neighbour_list(config.neighbourhood, config.skin)
+        else:
+            population.use_grid(config.neighbourhood)
+    
+    #------------------------------------------------------
+    # Create wolves
+    # - All wolves will start as a pack at the same location
+    #------------------------------------------------------
+    for i in range(config.num_in_wolf_pack):
+        wolf_pack.append(agentframework.Wolf(environment, wolf_pack, 
+                                             rng=streams['wolves']))
+    
+    if on_start is not None:
+        on_start(agents, wolf_pack)
+    
+    #------------------------------------------------------
+    # Move the agents and wolves (j times each)
+    #------------------------------------------------------
+    run_start = time.perf_counter()
+    iterations = 0
+    
+    if config.workers > 1:
+        # Strips of the raster run by worker processes (see modelparallel)
+        iterations, num_of_agents_killed, strips = \
+            modelparallel.run_parallel(config, population, wolf_pack, 
+                                       streams['scheduler'], config.workers,
+                                       timer, on_iteration)
+    else:
+        for j in range(config.num_of_iterations):
+            if config.num_of_agents > num_of_agents_killed:
+                if timer is not None:
+                    timer.start_iteration(j)
+                
+                # Order the live Agents (dead ones are no longer held in 
+                # the live rows) and the wolves for this iteration
+                with modelprofile.phase(timer, 'shuffle'):
+                    order = scheduler.order(population)
+                    wolf_order = scheduler.wolf_order(len(wolf_pack))
+        
+                # Each live Agent moves 1 raster cell, eats at its new 
+                # location and interacts with neighbours if there is more 
+                # than 1 Agent, as the scheduler has them take turns.
+                scheduler.step(population, order, config.neighbourhood, 
+                               share=config.num_of_agents > 1, timer=timer)
+                
+                num_of_agents_killed = 0
+            
+                # Move 3 raster cells, all wolves in one batch.  A move 
+                # only changes the Wolf itself, so all wolves can move 
+                # before any of them hunts.
+                with modelprofile.phase(timer, 'wolf_move'):
+                    agentframework.move_wolves(
+                        [wolf_pack[k] for k in wolf_order.tolist()], 
+                        streams['wolves'].random(len(wolf_pack)))
+            
+                # let each wolf kill the Agents at its location
+                with modelprofile.phase(timer, 'hunt'):
+                    for k in wolf_order.tolist():
+                        wolf_pack[k].hunt(agents)
+                
+                        # accumulate wolf pack kills
+                        num_of_agents_killed += wolf_pack[k].kills
+                
+                iterations += 1
+                
+                if on_iteration is not None:
+                    on_iteration(iterations, config.num_of_iterations)
+            else:
+                # That is it!  All the Agent are dead.  No use carrying 
+                # on!
+                break
+        
+    if timer is not None:
+        timer.end_iteration()
+        
+    stats = {'iterations': iterations,
+             'agents_killed': num_of_agents_killed,
+             'agents_alive': config.num_of_agents - num_of_agents_killed,
+             'total_store': float(population.store[:len(population)].sum()),
+             'run_time': time.perf_counter() - run_start}
+    
+    if isinstance(population.grid, agentframework.NeighbourList):
+        stats['neighbour_rebuilds'] = population.grid.rebuilds
+        
+    if isinstance(environment, TiledEnvironment):
+        stats['tiles'] = environment.tile_stats()
+        
+    if config.workers > 1:
+        stats['strips'] = strips
+    
+    return Result(agents, wolf_pack, environment, stats)
 
 
 #----------------------------------------------------------
-# Now that we have the raster size, set the boundary 
-# limits and other mapping attributes
+# Output datasets
+# - out1.txt - environment raster data
+# - out2.txt - Agent store data
+# - out3.txt - Wolf data
 #----------------------------------------------------------
-plt.ylim(0, agents[0].y_boundary)
-plt.xlim(0, agents[0].x_boundary)
-plt.minorticks_on()
-plt.copper()
-plt.title('Agent Movements\nby Student 201388212')
-
-cross = lns.Line2D([], [], color='Black', marker='x', markersize=5, 
-                   linestyle='None')
-circle = lns.Line2D([], [], color='Black', marker='o', markersize=5, 
-                    linestyle='None')
-delta = lns.Line2D([], [], color='Black', marker='v', markersize=5, 
-                   linestyle='None')
-diamond = lns.Line2D([], [], color='Black', marker='D', markersize=5, 
-                     linestyle='None')
-
-agent_legend = plt.legend([cross, circle, delta, diamond],
-                          ['Agent Start', 'Agent End', 
-                           'Wolf Start', 'Wolf End'], 
-                          loc = 'center left', 
-                          bbox_to_anchor = (-0.5, 0.5))
-    
-plt.fig = plt.figure(1)
-plt.fig.set_size_inches(10, 6)
-plt.fig.subplots_adjust(top=0.9)
-plt.fig.savefig('legend_test.png', bbox_extra_artists=(agent_legend))
+def write_outputs(result, binary_out='N'):
+    '''
+    Output the datasets of a run (out1.txt, out2.txt and out3.txt, plus
+    out1.rbin if binary_out is Y).
+    '''
+    f1 = open('out1.txt', 'w', newline='')
+    f2 = open('out2.txt', 'a', newline='')
+    f3 = open('out3.txt', 'a', newline='')
+    
+    output1 = csv.writer(f1, delimiter=',', quoting=csv.QUOTE_NONNUMERIC)
+    output2 = csv.writer(f2, delimiter=',', quoting=csv.QUOTE_NONNUMERIC)
+    output3 = csv.writer(f3, delimiter=',', quoting=csv.QUOTE_NONNUMERIC)
+    
+    # Round as integer (to match input) finalised cells and output, a 
+    # strip of rows at a time
+    data = result.environment.data
+    
+    for y in range(0, len(data), OUTPUT_ROWS):
+        rows = data[y:y + OUTPUT_ROWS]
+        output1.writerows(rows.round().astype(int).tolist())
+    
+    # Round to 2 decimal places finalised stores
+    output2.writerow([round(agent.store,2) for agent in result.agents])
+    output3.writerow([wolf.kills for wolf in result.wolf_pack])
+    
+    f1.close() 
+    f2.close() 
+    f3.close()
+    
+    # Unrounded copy of the modified raster
+    if binary_out == 'Y':
+        save_raster(result.environment, 'out1.rbin')
 
 
 #----------------------------------------------------------
-# If plotting the start locations of each Agent & Wolf is
-# required, then plot each 
-# - Agent location with an 'x' and its allocated colour
-# - Wolf location with a white triangle (All wolves start
-#   at the same location then split up).
+# Plotting
 #----------------------------------------------------------
-if args.plot_start == 'Y':
-    for agent in agents:
-        plt.scatter(agent.x, agent.y, marker='x', color=agent.colour)
+def setup_figure(environment):
+    '''
+    Import matplotlib and set the boundary limits, legend and other 
+    mapping attributes of the figure.  Returns matplotlib.pyplot.
+    '''
+    import matplotlib.lines as lns
+    import matplotlib.pyplot as plt
+    
+    plt.ylim(0, environment.y_boundary)
+    plt.xlim(0, environment.x_boundary)
+    plt.minorticks_on()
+    plt.copper()
+    plt.title('Agent Movements\nby Student 201388212')
+    
+    cross = lns.Line2D([], [], color='Black', marker='x', markersize=5, 
+                       linestyle='None')
+    circle = lns.Line2D([], [], color='Black', marker='o', markersize=5, 
+                        linestyle='None')
+    delta = lns.Line2D([], [], color='Black', marker='v', markersize=5, 
+                       linestyle='None')
+    diamond = lns.Line2D([], [], color='Black', marker='D', markersize=5, 
+                         linestyle='None')
+    
+    agent_legend = plt.legend([cross, circle, delta, diamond],
+                              ['Agent Start', 'Agent End', 
+                               'Wolf Start', 'Wolf End'], 
+                              loc = 'center left', 
+                              bbox_to_anchor = (-0.5, 0.5))
         
-        if args.display_agents == 'Y':
-            print('Start -', agent) 
+    plt.fig = plt.figure(1)
+    plt.fig.set_size_inches(10, 6)
+    plt.fig.subplots_adjust(top=0.9)
+    plt.fig.savefig('legend_test.png', bbox_extra_artists=(agent_legend))
+    
+    return plt
 
-    for wolf in wolf_pack:
-        # Only need to plot once as the wolves start as a pack
-        if wolf.wolf_num == 1:
-            plt.scatter(wolf.x, wolf.y, marker='v', color='white')
-        
-        if args.display_wolves == 'Y':
-            print('Start -',  wolf) 
+
+def scatter_agents(plt, agents, marker):
+    '''
+    Plot every Agent (one collection), each in its own colour.
+    
+    Inputs:
+        - plt: matplotlib.pyplot
+        - agents: Agents to plot (views onto one AgentPopulation)
+        - marker: Marker of every Agent
+    '''
+    population = agents[0].population
+    n = len(population)
+    
+    return plt.scatter(population.x[:n], population.y[:n], marker=marker, 
+                       c=agentframework.PALETTE_RGBA[
+                           population.colour_index[:n]])
+
+
+def scatter_wolves(plt, wolf_pack, marker):
+    '''
+    Plot every Wolf (one collection) in white.
+    '''
+    return plt.scatter([wolf.x for wolf in wolf_pack], 
+                       [wolf.y for wolf in wolf_pack], marker=marker, 
+                       color='white')
 
 
 #----------------------------------------------------------
-# Move the agents and wolves (j times each)
+# Animation Class
 #----------------------------------------------------------
-for j in range(args.num_of_iterations):
-    if args.num_of_agents > num_of_agents_killed:
-        # Randomly shuffle the Agents before next iteration of moves
-        random.shuffle(agents)
-        random.shuffle(wolf_pack)
-    
-        for agent in agents: 
-            if agent.alive == 'Y':
-                # Use agent.agent_num as index as the agents_move, agents_eat
-                # and agents_share lists were not randomly shuffled.
+class Animation():
+    '''
+    Live view of a run.  The raster (and any start locations) are drawn 
+    once and kept as the background; every stride-th iteration only the
+    live Agents and the Wolves are drawn over it (blitted).
+    '''
+    def __init__(self, plt, environment, agents, wolf_pack, stride):
+        '''
+        Initialisation of the Animation instance with:
+            - Raster image and colour bar (drawn once)
+            - Agent and Wolf collections (redrawn each frame)
+            - Colour of each Agent
+            - Saved background
             
-                # Move 1 raster cell
-                agents_move[agent.agent_num-1]()   
+        Inputs:
+            - plt: matplotlib.pyplot set up by setup_figure
+            - environment: Environment raster at the start of the run
+            - agents: Agents of the run
+            - wolf_pack: Wolves of the run
+            - stride: Iterations between frames
+        '''
+        self.plt = plt
+        self.population = agents[0].population
+        self.wolf_pack = wolf_pack
+        self.stride = stride
+        self.canvas = plt.fig.canvas
+        self.axes = plt.gca()
         
-                # Eat at new location
-                agents_eat[agent.agent_num-1]()
+        self.image = plt.imshow(environment.data)
+        plt.colorbar().set_label('Elevation (m)')
         
-                # Interact with neighbours if there is more than 1 Agent
-                if args.num_of_agents > 1:
-                    agents_share[agent.agent_num-1](args.neighbourhood)
-            
-        num_of_agents_killed = 0
-
-        for wolf in wolf_pack:
-            # Use wolf.wolf_num as index as the wolf_pack_move and
-            # wolf_pack_hunt lists were not randomly shuffled.
-
-            # Move 3 raster cells
-            wolf_pack_move[wolf.wolf_num-1]()
+        self.agent_points = scatter_agents(plt, agents, 'o')
+        self.wolf_points = scatter_wolves(plt, wolf_pack, 'D')
+        self.agent_points.set_animated(True)
+        self.wolf_points.set_animated(True)
+        self.colours = agentframework.PALETTE_RGBA[
+            self.population.colour_index[:len(self.population)]]
         
-            # let the wolf kill the Agent if at the same location
-            wolf_pack_hunt[wolf.wolf_num-1](agents)
+        plt.show(block=False)
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(plt.fig.bbox)
+        self.frame()
+
+
+    def frame(self, iterations=0, num_of_iterations=None):
+        '''
+        Draw the live Agents and the Wolves over the background if this 
+        is a frame (every stride-th iteration).
+        '''
+        if iterations % self.stride != 0:
+            return
         
-            # accumulate wolf pack kills
-            num_of_agents_killed += wolf.kills
-    else:
-        # That is it!  All the Agent are dead.  No use carrying on!
-        break
+        population = self.population
+        n = len(population)
+        live = population.alive[:n]
+        
+        self.agent_points.set_offsets(
+            np.column_stack((population.x[:n][live], population.y[:n][live])))
+        self.agent_points.set_facecolor(self.colours[live])
+        self.wolf_points.set_offsets(
+            [(wolf.x, wolf.y) for wolf in self.wolf_pack])
+        
+        self.canvas.restore_region(self.background)
+        self.axes.draw_artist(self.agent_points)
+        self.axes.draw_artist(self.wolf_points)
+        self.canvas.blit(self.plt.fig.bbox)
+        self.canvas.flush_events()
+        
+        
+    def finish(self, environment):
+        '''
+        Leave the figure as a run without animation would: every Agent 
+        (alive or not) and Wolf at its finishing location over the 
+        modified raster.
+        '''
+        population = self.population
+        n = len(population)
+        
+        self.agent_points.set_offsets(
+            np.column_stack((population.x[:n], population.y[:n])))
+        self.agent_points.set_facecolor(self.colours)
+        self.agent_points.set_animated(False)
+        self.wolf_points.set_offsets(
+            [(wolf.x, wolf.y) for wolf in self.wolf_pack])
+        self.wolf_points.set_animated(False)
+        
+        self.image.set_data(environment.data)
+        self.image.autoscale()
+
 
-            
 #----------------------------------------------------------
-# Plot each Agent finishing location with a cirle using 
-# the same colour that was used to plot the Agent starting 
-# location
+# Command line processing
 #----------------------------------------------------------
-for agent in agents:
-    plt.scatter(agent.x, agent.y, marker='o', color=agent.colour)
+def main(argv=None, warm=None):
+    '''
+    Run the model from the command line: display, plot and output the 
+    results of run_model.  Returns the Result.
+    
+    Inputs:
+        - argv: Argument strings (defaults to the command line)
+        - warm: Dictionary kept between runs (by modelserver.py) holding 
+                the raster and default start locations for reuse while 
+                in.txt and the raster arguments are unchanged (None to 
+                load them every run)
+    '''
+    args = parse_arguments(argv)
+    
+    if args.display_params == 'Y':
+        print('Processed with the following arguments:' + 
+              ',\n - No. Agents: ' + str(args.num_of_agents) + 
+              ',\n - Use default Agent start locations: ' + 
+              args.agent_defaults + 
+              ',\n - No. Agent moves: ' + str(args.num_of_iterations) + 
+              ',\n - Neighbourhood Distance: ' + str(args.neighbourhood) + 
+              ',\n - No. Wolves: '+ str(args.num_in_wolf_pack) + 
+              ',\n - Plot starting locations: ' + args.plot_start + 
+              ',\n - Spatial grid index: ' + args.use_grid + 
+              ',\n - Neighbour list skin: ' + str(args.skin) + 
+              ',\n - Schedule: ' + args.schedule + 
+              ',\n - Backend: ' + 
+              modelkernels.resolve_backend(args.backend) + 
+              ',\n - Workers: ' + str(args.workers) + 
+              ',\n - Tile size: ' + str(args.tile_size) + 
+              ',\n - Tile cache (MB): ' + str(args.tile_cache) + 
+              ',\n - Binary raster cache: ' + args.raster_cache + 
+              ',\n - Binary raster output: ' + args.binary_out + 
+              ',\n - Headless: ' + args.headless + 
+              ',\n - Seed: ' + str(args.seed) + '.')
+    
+    if modelkernels.resolve_backend(args.backend) != args.backend:
+        print('Numba not installed - using the python backend.')
+    
+    # Per-phase timing only if a timing file is wanted
+    if args.profile_out != '':
+        timer = modelprofile.PhaseTimer(args.profile_every)
+    else:
+        timer = None
+    
+    # Plotting is skipped entirely in headless mode.  Parallel runs keep
+    # the Agents in the worker processes so cannot be animated.
+    plotting = args.headless != 'Y'
+    animating = plotting and args.animate > 0 and args.workers == 1
+    animation = None
+    frames = None
+    
+    #------------------------------------------------------
+    # Read in raster dataset and create environment
+    # - Reuses the binary copy (in.txt.rbin) if in.txt is unchanged
+    # - Reuses the warm raster if in.txt is unchanged since it was read
+    #------------------------------------------------------
+    if warm is not None:
+        stat = os.stat('in.txt')
+        raster_key = (os.getcwd(), stat.st_mtime_ns, stat.st_size, 
+                      args.raster_cache, args.tile_size, args.tile_cache)
+    
+    if warm is not None and warm.get('raster_key') == raster_key:
+        environment = warm['raster']
+    else:
+        try:
+            with modelprofile.phase(timer, 'load'):
+                environment = load_raster('in.txt', 
+                                          cache=args.raster_cache == 'Y',
+                                          tile=args.tile_size,
+                                          budget=args.tile_cache << 20)
+        except ValueError as err:
+            sys.exit(str(err))
+            
+        if warm is not None:
+            warm['raster_key'] = raster_key
+            warm['raster'] = environment
+        
+    if args.agent_defaults != 'Y':
+        start_locations = []
+    elif warm is not None and 'start_locations' in warm:
+        start_locations = warm['start_locations']
+    else:
+        start_locations = get_start_locations()
         
-    if args.display_agents == 'Y':
-        print('Finish -', agent) 
+        if warm is not None:
+            warm['start_locations'] = start_locations
     
-
-#----------------------------------------------------------
-# Plot each Wolf finishing location with a white diamond
-#----------------------------------------------------------
-for wolf in wolf_pack:
-    plt.scatter(wolf.x, wolf.y, marker='D', color='white')
+    #------------------------------------------------------
+    # Now that we have the raster size, set up the figure
+    #------------------------------------------------------
+    if plotting:
+        with modelprofile.phase(timer, 'plot'):
+            plt = setup_figure(environment)
+    
+    def show_start(agents, wolf_pack):
+        '''
+        If plotting the start locations of each Agent & Wolf is
+        required, then plot each 
+        - Agent location with an 'x' and its allocated colour
+        - Wolf location with a white triangle (All wolves start
+          at the same location then split up).
+          
+        Then report time taken to get ready (imports, arguments, 
+        raster and Agent / Wolf creation).
+        '''
+        nonlocal animation, frames
         
-    if args.display_wolves == 'Y':
-        print('Finish -', wolf) 
+        if args.plot_start == 'Y':
+            with modelprofile.phase(timer, 'plot'):
+                if plotting:
+                    scatter_agents(plt, agents, 'x')
+                    
+                    # Only need to plot one as the wolves start as a pack
+                    scatter_wolves(plt, wolf_pack[:1], 'v')
+                    
+                if args.display_agents == 'Y':
+                    for agent in agents:
+                        print('Start -', agent) 
+        
+                if args.display_wolves == 'Y':
+                    for wolf in wolf_pack:
+                        print('Start -',  wolf) 
+                    
+        if animating:
+            with modelprofile.phase(timer, 'plot'):
+                animation = Animation(plt, environment, agents, wolf_pack, 
+                                      args.animate)
+                
+        if args.frames_out != '':
+            with modelprofile.phase(timer, 'frames'):
+                frames = modelframes.FrameWriter(args.frames_out, 
+                                                 environment, 
+                                                 agents[0].population, 
+                                                 wolf_pack, 
+                                                 args.frames_every, 
+                                                 args.frames_max, 
+                                                 args.frames_size)
+                frames.snapshot(0)
+                    
+        if args.display_params == 'Y':
+            print('Startup time: ' + 
+                  str(round(time.perf_counter() - start_time, 3)) + 
+                  ' seconds.')
     
+    def show_progress(iterations, num_of_iterations):
+        '''
+        Print the iterations done (flushed, for the GUI to follow), 
+        draw the next frame of any animation and take any frame due.
+        '''
+        if args.progress == 'Y':
+            print('Iteration ' + str(iterations) + ' of ' + 
+                  str(num_of_iterations), flush=True)
+            
+        if animation is not None:
+            with modelprofile.phase(timer, 'plot'):
+                animation.frame(iterations, num_of_iterations)
+                
+        if frames is not None:
+            with modelprofile.phase(timer, 'frames'):
+                frames.snapshot(iterations)
+        
+    try:
+        result = run_model(args, environment, start_locations, show_start, 
+                           timer=timer, 
+                           on_iteration=show_progress 
+                           if args.progress == 'Y' or animating or 
+                           args.frames_out != '' else None)
+    finally:
+        # Wait for the frames still being drawn
+        if frames is not None:
+            with modelprofile.phase(timer, 'frames'):
+                frames.close()
+                
+    if frames is not None:
+        print(str(frames.frames) + ' frames written to ' + args.frames_out)
+        
+        if args.frames_video != '':
+            if modelframes.encode(args.frames_out, args.frames_video,
+                                  frames=frames.frames):
+                print('Video written to ' + args.frames_video)
+            else:
+                print('ffmpeg not installed - no video written.')
+    
+    if args.display_params == 'Y' and 'neighbour_rebuilds' in result.stats:
+        print('Neighbour list rebuilds: ' + 
+              str(result.stats['neighbour_rebuilds']) + ' in ' + 
+              str(result.stats['iterations']) + ' iterations.')
+        
+    if args.display_params == 'Y' and 'tiles' in result.stats:
+        print('Tile cache: ' + 
+              ', '.join(name + ' ' + str(count) for name, count in 
+                        result.stats['tiles'].items()) + '.')
+    
+    with modelprofile.phase(timer, 'plot'):
+        #--------------------------------------------------
+        # Plot each Agent finishing location with a cirle using 
+        # the same colour that was used to plot the Agent starting 
+        # location, and each Wolf finishing location with a white 
+        # diamond, over the finalised environment (already in the 
+        # figure if animated)
+        #--------------------------------------------------
+        if animation is not None:
+            animation.finish(result.environment)
+        elif plotting:
+            scatter_agents(plt, result.agents, 'o')
+            scatter_wolves(plt, result.wolf_pack, 'D')
+            plt.imshow(result.environment.data)
+            plt.colorbar().set_label('Elevation (m)')
+            
+        if args.display_agents == 'Y':
+            for agent in result.agents:
+                print('Finish -', agent) 
+            
+        if args.display_wolves == 'Y':
+            for wolf in result.wolf_pack:
+                print('Finish -', wolf) 
+            
+    # Display plotting (waits for the window to be closed)
+    if plotting:
+        plt.show()
+    
+    with modelprofile.phase(timer, 'output'):
+        write_outputs(result, args.binary_out)
+        
+    if timer is not None:
+        timer.write(args.profile_out)
+        
+    return result
 
-#----------------------------------------------------------
-# Display finalised environment and plotting
-#----------------------------------------------------------
-plt.imshow(environment)
-plt.colorbar().set_label('Elevation (m)')
-plt.show()
-
-
-#----------------------------------------------------------
-# Output datasets
-# - out1.txt - environment raster data
-# - out2.txt - Agent store data
-# - out3.txt - Wolf data
-#----------------------------------------------------------
-f1 = open('out1.txt', 'w', newline='')
-f2 = open('out2.txt', 'a', newline='')
-f3 = open('out3.txt', 'a', newline='')
-
-output1 = csv.writer(f1, delimiter=',', quoting=csv.QUOTE_NONNUMERIC)
-output2 = csv.writer(f2, delimiter=',', quoting=csv.QUOTE_NONNUMERIC)
-output3 = csv.writer(f3, delimiter=',', quoting=csv.QUOTE_NONNUMERIC)
-
-for row in environment: 
-    # Round as integer (to match input) finalised cells and output
-    output1.writerow(list(map(lambda row_elem: round(row_elem), row)))
 
-# Round to 2 decimal places finalised stores
-output2.writerow([round(agent.store,2) for agent in agents])
-output3.writerow([wolf.kills for wolf in wolf_pack])
+def stop(signum, frame):
+    '''
+    End the run when asked to terminate (e.g. Cancel in the GUI), so any
+    worker processes are stopped on the way out
+    '''
+    sys.exit('Run cancelled.')
 
-f1.close() 
-f2.close() 
-f3.close() 
 
+if __name__ == '__main__':
+    signal.signal(signal.SIGTERM, stop)
+    main()
@@ -0,0 +1,522 @@
+'''
+Filename: modelparallel.py
+
+Contains:
+- Classes: Strip
+- Methods (Strip): iterate, move_agents, eat, share, move_wolves, hunt,
+                   exchange, migrate, halo, state.
+- Functions: mix, uniform_draws, strip_bounds, select, join, gather,
+             run_strip, run_parallel
+
+Parallel runs by domain decomposition (--workers n):
+    The toroidal raster is split into n strips of whole rows, one per
+    worker process.  Each worker holds its strip of the raster and owns
+    the Agents and Wolves inside it.  Every iteration:
+        - Agents move; any leaving the strip migrate to the worker above
+          or below (round the raster).
+        - Agents eat from the strip.
+        - Agents share: each worker sends the live Agents within
+          --distance rows of its edges to the workers either side (the
+          halo), then each store becomes the mean of its own and its
+          neighbours' stores as they were before any sharing.
+        - Wolves move, migrating as the Agents do, then hunt the Agents
+          on their cell in creation order.
+    These are the rules of the synchronous scheduler (--schedule sync).
+
+    Neighbouring workers exchange migrants and halos directly through
+    queues; the main process only starts each iteration, prints the kills
+    and assembles the Agents, Wolves and raster at the end.
+
+    Moves are drawn from (seed, iteration, Agent or Wolf number) rather
+    than one shared generator, so a seeded run gives the same results
+    whatever the number of workers (2 or more).  --workers 1 runs the
+    synchronous scheduler in the main process instead, drawing its moves
+    from the run's generators, so its results differ.
+'''
+import math
+import queue
+import multiprocessing
+import numpy as np
+import agentframework
+import modelprofile
+from environment import Environment
+
+# Wolf record fields (each an array, one entry per Wolf)
+wolf_fields = ('number', 'y', 'x', 'kills')
+
+# Most rows moved in one iteration (a Wolf moves 3)
+MAX_STEP = 3
+
+# SplitMix64 constants
+GOLDEN = 0x9E3779B97F4A7C15
+MASK = (1 << 64) - 1
+
+
+#----------------------------------------------------------
+# Strip Class
+#----------------------------------------------------------
+class Strip():
+    '''
+    The rows of the raster held by one worker, with the Agents and Wolves
+    on them.
+    '''
+    def __init__(self, index, bounds, data, neighbourhood, keys, agents,
+                 wolves, queues):
+        '''
+        Initialisation of the Strip instance with:
+            - Strip of the raster and its place in the whole raster
+            - Agent and Wolf records
+            - Queues to the workers above and below
+
+        Inputs:
+            - index: Number of the strip (0 at the top)
+            - bounds: First row of every strip, then the raster height
+            - data: Rows of the raster in the strip
+            - neighbourhood: Distance considered to be a neighbour
+            - keys: Keys of the Agent and Wolf move draws
+            - agents, wolves: Records (dictionaries of arrays) of the
+                              Agents and Wolves in the strip
+            - queues: (to above, to below, from above, from below) queues
+        '''
+        self.index = index
+        self.bounds = np.asarray(bounds)
+        self.top = int(bounds[index])
+        self.bottom = int(bounds[index + 1])
+        self.height = int(bounds[-1])
+        self.width = data.shape[1]
+        self.environment = Environment(data)
+        self.neighbourhood = neighbourhood
+        self.agent_key, self.wolf_key = keys
+        self.agents = agents
+        self.wolves = wolves
+        self.to_above, self.to_below, self.from_above, self.from_below = \
+            queues
+
+
+    def iterate(self, j, share=True):
+        '''
+        Run iteration j of the strip's Agents and Wolves and return the
+        kills made, as (Wolf number, y, x, kills) after each kill.
+        '''
+        self.move_agents(j)
+        self.eat()
+
+        if share:
+            self.share()
+
+        self.move_wolves(j)
+
+        return self.hunt()
+
+
+    def move_agents(self, j):
+        '''
+        Move every live Agent one diagonal cell (the rule of
+        AgentPopulation.plan_moves), then migrate those leaving the strip
+        '''
+        agents = self.agents
+        live = agents['alive']
+        draws = uniform_draws(self.agent_key, j, agents['number'][live], 2)
+        steps = np.where(draws < 0.5, 1, -1)
+        agents['y'][live] = (agents['y'][live] + steps[:, 0]) % self.height
+        agents['x'][live] = (agents['x'][live] + steps[:, 1]) % self.width
+        agents['moves'][live] += 1
+
+        self.agents = self.migrate(agents)
+
+
+    def eat(self):
+        '''
+        Every live Agent nibbles at the strip, Agents sharing a cell in
+        number order (see agentframework.eat_cells)
+        '''
+        agents = self.agents
+        live = np.flatnonzero(agents['alive'])
+        cells = (agents['y'][live] - self.top) * self.width + \
+                agents['x'][live]
+        agents['store'][live] = agentframework.eat_cells(
+            self.environment, cells, agents['store'][live])
+
+
+    def share(self):
+        '''
+        Every live Agent shares at once with its live neighbours in the
+        strip and the halo (the rule of AgentPopulation.share_all)
+        '''
+        agents = self.agents
+        live = np.flatnonzero(agents['alive'])
+        own = {field: agents[field][live] 
+               for field in ('number', 'y', 'x', 'store')}
+        halo = self.halo(own)
+        own['own'] = np.ones(len(live), dtype=bool)
+        halo['own'] = np.zeros(len(halo['number']), dtype=bool)
+
+        # Own and halo Agents in number order, so each Agent's neighbours
+        # are added up in the same order however the raster is split
+        both = join([own, halo])
+        y = both['y']
+        x = both['x']
+        store = both['store']
+        first, second = agentframework.pairs_within(y, x, self.height,
+                                                    self.width,
+                                                    self.neighbourhood)
+
+        # Straight line neighbours of the strip's own Agents only
+        dy = y[second] - y[first]
+        dx = x[second] - x[first]
+        near = (dy * dy + dx * dx <= 
+                self.neighbourhood * self.neighbourhood) & both['own'][first]
+        first = first[near]
+        second = second[near]
+
+        totals = np.bincount(first, weights=store[second], 
+                             minlength=len(store))
+        counts = np.bincount(first, minlength=len(store))
+        shared = (store + totals) / (1 + counts)
+        agents['store'][live] = shared[both['own']]
+
+
+    def move_wolves(self, j):
+        '''
+        Move every Wolf 3 cells North, East, South or West (the rule of
+        agentframework.move_wolves), then migrate those leaving the strip
+        '''
+        wolves = self.wolves
+        where_to = uniform_draws(self.wolf_key, j, wolves['number'], 1)
+        direction = (where_to[:, 0] * 4).astype(np.intp)
+        wolves['y'] = (wolves['y'] + np.array([3, 0, -3, 0])[direction]) % \
+                      self.height
+        wolves['x'] = (wolves['x'] + np.array([0, 3, 0, -3])[direction]) % \
+                      self.width
+
+        self.wolves = self.migrate(wolves)
+
+
+    def hunt(self):
+        '''
+        Each Wolf in creation order kills the live Agents on its cell.
+
+        Returns (Wolf number, y, x, kills) after each kill.
+        '''
+        agents = self.agents
+        wolves = self.wolves
+        kills = []
+
+        for k in range(len(wolves['number'])):
+            wolf_y = wolves['y'][k]
+            wolf_x = wolves['x'][k]
+            prey = np.flatnonzero(agents['alive'] &
+                                  (agents['y'] == wolf_y) &
+                                  (agents['x'] == wolf_x))
+
+            for i in prey.tolist():
+                agents['alive'][i] = False
+                wolves['kills'][k] += 1
+                kills.append((int(wolves['number'][k]), int(wolf_y),
+                              int(wolf_x), int(wolves['kills'][k])))
+
+        return kills
+
+
+    def exchange(self, up, down):
+        '''
+        Send up and down to the workers above and below and return what
+        they sent back (from above, from below)
+        '''
+        self.to_above.put(up)
+        self.to_below.put(down)
+
+        return self.from_above.get(), self.from_below.get()
+
+
+    def migrate(self, records):
+        '''
+        Send the records outside the strip to the strip above or below
+        and return the rest with those received, in number order.
+        '''
+        owner = np.searchsorted(self.bounds, records['y'], 'right') - 1
+        strips = len(self.bounds) - 1
+        stay = owner == self.index
+        below = ~stay & (owner == (self.index + 1) % strips)
+        above = ~stay & ~below
+
+        from_above, from_below = self.exchange(
+            select(records, np.flatnonzero(above)),
+            select(records, np.flatnonzero(below)))
+
+        return join([select(records, np.flatnonzero(stay)), from_above,
+                     from_below])
+
+
+    def halo(self, live):
+        '''
+        Send the live Agent records (number, y, x and store) within the 
+        neighbourhood of the top and bottom rows to the strips above and 
+        below and return the halo received (Agents of other strips only, 
+        once each).
+        '''
+        reach = int(math.ceil(self.neighbourhood))
+        from_above, from_below = self.exchange(
+            select(live, np.flatnonzero(live['y'] < self.top + reach)),
+            select(live, np.flatnonzero(live['y'] >= self.bottom - reach)))
+
+        halo = join([from_above, from_below])
+
+        # A strip may be both above and below, or be its own neighbour
+        keep = np.r_[True, halo['number'][1:] != halo['number'][:-1]] & \
+               ~np.isin(halo['number'], self.agents['number'])
+
+        return select(halo, np.flatnonzero(keep))
+
+
+    def state(self):
+        '''
+        Agent and Wolf records and raster rows of the strip
+        '''
+        return {'index': self.index,
+                'agents': self.agents,
+                'wolves': self.wolves,
+                'data': self.environment.data}
+
+
+#----------------------------------------------------------
+# Functions
+#----------------------------------------------------------
+def mix(z):
+    '''
+    SplitMix64 finaliser of an array of uint64
+    '''
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+
+    return z ^ (z >> np.uint64(31))
+
+
+def uniform_draws(key, iteration, numbers, count):
+    '''
+    Uniform [0, 1) draws, count per number, that depend only on key,
+    iteration and the numbers (a counter based generator).
+
+    Inputs:
+        - key: Integer key of the run
+        - iteration: Iteration number
+        - numbers: Agent or Wolf numbers
+        - count: Draws per number
+    '''
+    base = mix(np.array([(key + (iteration + 1) * GOLDEN) & MASK],
+                        dtype=np.uint64))
+    numbers = np.asarray(numbers, dtype=np.uint64)
+    z = base + numbers[:, None] * np.uint64(count) + \
+        np.arange(count, dtype=np.uint64)
+
+    return (mix(z + np.uint64(GOLDEN)) >> np.uint64(11)) * 2.0**-53
+
+
+def strip_bounds(height, workers, neighbourhood):
+    '''
+    First row of each strip, then the raster height.  Strips are at least
+    the neighbourhood (and a Wolf move) high, so halos and migrants only
+    come from the strips either side; fewer strips are used if need be.
+    '''
+    least = max(MAX_STEP, int(math.ceil(neighbourhood)))
+    strips = max(1, min(workers, height // least))
+
+    return [height * k // strips for k in range(strips + 1)]
+
+
+def select(records, index):
+    '''
+    Records at the positions index (copies)
+    '''
+    return {field: values[index] for field, values in records.items()}
+
+
+def join(records):
+    '''
+    Records of several lists joined together in number order
+    '''
+    joined = {field: np.concatenate([part[field] for part in records])
+              for field in records[0]}
+
+    return select(joined, np.argsort(joined['number'], kind='stable'))
+
+
+def gather(reports, processes):
+    '''
+    One report from each worker process (raises RuntimeError if a worker
+    has stopped before sending its report)
+    '''
+    results = []
+
+    while len(results) < len(processes):
+        try:
+            results.append(reports.get(timeout=1))
+        except queue.Empty:
+            for k, process in enumerate(processes):
+                if not process.is_alive():
+                    raise RuntimeError('Strip worker ' + str(k) + 
+                                       ' stopped (exit code ' + 
+                                       str(process.exitcode) + ').')
+
+    return results
+
+
+def run_strip(index, bounds, data, neighbourhood, keys, agents, wolves,
+              queues, control, reports, share):
+    '''
+    Worker process of one strip: runs an iteration each time the main
+    process asks, reporting its kills and the total kills of its Wolves,
+    then reports the state of the strip when told to stop.
+    '''
+    strip = Strip(index, bounds, data, neighbourhood, keys, agents, wolves,
+                  queues)
+    j = 0
+
+    while control.get():
+        kills = strip.iterate(j, share)
+        reports.put((index, kills, int(strip.wolves['kills'].sum())))
+        j += 1
+
+    reports.put((index, strip.state()))
+
+
+def run_parallel(config, population, wolf_pack, rng, workers, timer=None,
+                 on_iteration=None):
+    '''
+    Run the iterations of a model run over strips of the raster in worker
+    processes, then copy the final Agents, Wolves and raster back.
+
+    Inputs:
+        - config: Parameters (as returned by modelmain.parse_arguments)
+        - population: AgentPopulation of the run (on its own copy of the
+                      Environment)
+        - wolf_pack: Wolves of the run
+        - rng: numpy.random.Generator the move draw keys are taken from
+        - workers: Number of worker processes (fewer if the raster is
+                   too small)
+        - timer: modelprofile.PhaseTimer to time each iteration with
+                 (None for no timing)
+        - on_iteration: Function called with (iterations done,
+                        config.num_of_iterations) after each iteration
+
+    Returns (iterations, number of Agents killed, number of strips).
+    '''
+    environment = population.environment
+    height, width = environment.shape
+    bounds = strip_bounds(height, workers, config.neighbourhood)
+    strips = len(bounds) - 1
+    keys = [int(key) for key in rng.integers(0, 2**63, size=2)]
+
+    agents = {'number': np.arange(len(population)),
+              'y': population.y[:len(population)].copy(),
+              'x': population.x[:len(population)].copy(),
+              'store': population.store[:len(population)].copy(),
+              'moves': population.moves[:len(population)].copy(),
+              'alive': population.alive[:len(population)].copy()}
+    wolves = {'number': np.array([wolf.wolf_num for wolf in wolf_pack],
+                                 dtype=np.int64),
+              'y': np.array([wolf.y for wolf in wolf_pack], dtype=np.int64),
+              'x': np.array([wolf.x for wolf in wolf_pack], dtype=np.int64),
+              'kills': np.array([wolf.kills for wolf in wolf_pack],
+                                dtype=np.int64)}
+    agent_owner = np.searchsorted(bounds, agents['y'], 'right') - 1
+    wolf_owner = np.searchsorted(bounds, wolves['y'], 'right') - 1
+
+    # Queues into each strip from the strips above and below
+    from_above = [multiprocessing.Queue() for k in range(strips)]
+    from_below = [multiprocessing.Queue() for k in range(strips)]
+    controls = [multiprocessing.Queue() for k in range(strips)]
+    reports = multiprocessing.Queue()
+    processes = []
+
+    for k in range(strips):
+        queues = (from_below[(k - 1) % strips], from_above[(k + 1) % strips],
+                  from_above[k], from_below[k])
+        process = multiprocessing.Process(
+            target=run_strip,
+            args=(k, bounds, environment[bounds[k]:bounds[k + 1]],
+                  config.neighbourhood, keys,
+                  select(agents, np.flatnonzero(agent_owner == k)),
+                  select(wolves, np.flatnonzero(wolf_owner == k)),
+                  queues, controls[k], reports, config.num_of_agents > 1),
+            daemon=True)
+        process.start()
+        processes.append(process)
+
+    iterations = 0
+    num_of_agents_killed = 0
+    finished = False
+
+    try:
+        for j in range(config.num_of_iterations):
+            if config.num_of_agents <= num_of_agents_killed:
+                # That is it!  All the Agent are dead.
+                break
+
+            if timer is not None:
+                timer.start_iteration(j)
+
+            with modelprofile.phase(timer, 'step'):
+                for control in controls:
+                    control.put(True)
+
+                results = sorted(gather(reports, processes))
+
+            # Kills are printed as the Wolves would (in strip order)
+            num_of_agents_killed = 0
+
+            for index, kills, total in results:
+                for number, wolf_y, wolf_x, wolf_kills in kills:
+                    wolf = wolf_pack[number - 1]
+                    wolf.y, wolf.x, wolf.kills = wolf_y, wolf_x, wolf_kills
+                    print('Kill -', wolf)
+
+                num_of_agents_killed += total
+
+            iterations += 1
+
+            if on_iteration is not None:
+                on_iteration(iterations, config.num_of_iterations)
+
+        for control in controls:
+            control.put(False)
+
+        states = gather(reports, processes)
+        finished = True
+    finally:
+        # Workers are stopped straight away if the run was stopped part
+        # way (e.g. cancelled) as they are waiting for the next iteration
+        for process in processes:
+            process.join(timeout=10 if finished else 0)
+
+            if process.is_alive():
+                process.terminate()
+
+    #------------------------------------------------------
+    # Assemble the final Agents, Wolves and raster
+    #------------------------------------------------------
+    for index, state in states:
+        strip_agents = state['agents']
+        rows = strip_agents['number']
+        population.y[rows] = strip_agents['y']
+        population.x[rows] = strip_agents['x']
+        population.store[rows] = strip_agents['store']
+        population.moves[rows] = strip_agents['moves']
+        population.alive[rows] = strip_agents['alive']
+
+        for number, wolf_y, wolf_x, kills in zip(
+                *[state['wolves'][field].tolist() for field in wolf_fields]):
+            wolf = wolf_pack[number - 1]
+            wolf.y, wolf.x, wolf.kills = wolf_y, wolf_x, kills
+
+        environment[bounds[index]:bounds[index + 1]] = state['data']
+
+    # Rebuild the live rows from the copied alive flags
+    alive = np.flatnonzero(population.alive[:len(population)])
+    population.alive[:len(population)] = False
+    population.live_count = 0
+
+    for i in alive.tolist():
+        population.revive(i)
+
+    return iterations, num_of_agents_killed, strips
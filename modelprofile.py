@@ -0,0 +1,154 @@
+'''
+Filename: modelprofile.py
+
+Contains:
+- Classes: PhaseTimer
+- Methods (PhaseTimer): start_iteration, end_iteration, phase, add,
+                        summary, write.
+- Functions: phase
+
+Per-phase wall time and call counts of a model run (loading, moving,
+eating, sharing, hunting, shuffling, plotting and output).  Iteration
+phases may be sampled every k-th iteration.  Nothing is timed, and
+nothing is called, if no PhaseTimer is given to the model.
+'''
+import json
+import time
+import contextlib
+
+# Shared do-nothing context for phases that are not being timed
+no_timing = contextlib.nullcontext()
+
+
+#----------------------------------------------------------
+# PhaseTimer Class
+#----------------------------------------------------------
+class PhaseTimer():
+    '''
+    Collects per-iteration and cumulative wall time and call counts of
+    each named phase.
+    '''
+    def __init__(self, every=1):
+        '''
+        Initialisation of the PhaseTimer instance with:
+            - Sampling interval
+            - Empty totals, counts and trace events
+
+        Inputs:
+            - every: Time iteration phases every k-th iteration only
+        '''
+        self.every = every
+        self.active = True
+        self.iteration = None
+        self.sampled = 0
+        self.totals = {}
+        self.calls = {}
+        self.per_iteration = {}
+        self.events = []
+        self.origin = time.perf_counter()
+
+
+    def start_iteration(self, j):
+        '''
+        Start iteration j (sets whether its phases are timed)
+        '''
+        self.iteration = j
+        self.active = (j % self.every == 0)
+
+        if self.active:
+            self.sampled += 1
+
+
+    def end_iteration(self):
+        '''
+        Back to timing phases outside the iterations
+        '''
+        self.iteration = None
+        self.active = True
+
+
+    def phase(self, name):
+        '''
+        Context timing the enclosed code as one call of phase name
+        '''
+        if not self.active:
+            return no_timing
+
+        return self.timed(name)
+
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        '''
+        Context timing the enclosed code (see phase)
+        '''
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.add(name, start, time.perf_counter() - start)
+
+
+    def add(self, name, start, seconds, calls=1):
+        '''
+        Record calls of phase name taking seconds in all, from start
+        (a time.perf_counter value).
+        '''
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + calls
+
+        if self.iteration is not None:
+            per_iteration = self.per_iteration.setdefault(name, {})
+            per_iteration[self.iteration] = \
+                per_iteration.get(self.iteration, 0.0) + seconds
+
+        self.events.append((name, start - self.origin, seconds,
+                            self.iteration))
+
+
+    def summary(self):
+        '''
+        Cumulative and per-iteration times of each phase (dictionary)
+        '''
+        return {'every': self.every,
+                'sampled_iterations': self.sampled,
+                'phases': {name: {'seconds': self.totals[name],
+                                  'calls': self.calls[name],
+                                  'per_iteration':
+                                      {str(j): seconds for j, seconds in
+                                       self.per_iteration.get(name,
+                                                              {}).items()}}
+                           for name in self.totals}}
+
+
+    def write(self, path):
+        '''
+        Write the timings to path: a Chrome trace (chrome://tracing or
+        Perfetto) if path ends with .trace.json, otherwise the summary.
+        '''
+        if path.endswith('.trace.json'):
+            output = {'traceEvents':
+                      [{'name': name, 'ph': 'X', 'pid': 1, 'tid': 1,
+                        'ts': start * 1e6, 'dur': seconds * 1e6,
+                        'args': {'iteration': iteration}}
+                       for name, start, seconds, iteration in self.events],
+                      'displayTimeUnit': 'ms'}
+        else:
+            output = self.summary()
+
+        with open(path, 'w') as f:
+            json.dump(output, f, indent=1)
+
+
+#----------------------------------------------------------
+# Functions
+#----------------------------------------------------------
+def phase(timer, name):
+    '''
+    timer.phase(name), or a do-nothing context if timer is None
+    '''
+    if timer is None:
+        return no_timing
+
+    return timer.phase(name)
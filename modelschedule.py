@@ -0,0 +1,142 @@
+'''
+Filename: modelschedule.py
+
+Contains:
+- Classes: RandomSequential, FixedOrder, Synchronous
+- Methods (each Class): order, wolf_order, step.
+- Functions: make_scheduler
+
+Update schedulers - the order the Agents and Wolves of a run act in each
+iteration:
+    - random - Random-sequential: Agents act one at a time (move, eat and
+               share) in a fresh random permutation of the live Agents,
+               and Wolves hunt in a random order.
+    - fixed - Agents act one at a time and Wolves hunt in creation order.
+    - sync - Synchronous: every Agent moves, then every Agent eats, then
+             every Agent shares, each phase reading the state the last
+             one left and run as one batch over the population.  Wolves
+             hunt in creation order.
+'''
+import numpy as np
+
+# Scheduler names accepted by make_scheduler (--schedule)
+schedules = ['random', 'fixed', 'sync']
+
+
+#----------------------------------------------------------
+# RandomSequential Class
+#----------------------------------------------------------
+class RandomSequential():
+    '''
+    Agents act in turn in a random permutation of the live rows, drawn
+    again every iteration.
+    '''
+    def __init__(self, rng):
+        '''
+        Initialisation of the RandomSequential instance with:
+            - Random number generator
+            - Wolf order (set up on first use)
+
+        Inputs:
+            - rng: numpy.random.Generator the permutations are drawn from
+        '''
+        self.rng = rng
+        self.wolves = None
+
+
+    def order(self, population):
+        '''
+        Rows of the live Agents in the order they act this iteration
+        '''
+        return self.rng.permutation(population.live_rows())
+
+
+    def wolf_order(self, num_in_wolf_pack):
+        '''
+        Positions in the wolf pack in the order the Wolves hunt this
+        iteration (the last order shuffled again)
+        '''
+        if self.wolves is None or len(self.wolves) != num_in_wolf_pack:
+            self.wolves = np.arange(num_in_wolf_pack)
+
+        self.rng.shuffle(self.wolves)
+
+        return self.wolves
+
+
+    def step(self, population, order, neighbourhood, share=True,
+             timer=None):
+        '''
+        Run one iteration of the Agents in order (see
+        AgentPopulation.step)
+        '''
+        population.step(order, neighbourhood, share, timer)
+
+
+#----------------------------------------------------------
+# FixedOrder Class
+#----------------------------------------------------------
+class FixedOrder(RandomSequential):
+    '''
+    Agents act in turn in row (creation) order every iteration.
+    '''
+    def __init__(self, rng=None):
+        '''
+        Initialisation of the FixedOrder instance (no random draws)
+        '''
+        super().__init__(rng)
+
+
+    def order(self, population):
+        '''
+        Rows of the live Agents in row order
+        '''
+        return np.sort(population.live_rows())
+
+
+    def wolf_order(self, num_in_wolf_pack):
+        '''
+        Positions in the wolf pack in creation order
+        '''
+        return np.arange(num_in_wolf_pack)
+
+
+#----------------------------------------------------------
+# Synchronous Class
+#----------------------------------------------------------
+class Synchronous(FixedOrder):
+    '''
+    Every Agent moves, then every Agent eats, then every Agent shares,
+    each phase as one batch.
+    '''
+    def step(self, population, order, neighbourhood, share=True,
+             timer=None):
+        '''
+        Run one synchronous iteration of the live Agents (see
+        AgentPopulation.step_synchronous; order is not needed)
+        '''
+        population.step_synchronous(neighbourhood, share, timer)
+
+
+#----------------------------------------------------------
+# Functions
+#----------------------------------------------------------
+def make_scheduler(name, rng=None):
+    '''
+    Scheduler for a name in schedules.
+
+    Inputs:
+        - name: random, fixed or sync
+        - rng: numpy.random.Generator (only used by random)
+    '''
+    if name == 'random':
+        return RandomSequential(rng)
+
+    if name == 'fixed':
+        return FixedOrder()
+
+    if name == 'sync':
+        return Synchronous()
+
+    raise ValueError('Unknown schedule ' + str(name) + ' (must be one of ' +
+                     ', '.join(schedules) + ').')
@@ -0,0 +1,407 @@
+'''
+Agent model server
+
+Filename: modelserver.py
+
+Called by:
+    - Command line
+    - modelhome.py (GUI front-end)
+    - modelmain.py (hands its run to the server if one is running)
+
+Contains:
+- Classes: Output, Server
+- Methods: write, flush (Output); serve, handle, watch, stop (Server)
+- Functions: read_address, wanted, forward, start, stop_server
+
+A long lived process that keeps the model warm between runs: the imports
+(NumPy, matplotlib, requests and bs4), the parsed raster and the default
+Agent start locations.  modelmain.py hands its arguments to the server
+over a local socket when one is running in the same folder, so second and
+later runs skip the interpreter start up, imports and raster parsing.
+Output is passed back to modelmain.py as it is printed.
+
+Input:
+    - Optional arguments:
+        - stop - Stop the server running in this folder
+
+Output:
+    - .modelserver - Address and key of the running server (removed when
+                     the server stops)
+'''
+import os
+import sys
+import json
+import time
+import signal
+import secrets
+import argparse
+import threading
+import subprocess
+import _thread
+from multiprocessing.connection import Listener, Client, \
+                                       AuthenticationError
+
+# Address and key of the server running in a folder
+ADDRESS_FILE = '.modelserver'
+
+
+#----------------------------------------------------------
+# Output Class
+#----------------------------------------------------------
+class Output():
+    '''
+    Stand in for sys.stdout / sys.stderr during a run that passes what is
+    printed to the client.
+    '''
+    def __init__(self, conn, kind):
+        '''
+        Initialisation of the Output instance with:
+            - Connection to the client
+            - Kind of output (out or err)
+        '''
+        self.conn = conn
+        self.kind = kind
+
+
+    def write(self, text):
+        '''
+        Send text to the client (dropped if the client has gone).
+        '''
+        if text != '':
+            try:
+                self.conn.send((self.kind, text))
+            except OSError:
+                pass
+
+        return len(text)
+
+
+    def flush(self):
+        '''
+        Nothing to flush (every write is sent straight away).
+        '''
+        pass
+
+
+#----------------------------------------------------------
+# Server Class
+#----------------------------------------------------------
+class Server():
+    '''
+    Runs modelmain.main for each request, one at a time, with the raster
+    and start locations kept (in warm) between runs.
+
+    Requests (tuples sent over the connection):
+        - ('run', folder, arguments) - Run the model in folder
+        - ('stop',) - Stop the server
+
+    Replies to a run:
+        - ('out', text) / ('err', text) - Printed output, as printed
+        - ('done', exit status, stats) - End of the run (stats is
+                                         Result.stats, {} if it failed)
+    '''
+    def __init__(self, address=('localhost', 0)):
+        '''
+        Initialisation of the Server instance with:
+            - Listener on a free local port with a random key
+            - Warm state kept between runs
+            - Lock so a cancel never lands outside its run
+        '''
+        self.authkey = secrets.token_bytes(32)
+        self.listener = Listener(address, authkey=self.authkey)
+        self.warm = {}
+        self.lock = threading.Lock()
+        self.stopping = False
+
+
+    def serve(self):
+        '''
+        Write the address file and handle requests until stopped.
+        '''
+        address = self.listener.address
+
+        with open(ADDRESS_FILE, 'w') as f:
+            os.chmod(ADDRESS_FILE, 0o600)
+            json.dump({'address': list(address),
+                       'authkey': self.authkey.hex(),
+                       'pid': os.getpid()}, f)
+
+        print('Model server on ' + str(address[0]) + ':' + str(address[1]) +
+              ' (pid ' + str(os.getpid()) + ')', flush=True)
+
+        try:
+            while not self.stopping:
+                try:
+                    conn = self.listener.accept()
+                except (OSError, AuthenticationError):
+                    continue
+
+                try:
+                    self.handle(conn)
+                except KeyboardInterrupt:
+                    # A cancel landing just after its run ended
+                    pass
+                except (OSError, EOFError):
+                    # Client gone
+                    pass
+                finally:
+                    conn.close()
+        except KeyboardInterrupt:
+            # Terminated (or Ctrl-C) while waiting for a request
+            pass
+        finally:
+            self.listener.close()
+
+            if os.path.exists(ADDRESS_FILE):
+                os.remove(ADDRESS_FILE)
+
+            print('Model server stopped', flush=True)
+
+
+    def handle(self, conn):
+        '''
+        Carry out one request.  A run is cancelled (KeyboardInterrupt in
+        the model, which stops any worker processes) if the client closes
+        the connection or the server is terminated part way through.
+
+        Each run has its own running flag and watcher thread, which is
+        finished with before the next client is accepted, so a client
+        that goes away can only cancel its own run.
+        '''
+        import modelmain
+
+        request = conn.recv()
+
+        if request[0] == 'stop':
+            self.stopping = True
+            return
+
+        folder, argv = request[1], request[2]
+        stdout, stderr = sys.stdout, sys.stderr
+        code, stats = 0, {}
+
+        running = threading.Event()
+        running.set()
+        watcher = threading.Thread(target=self.watch, args=(conn, running),
+                                   daemon=True)
+        watcher.start()
+
+        try:
+            sys.stdout = Output(conn, 'out')
+            sys.stderr = Output(conn, 'err')
+            os.chdir(folder)
+            modelmain.start_time = time.perf_counter()
+
+            result = modelmain.main(argv, self.warm)
+            stats = result.stats
+        except SystemExit as e:
+            # Argument errors, help and sys.exit('message')
+            if isinstance(e.code, str):
+                print(e.code, file=sys.stderr)
+                code = 1
+            else:
+                code = e.code or 0
+        except KeyboardInterrupt:
+            print('Run cancelled.', file=sys.stderr)
+            code = 1
+        except Exception as e:
+            print(type(e).__name__ + ': ' + str(e), file=sys.stderr)
+            code = 1
+        finally:
+            with self.lock:
+                running.clear()
+
+            sys.stdout, sys.stderr = stdout, stderr
+
+            # Start the next run with a fresh figure
+            if 'matplotlib.pyplot' in sys.modules:
+                sys.modules['matplotlib.pyplot'].close('all')
+
+        try:
+            conn.send(('done', code, stats))
+        finally:
+            watcher.join()
+
+
+    def watch(self, conn, running):
+        '''
+        Cancel the run (from its own thread) if the client goes away
+        before the run ends.
+
+        Inputs:
+            - conn: Connection to the client of the run
+            - running: Event set while the run is in progress
+        '''
+        try:
+            while running.is_set():
+                if conn.poll(0.05):
+                    conn.recv()
+        except (OSError, EOFError):
+            with self.lock:
+                if running.is_set():
+                    _thread.interrupt_main()
+
+
+    def stop(self, signum, frame):
+        '''
+        Stop serving when asked to terminate (any run is cancelled).
+        '''
+        self.stopping = True
+        raise KeyboardInterrupt
+
+
+#----------------------------------------------------------
+# Client side
+#----------------------------------------------------------
+def read_address():
+    '''
+    (address, authkey) of the server running in this folder, or None.
+    '''
+    try:
+        with open(ADDRESS_FILE) as f:
+            info = json.load(f)
+
+        return tuple(info['address']), bytes.fromhex(info['authkey'])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def wanted(argv):
+    '''
+    False if the arguments ask not to use the server (--server N).
+    '''
+    for i, arg in enumerate(argv):
+        if arg == '--server' and i + 1 < len(argv):
+            return argv[i + 1].upper() == 'Y'
+
+        if arg.startswith('--server='):
+            return arg[len('--server='):].upper() == 'Y'
+
+    return True
+
+
+def forward(argv):
+    '''
+    Run the model on the server running in this folder, printing its
+    output as it arrives, and exit with the exit status of the run.
+
+    Returns (without running anything) if there is no server to use, so
+    the caller can run the model itself.
+
+    Inputs:
+        - argv: modelmain.py arguments
+    '''
+    if not wanted(argv):
+        return
+
+    server = read_address()
+
+    if server is None:
+        return
+
+    try:
+        conn = Client(server[0], authkey=server[1])
+    except (OSError, AuthenticationError):
+        # Stale address file - the server is no longer running
+        return
+
+    # Closing the connection cancels the run on the server
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+    try:
+        conn.send(('run', os.getcwd(), list(argv)))
+
+        while True:
+            reply = conn.recv()
+
+            if reply[0] == 'out':
+                sys.stdout.write(reply[1])
+                sys.stdout.flush()
+            elif reply[0] == 'err':
+                sys.stderr.write(reply[1])
+                sys.stderr.flush()
+            else:
+                code = reply[1]
+                break
+    except (OSError, EOFError):
+        code = 'Model server stopped during the run.'
+    except KeyboardInterrupt:
+        code = 'Run cancelled.'
+    finally:
+        conn.close()
+
+    sys.exit(code)
+
+
+def start():
+    '''
+    Start a server for this folder in the background (if none is
+    running) and return its process (None if one was already running).
+    '''
+    server = read_address()
+
+    if server is not None:
+        try:
+            Client(server[0], authkey=server[1]).close()
+            return None
+        except (OSError, AuthenticationError):
+            pass
+
+    return subprocess.Popen([sys.executable, 'modelserver.py'],
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL,
+                            start_new_session=True)
+
+
+def stop_server():
+    '''
+    Stop the server running in this folder.  Returns False if there was
+    none.
+    '''
+    server = read_address()
+
+    if server is None:
+        return False
+
+    try:
+        conn = Client(server[0], authkey=server[1])
+    except (OSError, AuthenticationError):
+        return False
+
+    conn.send(('stop',))
+    conn.close()
+
+    return True
+
+
+#----------------------------------------------------------
+# Command line processing
+#----------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Keep the Agent model warm between runs.')
+    parser.add_argument('--stop', action='store_true',
+                        help='Stop the server running in this folder')
+    args = parser.parse_args()
+
+    if args.stop:
+        if not stop_server():
+            sys.exit('No server running')
+    else:
+        server = Server()
+        signal.signal(signal.SIGTERM, server.stop)
+
+        # Cancelling a run interrupts it as Ctrl-C would (Ctrl-C is
+        # ignored when started in the background by some shells)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+        # Import everything a run needs up front
+        import modelmain
+
+        for name in ('matplotlib.pyplot', 'requests', 'bs4'):
+            try:
+                __import__(name)
+            except ImportError:
+                pass
+
+        server.serve()
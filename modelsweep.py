@@ -0,0 +1,242 @@
+'''
+Agent model parameter sweep
+
+Filename: modelsweep.py
+
+Called by:
+    - Command line
+
+Input:
+    - Optional arguments:
+        - agents, distance, wolves, moves - Comma separated values of each
+          parameter to sweep (every combination is run)
+        - replicates - Number of runs of each combination
+        - seed - Seed of the sweep (replicate r uses stream r spawned from
+          it, shared by every parameter combination)
+        - workers - Number of worker processes (default all cores)
+        - table - Combined results table (CSV)
+        - raster - Environment raster file
+
+Output:
+    - Files
+        - Combined results table (one row per run).  Runs already in the
+          table are skipped, so an interrupted sweep resumes where it left
+          off when run again.
+
+Each worker maps the binary copy of the raster (see environment.py)
+read-only rather than parsing the text raster for every run.
+'''
+import os
+import sys
+import csv
+import argparse
+import itertools
+import concurrent.futures
+import numpy as np
+import modelmain
+from environment import RASTER_SUFFIX, Environment, convert_text_raster, \
+                        cache_is_current, read_binary_raster
+
+
+#----------------------------------------------------------
+# Initialise variables
+#----------------------------------------------------------
+sweep_params = ['agents', 'distance', 'wolves', 'moves']
+table_fields = sweep_params + ['replicate', 'seed', 'iterations',
+                               'agents_killed', 'agents_alive',
+                               'total_store', 'run_time']
+
+# Raster shared by the runs of a worker process
+worker_environment = None
+
+
+#----------------------------------------------------------
+# Worker processing
+#----------------------------------------------------------
+def init_worker(raster_path):
+    '''
+    Map the raster once per worker and silence per-run output (kills).
+    '''
+    global worker_environment
+
+    worker_environment = Environment(read_binary_raster(raster_path,
+                                                        mode='r'),
+                                     copy=False)
+    sys.stdout = open(os.devnull, 'w')
+
+
+def run_one(run):
+    '''
+    Run the model for one row of the sweep and return the table row.
+    '''
+    config = modelmain.parse_arguments(
+        ['--' + param + '=' + str(run[param]) for param in sweep_params] +
+        ['--headless=Y'])
+
+    # Same stream as SeedSequence(seed).spawn(replicates)[replicate]
+    seed = np.random.SeedSequence(run['seed'], 
+                                  spawn_key=(run['replicate'],))
+
+    result = modelmain.run_model(config, worker_environment, seed=seed)
+
+    row = dict(run)
+    row.update(result.stats)
+
+    return row
+
+
+#----------------------------------------------------------
+# Sweep processing
+#----------------------------------------------------------
+def sweep_runs(values, replicates, seed):
+    '''
+    List every run of the sweep (each combination x each replicate).
+
+    Inputs:
+        - values: Dictionary of the values of each sweep parameter
+        - replicates: Number of runs of each combination
+        - seed: Seed of the sweep
+    '''
+    runs = []
+
+    for combination in itertools.product(*[values[param]
+                                           for param in sweep_params]):
+        for replicate in range(replicates):
+            run = dict(zip(sweep_params, combination))
+            run['replicate'] = replicate
+            run['seed'] = seed
+            runs.append(run)
+
+    return runs
+
+
+def run_key(run):
+    '''
+    Identify a run by its parameters, replicate and seed.
+    '''
+    return tuple(str(run[field]) for field in sweep_params +
+                 ['replicate', 'seed'])
+
+
+def completed_runs(table_path):
+    '''
+    Keys of the runs already in the results table.
+    '''
+    if not os.path.exists(table_path):
+        return set()
+
+    with open(table_path, newline='') as f:
+        return set(run_key(row) for row in csv.DictReader(f))
+
+
+def shared_raster(raster_path):
+    '''
+    Binary copy of the raster for the workers to map (converted once).
+    '''
+    if raster_path.endswith(RASTER_SUFFIX):
+        return raster_path
+
+    binary_path = raster_path + RASTER_SUFFIX
+
+    if not cache_is_current(raster_path, binary_path):
+        convert_text_raster(raster_path, binary_path)
+
+    return binary_path
+
+
+def run_sweep(values, replicates=1, seed=0, workers=None,
+              table_path='sweep.csv', raster_path='in.txt'):
+    '''
+    Run every combination of the sweep values over a process pool,
+    appending each finished run to the results table.
+
+    Returns the number of runs made (runs already in the table are
+    skipped).
+    '''
+    runs = sweep_runs(values, replicates, seed)
+    done = completed_runs(table_path)
+    runs = [run for run in runs if run_key(run) not in done]
+
+    if not runs:
+        return 0
+
+    if workers is None:
+        workers = len(os.sched_getaffinity(0)) \
+                  if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+    new_table = not os.path.exists(table_path)
+
+    with open(table_path, 'a', newline='') as f, \
+         concurrent.futures.ProcessPoolExecutor(
+             max_workers=workers, initializer=init_worker,
+             initargs=(shared_raster(raster_path),)) as pool:
+
+        table = csv.DictWriter(f, fieldnames=table_fields,
+                               extrasaction='ignore')
+
+        if new_table:
+            table.writeheader()
+
+        futures = [pool.submit(run_one, run) for run in runs]
+
+        for count, future in enumerate(
+                concurrent.futures.as_completed(futures), 1):
+            # Written as each run finishes so the sweep can be resumed
+            table.writerow(future.result())
+            f.flush()
+
+            print('Run', count, 'of', len(runs), 'complete')
+
+    return len(runs)
+
+
+def parse_values(text):
+    '''
+    Comma separated integers (each > 0).
+    '''
+    try:
+        values = [int(value) for value in text.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(text + ' - Must be integers > 0')
+
+    if min(values) < 1:
+        raise argparse.ArgumentTypeError(text + ' - Must be integers > 0')
+
+    return values
+
+
+#----------------------------------------------------------
+# Command line processing
+#----------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run the Agents model over a grid of parameters.')
+
+    for param, default in zip(sweep_params, ['10', '20', '5', '100']):
+        parser.add_argument('--' + param, type=parse_values,
+                            default=parse_values(default),
+                            help='Values of --' + param +
+                                 ' (comma separated, default ' + default +
+                                 ')')
+
+    parser.add_argument('--replicates', type=int, default=1,
+                        help='Number of runs of each combination')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the sweep')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of worker processes (default all cores)')
+    parser.add_argument('--table', default='sweep.csv',
+                        help='Combined results table (CSV)')
+    parser.add_argument('--raster', default='in.txt',
+                        help='Environment raster file')
+    args = parser.parse_args()
+
+    try:
+        made = run_sweep({param: getattr(args, param)
+                          for param in sweep_params},
+                         args.replicates, args.seed, args.workers,
+                         args.table, args.raster)
+    except ValueError as err:
+        sys.exit(str(err))
+
+    print(made, 'runs made, results in', args.table)
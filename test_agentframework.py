@@ -0,0 +1,155 @@
+'''
+Filename: test_agentframework.py
+
+Contains:
+- Functions: make_agents, run_agents, test_grid_matches_brute_force,
+  test_neighbour_list_matches_brute_force,
+  test_neighbour_list_after_step_matches_brute_force,
+  test_reordered_agents_match_list_order, test_eat_all_matches_eat_one,
+  test_raster_rows_refused
+
+Neighbour searches through the Agent methods on seeded populations: the
+spatial grid index and the neighbour list must give the stores of the
+brute-force search.  To run, enter:
+    python -m pytest -q test_agentframework.py
+'''
+import numpy as np
+import pytest
+import agentframework
+from environment import Environment
+
+
+#----------------------------------------------------------
+# Helpers
+#----------------------------------------------------------
+def make_agents(num_of_agents=200, seed=5):
+    '''
+    Seeded Agents on a small raster (crowded, so most have neighbours).
+
+    Inputs:
+        - num_of_agents: Number of Agents
+        - seed: Seed of the raster and Agents
+    '''
+    rng = np.random.default_rng(seed)
+    environment = Environment(rng.integers(0, 500, (40, 50)))
+    population = agentframework.AgentPopulation(environment, num_of_agents,
+                                                rng=rng)
+    agents = []
+
+    for i in range(num_of_agents):
+        agents.append(agentframework.Agent(environment, agents,
+                                           population=population))
+
+    return agents
+
+
+def run_agents(index, iterations=12, neighbourhood=6, steps=0):
+    '''
+    Stores after Agents move, eat and share one at a time through the
+    Agent methods (after some AgentPopulation.step iterations).
+
+    Inputs:
+        - index: 'grid', 'list' (skin 3) or None for the brute-force
+                 search
+        - iterations: Iterations through the Agent methods
+        - neighbourhood: Distance considered to be a neighbour
+        - steps: AgentPopulation.step iterations first
+    '''
+    agents = make_agents()
+    population = agents[0].population
+
+    if index == 'grid':
+        population.use_grid(neighbourhood)
+    elif index == 'list':
+        population.use_neighbour_list(neighbourhood, 3)
+
+    for j in range(steps):
+        population.step(np.arange(len(population)), neighbourhood)
+
+    for j in range(iterations):
+        for agent in agents:
+            agent.move()
+            agent.eat()
+            agent.share_with_neighbours(neighbourhood)
+
+    return population.store.copy()
+
+
+#----------------------------------------------------------
+# Tests
+#----------------------------------------------------------
+def test_grid_matches_brute_force():
+    np.testing.assert_array_equal(run_agents('grid'), run_agents(None))
+
+
+def test_neighbour_list_matches_brute_force():
+    np.testing.assert_array_equal(run_agents('list'), run_agents(None))
+
+
+def test_neighbour_list_after_step_matches_brute_force():
+    np.testing.assert_array_equal(run_agents('list', steps=3),
+                                  run_agents(None, steps=3))
+
+
+def test_reordered_agents_match_list_order():
+    stores = []
+
+    for cached in (True, False):
+        agents = make_agents()
+        population = agents[0].population
+        population.use_grid(6)
+
+        for agent in agents:
+            agent.eat()
+            agent.share_with_neighbours(6)
+
+        agents.reverse()
+        population.reorder_agents()
+
+        for agent in agents:
+            agent.move()
+            agent.eat()
+
+            if cached:
+                agent.share_with_neighbours(6)
+            else:
+                # Neighbours visited in the order of the list as it is now
+                order = np.array([other.index for other in agents])
+                population.share_one(agent.index, 6, order)
+
+        stores.append(population.store.copy())
+
+    np.testing.assert_array_equal(stores[0], stores[1])
+
+
+def test_eat_all_matches_eat_one():
+    stores = []
+
+    for batched in (True, False):
+        agents = make_agents(2000)
+        population = agents[0].population
+
+        # Stores near 100, so Agents sharing a cell put back in turn
+        population.store[:] = np.arange(2000) % 120
+
+        if batched:
+            population.eat_all(np.arange(2000)[::-1])
+        else:
+            for agent in agents[::-1]:
+                agent.eat()
+
+        stores.append(population.store.copy())
+        stores.append(population.environment.data.copy())
+
+    np.testing.assert_array_equal(stores[0], stores[2])
+    np.testing.assert_array_equal(stores[1], stores[3])
+
+
+def test_raster_rows_refused():
+    rows = [[100.0] * 5 for i in range(4)]
+
+    with pytest.raises(ValueError):
+        agentframework.Agent(rows, [])
+
+    with pytest.raises(ValueError):
+        agentframework.Wolf(rows, [])
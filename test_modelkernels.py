@@ -0,0 +1,90 @@
+'''
+Filename: test_modelkernels.py
+
+Contains:
+- Functions: run_population, assert_same,
+  test_fallback_kernel_matches_python, test_compiled_kernel_matches_python,
+  test_kernel_skips_rows_not_in_order
+
+Parity of the step kernel backends with AgentPopulation.step on seeded
+populations.  To run, enter:
+    python -m pytest -q test_modelkernels.py
+'''
+import numpy as np
+import pytest
+import agentframework
+import modelkernels
+from environment import Environment
+
+
+#----------------------------------------------------------
+# Helpers
+#----------------------------------------------------------
+def run_population(kernel, num_of_agents=300, iterations=10,
+                   neighbourhood=15, seed=3, subset=False):
+    '''
+    Seeded population after some iterations through a kernel (None for
+    the Python implementation).
+
+    Inputs:
+        - kernel: Step kernel, or None
+        - num_of_agents: Number of Agents
+        - iterations: Number of iterations
+        - neighbourhood: Distance considered to be a neighbour
+        - seed: Seed of the raster, Agents and orders
+        - subset: Process only half the live Agents each iteration
+    '''
+    raster = np.random.default_rng(seed).integers(0, 500, (80, 80))
+    rng = np.random.default_rng(seed)
+    population = agentframework.AgentPopulation(Environment(raster),
+                                                num_of_agents, rng=rng)
+
+    for i in range(num_of_agents):
+        population.add()
+
+    population.use_kernel(kernel)
+
+    for j in range(iterations):
+        population.kill(int(rng.integers(num_of_agents)))
+        order = rng.permutation(population.live_rows())
+
+        if subset:
+            order = order[:len(order) // 2]
+
+        population.step(order, neighbourhood)
+
+    return population
+
+
+def assert_same(python, other):
+    '''
+    Assert two populations (and their rasters) are identical.
+    '''
+    for name in ('y', 'x', 'store', 'moves', 'alive'):
+        np.testing.assert_array_equal(getattr(python, name),
+                                      getattr(other, name), err_msg=name)
+
+    np.testing.assert_array_equal(python.environment.data,
+                                  other.environment.data)
+
+
+#----------------------------------------------------------
+# Tests
+#----------------------------------------------------------
+def test_fallback_kernel_matches_python():
+    assert_same(run_population(None),
+                run_population(modelkernels.step_kernel))
+
+
+@pytest.mark.skipif(modelkernels.compiled_step_kernel is None,
+                    reason='Numba not installed')
+def test_compiled_kernel_matches_python():
+    assert_same(run_population(None),
+                run_population(modelkernels.compiled_step_kernel))
+
+
+def test_kernel_skips_rows_not_in_order():
+    kernel = modelkernels.compiled_step_kernel or modelkernels.step_kernel
+
+    assert_same(run_population(None, subset=True),
+                run_population(kernel, subset=True))